@@ -0,0 +1,78 @@
+"""
+Boot Benchmark - Source vs Precompiled Bytecode
+Run this on the Pico to compare importing an update as .py source against
+importing the same update as .mpy bytecode.
+
+Setup (from your computer, with the server running):
+    curl -o bench_src.py  http://localhost:3000/updates/2.0.0/code
+    curl -o bench_mpy.mpy http://localhost:3000/updates/2.0.0/mpy
+    mpremote cp bench_src.py :bench_src.py
+    mpremote cp bench_mpy.mpy :bench_mpy.mpy
+    mpremote run bench_boot.py
+"""
+import gc
+import sys
+import utime
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# Module name and label for each form of the update
+MODULES = (
+    ("bench_src", "source (.py)"),
+    ("bench_mpy", "bytecode (.mpy)"),
+)
+RUNS = 5
+
+def measure(name):
+    """Import a module once, returns (time us, bytes allocated, bytes retained,
+    bytes free with the module loaded)"""
+    sys.modules.pop(name, None)
+    gc.collect()
+    free_before = gc.mem_free()
+
+    # No collections during the import, so the allocation total includes
+    # everything the compiler needed along the way
+    gc.disable()
+    try:
+        start = utime.ticks_us()
+        __import__(name)
+        elapsed = utime.ticks_diff(utime.ticks_us(), start)
+        free_after_import = gc.mem_free()
+    finally:
+        # A failed import must not leave the collector off for later runs
+        gc.enable()
+
+    gc.collect()
+    free_after_collect = gc.mem_free()
+    sys.modules.pop(name, None)
+    return (elapsed, free_before - free_after_import, free_before - free_after_collect,
+            free_after_collect)
+
+def run_benchmark():
+    results = {}
+    for name, label in MODULES:
+        try:
+            runs = [measure(name) for _ in range(RUNS)]
+        except (ImportError, MemoryError) as e:
+            print("{}: failed ({})".format(label, e))
+            continue
+
+        results[label] = {
+            "import_us_min": min(run[0] for run in runs),
+            "import_us_avg": sum(run[0] for run in runs) // RUNS,
+            "allocated_bytes": max(run[1] for run in runs),
+            "retained_bytes": max(run[2] for run in runs),
+            "mem_free_after": min(run[3] for run in runs)
+        }
+        r = results[label]
+        print("{:16} import {:>8} us (min {:>8})  allocated {:>7} B  retained {:>7} B".format(
+            label, r["import_us_avg"], r["import_us_min"], r["allocated_bytes"], r["retained_bytes"]))
+
+    print(json.dumps(results))
+    return results
+
+if __name__ == "__main__":
+    print("=== Boot Benchmark: source vs bytecode ===")
+    run_benchmark()
@@ -0,0 +1,356 @@
+// CoAP endpoint for devices that use the modem's CoAP client instead of HTTP
+//
+// A stand-in that translates each CoAP request into the equivalent HTTP
+// request on this server, so both transports share one implementation:
+//   GET  /c/<version>?d=<id>              -> GET /c/<version>, 304 becomes 2.03 Valid
+//   POST /ota with a JSON payload         -> POST /ota
+//   GET  /f/<version>/<format>/<path>?d=<id>&c=<compression>[&f=<delta from>]
+//        with Block2 <num>                -> GET /firmware/<version> with the Range of block <num>
+// HTTP status codes become the CoAP code with the same class and detail
+// (404 -> 4.04, 429 -> 4.29 with Max-Age set to the retry time). Answers
+// longer than the requested block size are sent block-wise (Block2).
+//
+// Confirmable requests are answered with a piggybacked ACK, non-confirmable
+// ones with a NON. Each answer is kept for EXCHANGE_LIFETIME ms so a
+// retransmitted request gets the same answer without running twice.
+
+const dgram = require('dgram');
+const http = require('http');
+const crypto = require('crypto');
+
+// Message types
+const CON = 0, NON = 1, ACK = 2, RST = 3;
+// Request methods
+const GET = 1, POST = 2;
+// Option numbers
+const URI_PATH = 11, CONTENT_FORMAT = 12, MAX_AGE = 14, URI_QUERY = 15, BLOCK2 = 23;
+// Content formats
+const TEXT_PLAIN = 0, OCTET_STREAM = 42, APPLICATION_JSON = 50;
+
+const VALID = (2 << 5) | 3;
+const CONTENT = (2 << 5) | 5;
+const NOT_FOUND = (4 << 5) | 4;
+const METHOD_NOT_ALLOWED = (4 << 5) | 5;
+
+const MAX_BLOCK_SIZE = 1024;
+const MAX_SZX = Math.log2(MAX_BLOCK_SIZE) - 4;  // Block size is 16 << szx
+const EXCHANGE_LIFETIME = 60000;
+
+// Nibble and extension bytes of an option delta or length
+function optionField(n) {
+    if (n < 13) {
+        return [n, Buffer.alloc(0)];
+    }
+    if (n < 269) {
+        return [13, Buffer.from([n - 13])];
+    }
+    const ext = Buffer.alloc(2);
+    ext.writeUInt16BE(n - 269);
+    return [14, ext];
+}
+
+// Unsigned integer option value in its shortest form
+function encodeUint(n) {
+    const bytes = [];
+    for (; n > 0; n = Math.floor(n / 256)) {
+        bytes.unshift(n % 256);
+    }
+    return Buffer.from(bytes);
+}
+
+function decodeUint(buf) {
+    return buf.reduce((n, b) => n * 256 + b, 0);
+}
+
+// Parse a datagram into { type, code, mid, token, options, payload }, where
+// options maps an option number to the list of its values
+function decode(buf) {
+    if (buf.length < 4 || buf[0] >> 6 !== 1) {
+        throw new Error('Not a CoAP message');
+    }
+    const tkl = buf[0] & 0x0f;
+    const msg = {
+        type: (buf[0] >> 4) & 3,
+        code: buf[1],
+        mid: buf.readUInt16BE(2),
+        token: buf.subarray(4, 4 + tkl),
+        options: new Map(),
+        payload: Buffer.alloc(0)
+    };
+    let pos = 4 + tkl;
+    let number = 0;
+    while (pos < buf.length) {
+        const byte = buf[pos++];
+        if (byte === 0xff) {
+            msg.payload = buf.subarray(pos);
+            break;
+        }
+        const fields = [byte >> 4, byte & 0x0f].map(nibble => {
+            if (nibble === 13) {
+                return buf[pos++] + 13;
+            }
+            if (nibble === 14) {
+                pos += 2;
+                return buf.readUInt16BE(pos - 2) + 269;
+            }
+            return nibble;
+        });
+        number += fields[0];
+        if (!msg.options.has(number)) {
+            msg.options.set(number, []);
+        }
+        msg.options.get(number).push(buf.subarray(pos, pos + fields[1]));
+        pos += fields[1];
+    }
+    return msg;
+}
+
+// Build a datagram; options is a list of [number, Buffer]
+function encode({ type, code, mid, token, options = [], payload }) {
+    const parts = [Buffer.from([0x40 | (type << 4) | token.length, code, mid >> 8, mid & 0xff]), token];
+    let last = 0;
+    for (const [number, value] of options.slice().sort((a, b) => a[0] - b[0])) {
+        const [delta, deltaExt] = optionField(number - last);
+        const [length, lengthExt] = optionField(value.length);
+        parts.push(Buffer.from([(delta << 4) | length]), deltaExt, lengthExt, value);
+        last = number;
+    }
+    if (payload && payload.length) {
+        parts.push(Buffer.from([0xff]), payload);
+    }
+    return Buffer.concat(parts);
+}
+
+// Block2 value: block number, more flag and size exponent (size = 16 << szx)
+function blockOption(num, more, szx) {
+    return [BLOCK2, encodeUint(num * 16 + (more ? 8 : 0) + szx)];
+}
+
+// CoAP response code of an HTTP status
+function statusToCode(status) {
+    if (status === 304) {
+        return VALID;
+    }
+    if (status >= 200 && status < 300) {
+        return CONTENT;
+    }
+    return (Math.floor(status / 100) << 5) | (status % 100);
+}
+
+class CoapProxy {
+    constructor({ port = 5683, httpPort, httpHost = '127.0.0.1' }) {
+        this.port = port;
+        this.httpPort = httpPort;
+        this.httpHost = httpHost;
+        this.agent = new http.Agent({ keepAlive: true });
+        this.exchanges = new Map();  // "<address>:<port>:<mid>" -> { reply, expires }
+        this.bodies = new Map();     // Block-wise answers of POSTs, by request
+        this.nextMid = Math.floor(Math.random() * 0x10000);
+        this.counters = { requests: 0, duplicates: 0, bytes_in: 0, bytes_out: 0 };
+    }
+
+    start() {
+        this.socket = dgram.createSocket('udp4');
+        this.socket.on('message', (buf, rinfo) => this.onMessage(buf, rinfo));
+        this.socket.on('error', error => console.error('CoAP endpoint error:', error.message));
+        this.socket.bind(this.port, () => console.log(`CoAP endpoint on udp port ${this.port}`));
+        setInterval(() => this.expire(Date.now()), EXCHANGE_LIFETIME).unref();
+    }
+
+    expire(now) {
+        for (const cache of [this.exchanges, this.bodies]) {
+            for (const [key, entry] of cache) {
+                if (entry.expires < now) {
+                    cache.delete(key);
+                }
+            }
+        }
+    }
+
+    send(buf, rinfo) {
+        this.counters.bytes_out += buf.length;
+        this.socket.send(buf, rinfo.port, rinfo.address);
+    }
+
+    async onMessage(buf, rinfo) {
+        this.counters.bytes_in += buf.length;
+        let req;
+        try {
+            req = decode(buf);
+        } catch (error) {
+            return;  // Not CoAP, nothing to answer
+        }
+        if (req.type === ACK || req.type === RST) {
+            return;
+        }
+        if (req.code === 0) {
+            // Empty message, a ping
+            this.send(encode({ type: RST, code: 0, mid: req.mid, token: Buffer.alloc(0) }), rinfo);
+            return;
+        }
+
+        const key = `${rinfo.address}:${rinfo.port}:${req.mid}`;
+        const known = this.exchanges.get(key);
+        if (known) {
+            this.counters.duplicates++;
+            if (known.reply) {
+                this.send(known.reply, rinfo);
+            }
+            return;
+        }
+        const exchange = { reply: null, expires: Date.now() + EXCHANGE_LIFETIME };
+        this.exchanges.set(key, exchange);
+        this.counters.requests++;
+
+        let res;
+        try {
+            res = await this.handle(req, rinfo);
+        } catch (error) {
+            console.error('CoAP request failed:', error.message);
+            res = { status: 502, payload: Buffer.alloc(0) };
+        }
+        const code = res.code || statusToCode(res.status);
+        const options = res.options || [];
+        if (res.format !== undefined && res.payload.length) {
+            options.push([CONTENT_FORMAT, encodeUint(res.format)]);
+        }
+        exchange.reply = encode({
+            type: req.type === CON ? ACK : NON,
+            code,
+            mid: req.type === CON ? req.mid : (this.nextMid = (this.nextMid + 1) & 0xffff),
+            token: req.token,
+            options,
+            payload: res.payload
+        });
+        this.send(exchange.reply, rinfo);
+    }
+
+    // Run a request on the HTTP side, resolves to { status, headers, body }
+    forward(method, urlPath, body, extraHeaders) {
+        return new Promise((resolve, reject) => {
+            const headers = Object.assign(
+                body ? { 'Content-Type': 'application/json', 'Content-Length': body.length } : {}, extraHeaders);
+            const request = http.request({
+                host: this.httpHost,
+                port: this.httpPort,
+                method,
+                path: urlPath,
+                headers,
+                agent: this.agent
+            }, response => {
+                const parts = [];
+                response.on('data', part => parts.push(part));
+                response.on('end', () => resolve({
+                    status: response.statusCode,
+                    headers: response.headers,
+                    body: Buffer.concat(parts)
+                }));
+            });
+            request.on('error', reject);
+            request.end(body);
+        });
+    }
+
+    async handle(req, rinfo) {
+        const segments = (req.options.get(URI_PATH) || []).map(s => s.toString());
+        const query = {};
+        for (const item of req.options.get(URI_QUERY) || []) {
+            const [name, ...value] = item.toString().split('=');
+            query[name] = value.join('=');
+        }
+        const block2 = req.options.get(BLOCK2);
+        const block = block2 ? decodeUint(block2[0]) : 0;
+        // Devices may ask for smaller blocks, never for larger ones
+        const szx = block2 ? Math.min(block & 7, MAX_SZX) : MAX_SZX;
+        const num = Math.floor(block / 16);
+
+        if (segments[0] === 'c' && segments.length === 2) {
+            if (req.code !== GET) {
+                return { code: METHOD_NOT_ALLOWED, payload: Buffer.alloc(0) };
+            }
+            const q = query.d ? `?d=${encodeURIComponent(query.d)}` : '';
+            const res = await this.forward('GET', `/c/${encodeURIComponent(segments[1])}${q}`);
+            return this.blockwise(res.status, res.body, TEXT_PLAIN, num, szx, !!block2);
+        }
+
+        if (segments[0] === 'ota' && segments.length === 1) {
+            if (req.code !== POST) {
+                return { code: METHOD_NOT_ALLOWED, payload: Buffer.alloc(0) };
+            }
+            // Later blocks of a large answer come from the first request's
+            // answer rather than running the action again
+            const key = `${rinfo.address}:${rinfo.port}:` +
+                crypto.createHash('sha1').update(req.payload).digest('hex');
+            let res = num > 0 && this.bodies.get(key);
+            if (!res) {
+                res = await this.forward('POST', '/ota', req.payload);
+                res.expires = Date.now() + EXCHANGE_LIFETIME;
+                this.bodies.set(key, res);
+            }
+            return this.blockwise(res.status, res.body, APPLICATION_JSON, num, szx, !!block2,
+                res.headers['retry-after']);
+        }
+
+        if (segments[0] === 'f' && segments.length >= 4) {
+            if (req.code !== GET) {
+                return { code: METHOD_NOT_ALLOWED, payload: Buffer.alloc(0) };
+            }
+            const size = 16 << szx;
+            const params = new URLSearchParams({
+                format: segments[2],
+                path: segments.slice(3).join('/'),
+                compression: query.c || 'none'
+            });
+            if (query.f) {
+                params.set('from', query.f);
+            }
+            if (query.d) {
+                params.set('d', query.d);
+            }
+            const res = await this.forward('GET', `/firmware/${encodeURIComponent(segments[1])}?${params}`,
+                null, { Range: `bytes=${num * size}-${num * size + size - 1}` });
+            if (res.status !== 206) {
+                return this.failure(res.status, res.body, res.headers['retry-after']);
+            }
+            // Content-Range: bytes <first>-<last>/<total>
+            const [, last, total] = /-(\d+)\/(\d+)$/.exec(res.headers['content-range']);
+            return {
+                status: 200,
+                format: OCTET_STREAM,
+                options: [blockOption(num, Number(last) + 1 < Number(total), szx)],
+                payload: res.body
+            };
+        }
+
+        return { code: NOT_FOUND, payload: Buffer.alloc(0) };
+    }
+
+    failure(status, body, retryAfter) {
+        const options = retryAfter ? [[MAX_AGE, encodeUint(Number(retryAfter))]] : [];
+        return { status, format: APPLICATION_JSON, options, payload: body };
+    }
+
+    // Block num of an answer, whole if it fits and no block was asked for
+    blockwise(status, body, format, num, szx, requested, retryAfter) {
+        if (status >= 300 && status !== 304) {
+            return this.failure(status, body, retryAfter);
+        }
+        const size = 16 << szx;
+        if (!requested && body.length <= size) {
+            return { status, format, payload: body };
+        }
+        const start = num * size;
+        return {
+            status,
+            format,
+            options: [blockOption(num, start + size < body.length, szx)],
+            payload: body.subarray(start, start + size)
+        };
+    }
+
+    stats() {
+        return Object.assign({ port: this.port, exchanges: this.exchanges.size }, this.counters);
+    }
+}
+
+module.exports = { CoapProxy, encode, decode, statusToCode };
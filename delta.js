@@ -0,0 +1,114 @@
+// Binary delta patches between two releases
+//
+// Patch format (all integers big-endian uint32):
+//   "OTD1" <new_size>
+//   followed by operations until the end of the patch:
+//   'C' <offset> <length>          copy length bytes of the old file at offset
+//   'I' <length> <length bytes>    insert literal bytes
+//
+// The device applies a patch by streaming it from flash while seeking in
+// the old file, so RAM use is bounded by its copy buffer.
+
+const MAGIC = Buffer.from('OTD1');
+const OP_COPY = 0x43;
+const OP_INSERT = 0x49;
+
+// Matches shorter than this are cheaper to send as literals
+const BLOCK_SIZE = 16;
+
+function copyOp(offset, length) {
+    const op = Buffer.alloc(9);
+    op[0] = OP_COPY;
+    op.writeUInt32BE(offset, 1);
+    op.writeUInt32BE(length, 5);
+    return op;
+}
+
+function insertOp(data) {
+    const op = Buffer.alloc(5);
+    op[0] = OP_INSERT;
+    op.writeUInt32BE(data.length, 1);
+    return Buffer.concat([op, data]);
+}
+
+// Build a patch that turns oldData into newData
+function createDelta(oldData, newData) {
+    // Index the old file at block boundaries, first occurrence wins
+    const index = new Map();
+    for (let i = 0; i + BLOCK_SIZE <= oldData.length; i += BLOCK_SIZE) {
+        const key = oldData.toString('latin1', i, i + BLOCK_SIZE);
+        if (!index.has(key)) {
+            index.set(key, i);
+        }
+    }
+
+    const header = Buffer.alloc(8);
+    MAGIC.copy(header);
+    header.writeUInt32BE(newData.length, 4);
+    const ops = [header];
+
+    // Slide over the new file; on a block match extend it in both directions
+    let literalStart = 0;
+    let i = 0;
+    while (i + BLOCK_SIZE <= newData.length) {
+        const match = index.get(newData.toString('latin1', i, i + BLOCK_SIZE));
+        if (match === undefined) {
+            i++;
+            continue;
+        }
+
+        let src = match;
+        let dst = i;
+        while (dst > literalStart && src > 0 && oldData[src - 1] === newData[dst - 1]) {
+            src--;
+            dst--;
+        }
+        let length = i + BLOCK_SIZE - dst;
+        while (dst + length < newData.length && src + length < oldData.length &&
+               oldData[src + length] === newData[dst + length]) {
+            length++;
+        }
+
+        if (dst > literalStart) {
+            ops.push(insertOp(newData.subarray(literalStart, dst)));
+        }
+        ops.push(copyOp(src, length));
+        i = literalStart = dst + length;
+    }
+    if (literalStart < newData.length) {
+        ops.push(insertOp(newData.subarray(literalStart)));
+    }
+
+    return Buffer.concat(ops);
+}
+
+// Apply a patch in memory, used to check generated patches before serving them
+function applyDelta(oldData, patch) {
+    if (!patch.subarray(0, 4).equals(MAGIC)) {
+        throw new Error('Not a delta patch');
+    }
+    const out = Buffer.alloc(patch.readUInt32BE(4));
+    let written = 0;
+    let pos = 8;
+    while (pos < patch.length) {
+        const op = patch[pos];
+        if (op === OP_COPY) {
+            const offset = patch.readUInt32BE(pos + 1);
+            const length = patch.readUInt32BE(pos + 5);
+            written += oldData.copy(out, written, offset, offset + length);
+            pos += 9;
+        } else if (op === OP_INSERT) {
+            const length = patch.readUInt32BE(pos + 1);
+            written += patch.copy(out, written, pos + 5, pos + 5 + length);
+            pos += 5 + length;
+        } else {
+            throw new Error(`Bad delta operation 0x${op.toString(16)}`);
+        }
+    }
+    if (written !== out.length) {
+        throw new Error('Delta output size mismatch');
+    }
+    return out;
+}
+
+module.exports = { createDelta, applyDelta };
@@ -0,0 +1,228 @@
+// Device registry persisted as an append-only log
+//
+// The registry lives in memory and is written to <file> as JSON lines, one
+// device record per line, the last line for a device winning on replay.
+// Check-ins only mark a device dirty; every flushInterval ms the dirty
+// devices are appended in one write, so a device that checks in many
+// times between flushes costs one line. When the log has grown to
+// several times the number of devices it is rewritten with one line each.
+//
+// Device ids are also kept sorted, so list() can page through the fleet
+// from a cursor (the last id of the previous page) without a full scan.
+
+const fs = require('fs');
+const { writeAtomic } = require('./store');
+
+const COMPACT_MIN_LINES = 1000;  // Never compact a log shorter than this
+const COMPACT_RATIO = 4;         // Compact once lines exceed this many per device
+
+class DeviceRegistry {
+    constructor({ file, flushInterval = 1000 }) {
+        this.file = file;
+        this.flushInterval = flushInterval;
+        this.devices = new Map();  // device id -> record
+        this.ids = [];             // device ids in ascending order
+        this.versions = new Map(); // current version -> number of devices
+        this.dirty = new Set();
+        this.logLines = 0;
+        this.flushing = null;
+        this.writes = 0;
+        this.load();
+    }
+
+    load() {
+        let text;
+        try {
+            text = fs.readFileSync(this.file, 'utf8');
+        } catch (error) {
+            if (error.code !== 'ENOENT') {
+                throw error;
+            }
+            return;
+        }
+        for (const line of text.split('\n')) {
+            if (!line) {
+                continue;
+            }
+            this.logLines++;
+            try {
+                const record = JSON.parse(line);
+                record.last_seen = new Date(record.last_seen);
+                this.store(record);
+            } catch (error) {
+                // A line cut short by a crash; the next compaction drops it
+            }
+        }
+    }
+
+    start() {
+        this.timer = setInterval(() => this.flush(), this.flushInterval);
+        this.timer.unref();
+    }
+
+    // Index of the first id not less than id
+    position(id) {
+        let lo = 0;
+        let hi = this.ids.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (this.ids[mid] < id) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        return lo;
+    }
+
+    countVersion(version, delta) {
+        const count = (this.versions.get(version) || 0) + delta;
+        if (count) {
+            this.versions.set(version, count);
+        } else {
+            this.versions.delete(version);
+        }
+    }
+
+    store(record) {
+        const previous = this.devices.get(record.device_id);
+        if (previous) {
+            this.countVersion(previous.current_version, -1);
+        } else {
+            this.ids.splice(this.position(record.device_id), 0, record.device_id);
+        }
+        this.countVersion(record.current_version, 1);
+        this.devices.set(record.device_id, record);
+    }
+
+    // Record a check-in. Fields left undefined keep their previous value.
+    seen(deviceId, { current_version, ip } = {}) {
+        if (!deviceId) {
+            return;
+        }
+        deviceId = String(deviceId);
+        const previous = this.devices.get(deviceId) || {};
+        this.store({
+            device_id: deviceId,
+            current_version: current_version !== undefined ? current_version : previous.current_version,
+            last_seen: new Date(),
+            ip: ip !== undefined ? ip : previous.ip
+        });
+        this.dirty.add(deviceId);
+    }
+
+    // Only refresh last_seen of a known device
+    touch(deviceId) {
+        const record = this.devices.get(deviceId);
+        if (record) {
+            record.last_seen = new Date();
+            this.dirty.add(deviceId);
+        }
+    }
+
+    get(deviceId) {
+        return this.devices.get(deviceId);
+    }
+
+    get size() {
+        return this.devices.size;
+    }
+
+    // [[version, number of devices running it], ...]
+    versionCounts() {
+        return Array.from(this.versions);
+    }
+
+    takeDirty() {
+        const lines = [];
+        for (const id of this.dirty) {
+            lines.push(JSON.stringify(this.devices.get(id)) + '\n');
+        }
+        this.dirty.clear();
+        return lines;
+    }
+
+    // Append the devices changed since the last flush, one write for all
+    flush() {
+        if (this.flushing || this.dirty.size === 0) {
+            return this.flushing;
+        }
+        const lines = this.takeDirty();
+        this.flushing = fs.promises.appendFile(this.file, lines.join(''))
+            .then(() => {
+                this.logLines += lines.length;
+                this.writes++;
+                if (this.logLines > Math.max(COMPACT_MIN_LINES, COMPACT_RATIO * this.devices.size)) {
+                    this.compact();
+                }
+            })
+            .catch(error => {
+                console.error('Device registry write failed:', error.message);
+                for (const line of lines) {
+                    this.dirty.add(JSON.parse(line).device_id);
+                }
+            })
+            .finally(() => {
+                this.flushing = null;
+            });
+        return this.flushing;
+    }
+
+    flushSync() {
+        const lines = this.takeDirty();
+        if (lines.length) {
+            fs.appendFileSync(this.file, lines.join(''));
+            this.logLines += lines.length;
+        }
+    }
+
+    // Rewrite the log with one line per device
+    compact() {
+        const lines = this.ids.map(id => JSON.stringify(this.devices.get(id)) + '\n');
+        writeAtomic(this.file, lines.join(''));
+        this.logLines = lines.length;
+    }
+
+    // One page of devices in id order, starting after the cursor id:
+    // { devices, next_cursor }. next_cursor is null on the last page.
+    // Filters: version (exact current_version), prefix (of the id) and
+    // seenSince (a Date).
+    list({ cursor, limit = 100, version, prefix, seenSince } = {}) {
+        const page = [];
+        let i = cursor ? this.position(cursor) : 0;
+        if (cursor && this.ids[i] === cursor) {
+            i++;
+        }
+        if (prefix && (!cursor || cursor < prefix)) {
+            i = Math.max(i, this.position(prefix));
+        }
+        for (; i < this.ids.length && page.length < limit; i++) {
+            const id = this.ids[i];
+            if (prefix && !id.startsWith(prefix)) {
+                break;  // Sorted, so no later id has the prefix either
+            }
+            const device = this.devices.get(id);
+            if (version && device.current_version !== version) {
+                continue;
+            }
+            if (seenSince && device.last_seen < seenSince) {
+                continue;
+            }
+            page.push(device);
+        }
+        const more = page.length === limit && i < this.ids.length &&
+            !(prefix && !this.ids[i].startsWith(prefix));
+        return { devices: page, next_cursor: more ? page[page.length - 1].device_id : null };
+    }
+
+    stats() {
+        return {
+            devices: this.devices.size,
+            pending_writes: this.dirty.size,
+            log_lines: this.logLines,
+            flushes: this.writes
+        };
+    }
+}
+
+module.exports = { DeviceRegistry };
@@ -4,13 +4,38 @@ Main code that can update itself from a server
 """
 import machine
 import os
+import sys
 import utime
 import ubinascii
 import gc
+try:
+    import random
+except ImportError:
+    import urandom as random
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 try:
     import ujson as json
 except ImportError:
     import json
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+try:
+    import deflate
+except ImportError:
+    deflate = None
+try:
+    import zlib
+except ImportError:
+    zlib = None
 
 # Version and device info
 VERSION = "1.0.0"
@@ -26,76 +51,375 @@ uart_baute = 115200
 # APN configuration
 APN = "cmnbiot"
 
+# Task scheduling (seconds)
+OTA_CHECK_INTERVAL = 60  # Between update checks unless the server hints otherwise
+OTA_MAX_BACKOFF = 3600   # Longest wait after repeated failures
+OTA_JITTER = 0.2         # Each wait is randomized by up to this fraction either way
+APP_INTERVAL = 5         # Duty cycle of the application task
+MODEM_REINIT_FAILURES = 3  # Bring the modem up again after this many failed checks in a row
+
+# Modem timing limits (ms). These are upper bounds; commands return as soon
+# as the modem answers.
+MODEM_BOOT_TIMEOUT = 10000
+BRINGUP_TIMEOUT = 60000  # Power on to PDP context active, all stages together
+BRINGUP_POLL = 500       # Interval between readiness queries
+HTTP_TIMEOUT = 30000
+HTTP_IDLE_TIMEOUT = 30000  # Reconnect rather than reuse a connection idle this long
+
+# UART receive buffering
+RX_BUF_SIZE = 4096  # Ring buffer the parsers read from
+UART_RXBUF = 1024   # Driver-side buffer between IRQs
+
+# Update download configuration
+CHUNK_SIZE = 1024  # Bytes per download request, bounds peak RAM use
+CHUNK_RETRIES = 3
+OTA_STAGING = "ota_staging.bin"
+OTA_JOURNAL = "ota_journal.json"  # Download progress, survives resets
+OTA_PATCH = "ota_patch.bin"       # Inflated delta patch while installing
+OTA_HASHES = "ota_hashes.json"    # SHA-256 of each file in the active slot
+
+# Transfer encodings this device accepts, in order of preference. "bin"
+# sends raw bytes through CHTTPREAD; drop it if the modem firmware mangles
+# binary bodies and base64 will be used instead.
+TRANSFER_ENCODINGS = ["bin", "b64", "hex"]
+
+# Compressed artifacts are only requested when a streaming decompressor is
+# available: deflate.DeflateIO (MicroPython 1.21+) or the older zlib.DecompIO
+COMPRESSION = ["zlib"] if (deflate or hasattr(zlib, "DecompIO")) else []
+
+# Transport for update checks and downloads: "http" over the modem's TCP
+# client, or "coap" over its CoAP/UDP client, which has no connection
+# setup and no HTTP headers per request. CoAP needs the server's CoAP
+# endpoint listening on COAP_PORT.
+TRANSPORT = "http"
+COAP_PORT = 5683
+COAP_BLOCK_SIZE = 1024           # Block2 size, a power of two from 16 to 1024
+COAP_ACK_TIMEOUT = 4000          # ms before a request is sent again, doubled each time
+COAP_MAX_RETRANSMIT = 3
+COAP_CONFIRMABLE_CHECKS = False  # Send conditional checks as non-confirmable messages
+
+# Precompiled .mpy updates skip compiling at boot. They are requested when
+# the firmware reports the bytecode version it loads.
+try:
+    MPY_VERSION = sys.implementation._mpy & 0xff
+except AttributeError:
+    MPY_VERSION = None
+INSTALL_FORMATS = ["mpy", "py"] if MPY_VERSION else ["py"]
+
+# A/B slots: updates are installed as app.py/app.mpy in the inactive slot
+# directory and activated by renaming a small pointer file over OTA_ACTIVE.
+# The first A/B install moves this factory main.py into FACTORY_SLOT and
+# replaces main.py with BOOT_STUB.
+OTA_SLOTS = ("slot_a", "slot_b")
+FACTORY_SLOT = "slot_b"
+OTA_ACTIVE = "ota_active"
+OTA_ROLLBACK = "ota_rollback"  # Set while a slot is being tried after a failed import
+BOOT_STUB = """# OTA boot stub
+import os, sys, machine
+try:
+    with open("ota_active") as f:
+        slot = f.read().strip()
+except OSError:
+    slot = "slot_b"
+sys.path.insert(0, "/" + slot)
+try:
+    import app
+except Exception as e:
+    sys.print_exception(e)
+    try:
+        os.stat("ota_rollback")
+    except OSError:
+        # Fall back to the other slot once
+        open("ota_rollback", "w").close()
+        with open("ota_active.tmp", "w") as f:
+            f.write("slot_a" if slot == "slot_b" else "slot_b")
+        os.rename("ota_active.tmp", "ota_active")
+        machine.reset()
+    raise
+try:
+    os.remove("ota_rollback")
+except OSError:
+    pass
+if hasattr(app, "main"):
+    app.main()
+"""
+
 # Initialize LED
 led_onboard = machine.Pin(led_pin, machine.Pin.OUT)
 
 # Initialize UART
 uart = None
 
-def led_blink_pattern(pattern_name="default"):
-    """Different LED blink patterns"""
+# Pattern the LED task is showing; set it with set_led()
+led_pattern = "default"
+
+def set_led(pattern_name):
+    """Ask the LED task to show a pattern; "error" plays once"""
+    global led_pattern
+    led_pattern = pattern_name
+
+async def led_blink_pattern(pattern_name="default"):
+    """Play one round of an LED blink pattern"""
     if pattern_name == "updating":
         # Fast blink during update
         for _ in range(10):
             led_onboard.value(1)
-            utime.sleep(0.1)
+            await asyncio.sleep_ms(100)
             led_onboard.value(0)
-            utime.sleep(0.1)
+            await asyncio.sleep_ms(100)
     elif pattern_name == "error":
         # SOS pattern
         for _ in range(3):
             led_onboard.value(1)
-            utime.sleep(0.1)
+            await asyncio.sleep_ms(100)
             led_onboard.value(0)
-            utime.sleep(0.1)
-        utime.sleep(0.3)
+            await asyncio.sleep_ms(100)
+        await asyncio.sleep_ms(300)
         for _ in range(3):
             led_onboard.value(1)
-            utime.sleep(0.3)
+            await asyncio.sleep_ms(300)
             led_onboard.value(0)
-            utime.sleep(0.3)
-        utime.sleep(0.3)
+            await asyncio.sleep_ms(300)
+        await asyncio.sleep_ms(300)
         for _ in range(3):
             led_onboard.value(1)
-            utime.sleep(0.1)
+            await asyncio.sleep_ms(100)
             led_onboard.value(0)
-            utime.sleep(0.1)
+            await asyncio.sleep_ms(100)
     else:
         # Default pattern
         led_onboard.value(1)
-        utime.sleep(0.5)
+        await asyncio.sleep_ms(500)
         led_onboard.value(0)
-        utime.sleep(0.5)
+        await asyncio.sleep_ms(500)
+
+async def led_task():
+    """Show led_pattern, reverting to the default after an error pattern"""
+    global led_pattern
+    while True:
+        pattern = led_pattern
+        await led_blink_pattern(pattern)
+        if pattern == "error" and led_pattern == "error":
+            led_pattern = "default"
 
 def powerOn(p):
     machine.Pin(p, machine.Pin.OUT).value(1)
-    utime.sleep(2)
 
-def sendCMD_waitResp(cmd, timeout=3000):
-    print("CMD:", cmd)
+# --- AT command engine ---
+# Responses are parsed line by line as they arrive. A command completes as
+# soon as its final result code (or the URC it is waiting for) shows up, so
+# the timeout is only an upper bound. Unsolicited result codes that nobody
+# is waiting for are dispatched to the handlers in urc_handlers, by the
+# running command or, between commands, by at_task. Waiting yields to the
+# other tasks, and at_lock keeps one command on the modem at a time.
+
+AT_OK = "OK"
+AT_ERRORS = ("ERROR", "+CME ERROR", "+CMS ERROR")
+
+urc_handlers = {}
+at_lock = asyncio.Lock()
+
+def register_urc(prefix, handler):
+    """Call handler(line) whenever a line starting with prefix arrives"""
+    urc_handlers[prefix] = handler
+
+def dispatch_urc(line):
+    for prefix in urc_handlers:
+        if line.startswith(prefix):
+            urc_handlers[prefix](line)
+            return True
+    return False
+
+# --- UART receive ring buffer ---
+# Received bytes are moved out of the UART in bulk readinto() calls, from
+# the UART IRQ where the firmware supports it and from the wait loops
+# otherwise. The buffer is preallocated and parsers read it through
+# memoryview slices, so receiving does not allocate per byte. _rx_head is
+# only written by the producer and _rx_tail only by the consumer, and one
+# slot is always kept free to tell a full buffer from an empty one.
+
+_rx_ring = bytearray(RX_BUF_SIZE)
+_rx_mv = memoryview(_rx_ring)
+_rx_head = 0
+_rx_tail = 0
+_rx_scan = 0
+_rx_busy = False
+
+def rx_pump(_=None):
+    """Move whatever the UART has received into the ring buffer"""
+    global _rx_head, _rx_busy
+    if _rx_busy:
+        return
+    _rx_busy = True
     try:
-        uart.write(cmd.encode() + b'\r\n')
-        response = waitResp(timeout)
-        print("RESP:", response)
-        return response
-    except Exception as e:
-        print("UART CMD failed:", e)
-        return ""
+        while uart.any():
+            head = _rx_head
+            tail = _rx_tail
+            if tail > head:
+                end = tail - 1
+            elif tail:
+                end = RX_BUF_SIZE
+            else:
+                end = RX_BUF_SIZE - 1
+            if end <= head:
+                break  # Full, leave the rest in the UART buffer
+            n = uart.readinto(_rx_mv[head:end])
+            if not n:
+                break
+            _rx_head = (head + n) % RX_BUF_SIZE
+    finally:
+        _rx_busy = False
+
+def rx_available():
+    return (_rx_head - _rx_tail) % RX_BUF_SIZE
+
+def rx_copy(start, end):
+    """Copy ring bytes [start, end) out as bytes"""
+    if start <= end:
+        return bytes(_rx_mv[start:end])
+    return bytes(_rx_mv[start:]) + bytes(_rx_mv[:end])
+
+def rx_readline():
+    """Return the next complete line without its line ending, or None"""
+    global _rx_tail, _rx_scan
+    head = _rx_head
+    i = _rx_scan
+    while i != head:
+        if _rx_ring[i] == 10:
+            line = rx_copy(_rx_tail, i)
+            _rx_tail = _rx_scan = (i + 1) % RX_BUF_SIZE
+            return line
+        i = (i + 1) % RX_BUF_SIZE
+    _rx_scan = i
+    if rx_available() == RX_BUF_SIZE - 1:
+        # A line longer than the buffer; hand it over in pieces
+        line = rx_copy(_rx_tail, head)
+        _rx_tail = _rx_scan = head
+        return line
+    return None
+
+def rx_consume(sink, n):
+    """Pass up to n buffered bytes to sink(memoryview), returns the count"""
+    global _rx_tail, _rx_scan
+    done = 0
+    while done < n:
+        head = _rx_head
+        tail = _rx_tail
+        if head == tail:
+            break
+        end = head if head > tail else RX_BUF_SIZE
+        end = min(end, tail + n - done)
+        sink(_rx_mv[tail:end])
+        done += end - tail
+        _rx_tail = _rx_scan = end % RX_BUF_SIZE
+    return done
+
+def is_ok(response):
+    """True if a response finished with OK rather than an error"""
+    return bool(response) and response.rstrip().endswith(AT_OK)
 
-def waitResp(timeout=3000):
+async def sendCMD_waitResp(cmd, timeout=3000, expect=None, sink=None):
+    """Send an AT command and return its response as soon as it is complete.
+    
+    Without expect the command completes on OK/ERROR. With expect it keeps
+    reading past OK until a line starting with expect (usually a URC such
+    as +CHTTPNMIC) arrives; an error result still ends it early.
+    
+    A "+CHTTPREAD: <id>,<len>" line announces <len> raw body bytes. They
+    are passed to sink(memoryview) as they arrive if a sink is given, and
+    included in the returned text otherwise.
+    """
+    async with at_lock:
+        print("CMD:", cmd)
+        try:
+            uart.write(cmd.encode() + b'\r\n')
+            response = await waitResp(timeout, expect, sink)
+            print("RESP:", response if len(response) < 512 else "({} bytes)".format(len(response)))
+            return response
+        except Exception as e:
+            print("UART CMD failed:", e)
+            return ""
+
+async def waitResp(timeout=3000, expect=None, sink=None):
     start = utime.ticks_ms()
-    resp = b""
+    lines = []
+    payload_left = 0
+    body = None
     while utime.ticks_diff(utime.ticks_ms(), start) < timeout:
-        if uart.any():
-            try:
-                resp += uart.read(1)
-            except:
+        rx_pump()
+        if payload_left:
+            n = rx_consume(sink or body.extend, payload_left)
+            payload_left -= n
+            if not payload_left and body is not None:
+                lines.append(body.decode('utf-8'))
+                body = None
+            if not n:
+                await asyncio.sleep_ms(5)
+            continue
+        
+        raw = rx_readline()
+        if raw is None:
+            await asyncio.sleep_ms(5)
+            continue
+        try:
+            line = raw.strip().decode('utf-8')
+        except:
+            line = "(binary data)"
+        if not line:
+            continue
+        
+        dispatch_urc(line)
+        lines.append(line)
+        if line.startswith("+CHTTPREAD:"):
+            payload_left = int(line.split(",")[-1])
+            if sink is None:
+                body = bytearray()
+        elif any(line.startswith(error) for error in AT_ERRORS):
+            # MicroPython's startswith takes no tuple
+            break
+        elif expect:
+            if line.startswith(expect):
                 break
-        utime.sleep_ms(10)
-    try:
-        return resp.decode('utf-8')
-    except:
-        return "(binary data)"
+        elif line == AT_OK:
+            break
+    return "\r\n".join(lines)
+
+async def wait_until(condition, timeout, interval=250):
+    """Poll the coroutine function condition until it returns true or timeout ms have passed"""
+    start = utime.ticks_ms()
+    while True:
+        if await condition():
+            return True
+        if utime.ticks_diff(utime.ticks_ms(), start) >= timeout:
+            return False
+        await asyncio.sleep_ms(interval)
+
+def poll_urcs():
+    """Dispatch the URCs received while no command is running"""
+    rx_pump()
+    raw = rx_readline()
+    while raw is not None:
+        try:
+            line = raw.strip().decode('utf-8')
+        except:
+            line = ""
+        if line:
+            dispatch_urc(line)
+        raw = rx_readline()
+
+async def at_task():
+    """Dispatch URCs that arrive while no command is running"""
+    while True:
+        if uart and not at_lock.locked():
+            poll_urcs()
+        await asyncio.sleep_ms(50)
+
+def on_http_error(line):
+    global http_stale
+    print("HTTP error reported by modem:", line)
+    http_stale = True
+
+register_urc("+CHTTPERR", on_http_error)
 
 def str_to_hexStr(string):
     try:
@@ -103,104 +427,607 @@ def str_to_hexStr(string):
     except:
         return string
 
-def hexStr_to_str(hex_str):
-    try:
-        return ubinascii.unhexlify(hex_str.encode('utf-8')).decode('utf-8')
-    except:
-        return hex_str
+# --- Modem bring-up ---
+# Every stage polls the modem until it reports ready instead of sleeping
+# for a fixed time, and all stages share one BRINGUP_TIMEOUT deadline. The
+# time at which each stage finished is kept in bringup_timings.
+
+bringup_timings = {}  # Stage -> ms since power on, for the last bring-up
+
+async def at_query(cmd, prefix):
+    """Send a query and return the values of its prefix lines"""
+    response = await sendCMD_waitResp(cmd)
+    return [line[len(prefix):].strip() for line in response.split("\r\n") if line.startswith(prefix)]
+
+async def modem_ready():
+    return is_ok(await sendCMD_waitResp("AT", timeout=500))
 
-def init_sim7020():
+async def network_registered():
+    # +CEREG: <n>,<stat>[,...], stat 1 is home network and 5 roaming
+    for value in await at_query("AT+CEREG?", "+CEREG:"):
+        if value.split(",")[1] in ("1", "5"):
+            return True
+    return False
+
+async def network_attached():
+    return "1" in await at_query("AT+CGATT?", "+CGATT:")
+
+async def pdp_active():
+    # +CGACT: <cid>,<state> for each context
+    for value in await at_query("AT+CGACT?", "+CGACT:"):
+        if value.endswith(",1"):
+            return True
+    return False
+
+async def apn_configured():
+    # *MCGDEFCONT: "<pdp type>","<apn>"[,...]
+    for value in await at_query("AT*MCGDEFCONT?", "*MCGDEFCONT:"):
+        if value.split(",")[1:2] == ['"{}"'.format(APN)]:
+            return True
+    return False
+
+async def init_sim7020():
     global uart
     try:
-        uart = machine.UART(uart_port, uart_baute, bits=8, parity=None, stop=1)
+        uart = machine.UART(uart_port, uart_baute, bits=8, parity=None, stop=1, rxbuf=UART_RXBUF)
+        try:
+            uart.irq(handler=rx_pump, trigger=machine.UART.IRQ_RXIDLE)
+        except (AttributeError, TypeError, ValueError):
+            pass  # No UART IRQ on this firmware, the wait loops poll instead
         powerOn(pwr_en)
-        utime.sleep(2)
+        start = utime.ticks_ms()
+        bringup_timings.clear()
+        
+        def elapsed():
+            return utime.ticks_diff(utime.ticks_ms(), start)
+        
+        async def stage(name, condition, timeout=BRINGUP_TIMEOUT):
+            timeout = min(timeout, BRINGUP_TIMEOUT - elapsed())
+            if not await wait_until(condition, timeout, BRINGUP_POLL):
+                print("Modem bring-up timed out waiting for", name)
+                return False
+            bringup_timings[name] = elapsed()
+            return True
         
-        if uart.any():
-            uart.read()
+        # Wait for the modem to answer instead of sleeping through its boot
+        if not await stage("modem", modem_ready, MODEM_BOOT_TIMEOUT):
+            return False
         
-        # Basic AT commands
-        sendCMD_waitResp("AT")
-        sendCMD_waitResp("ATE1")
+        await sendCMD_waitResp("ATE1")
         
-        # Configure APN
-        sendCMD_waitResp("AT+CFUN=0")
-        utime.sleep(2)
-        sendCMD_waitResp("AT*MCGDEFCONT=\"IP\",\"{}\"".format(APN))
-        sendCMD_waitResp("AT+CFUN=1")
-        utime.sleep(10)
-        sendCMD_waitResp("AT+CGATT?")
+        # The APN is stored in the modem; only cycle the radio to change it
+        if not await apn_configured():
+            await sendCMD_waitResp("AT+CFUN=0", timeout=10000)
+            await sendCMD_waitResp("AT*MCGDEFCONT=\"IP\",\"{}\"".format(APN))
+            await sendCMD_waitResp("AT+CFUN=1", timeout=10000)
+        bringup_timings["apn"] = elapsed()
         
-        print("SIM7020E initialized successfully")
+        for name, condition in (("registered", network_registered),
+                                ("attached", network_attached),
+                                ("pdp", pdp_active)):
+            if not await stage(name, condition):
+                return False
+        
+        print("SIM7020E initialized successfully:", bringup_timings)
         return True
     except Exception as e:
         print("SIM7020E initialization failed:", e)
         return False
 
-def http_get(url, endpoint):
-    """Make HTTP GET request"""
-    try:
-        print("Making HTTP GET request to:", url + endpoint)
-        sendCMD_waitResp("AT+CHTTPCREATE=\"{}\"".format(url))
-        utime.sleep(1)
-        sendCMD_waitResp("AT+CHTTPCON=0")
-        utime.sleep(2)
-        
-        response = sendCMD_waitResp("AT+CHTTPSEND=0,0,\"{}\"".format(endpoint))
-        utime.sleep(3)
+# --- HTTP session ---
+# One modem HTTP instance is kept open across consecutive requests so an
+# update check and the download that follows share a single connection
+# setup. The instance is dropped when the modem reports an error, when a
+# request fails or after HTTP_IDLE_TIMEOUT without traffic, and is
+# re-created lazily by the next request.
+
+http_session = None      # Modem HTTP instance id
+http_session_url = None  # Server the instance is connected to
+http_last_used = 0
+http_stale = False
+http_status = 0          # Status code of the last response
+
+async def http_close():
+    """Disconnect and destroy the modem HTTP instance, if any"""
+    global http_session, http_session_url
+    if http_session is None:
+        return
+    await sendCMD_waitResp("AT+CHTTPDISCON={}".format(http_session))
+    await sendCMD_waitResp("AT+CHTTPDESTROY={}".format(http_session))
+    http_session = None
+    http_session_url = None
+
+async def http_open(url):
+    """Make sure a connected HTTP instance for url exists, returns its id"""
+    global http_session, http_session_url, http_stale
+    if http_session is not None:
+        idle = utime.ticks_diff(utime.ticks_ms(), http_last_used)
+        if http_session_url == url and not http_stale and idle < HTTP_IDLE_TIMEOUT:
+            return http_session
+        await http_close()
+    
+    http_stale = False
+    response = await sendCMD_waitResp("AT+CHTTPCREATE=\"{}\"".format(url))
+    if not is_ok(response):
+        return None
+    session = 0
+    for line in response.split("\r\n"):
+        if line.startswith("+CHTTPCREATE:"):
+            session = int(line.split(":")[1])
+    
+    http_session = session
+    http_session_url = url
+    if not is_ok(await sendCMD_waitResp("AT+CHTTPCON={}".format(session), timeout=HTTP_TIMEOUT)):
+        await http_close()
+        return None
+    return session
+
+async def http_exchange(session, send_cmd, read_timeout, sink=None):
+    global http_status
+    # The modem answers OK straight away; +CHTTPNMIC: <id>,<status>,<len>
+    # signals the response
+    response = await sendCMD_waitResp(send_cmd, timeout=HTTP_TIMEOUT, expect="+CHTTPNMIC")
+    nmic = response.find("+CHTTPNMIC")
+    if nmic < 0 or http_stale:
+        return None
+    fields = response[nmic:].split("\r\n")[0].split(",")
+    http_status = int(fields[1])
+    
+    # Nothing to read, e.g. a 304
+    if int(fields[2]) == 0:
+        return ""
+    
+    # Error bodies are always read as text so they can be logged
+    if not 200 <= http_status < 300:
+        sink = None
+    
+    # Get response data
+    return await sendCMD_waitResp("AT+CHTTPREAD={}".format(session), timeout=read_timeout, sink=sink)
+
+async def http_request(url, method, path, content_type=None, body_hex=None, read_timeout=3000, sink=None,
+                       headers=None):
+    """Run one HTTP exchange on the shared session, returns the CHTTPREAD response.
+    
+    A request that fails on a reused connection is retried once on a fresh
+    one, since the server may have closed it in the meantime. A successful
+    response body is passed to sink instead of the returned text if given.
+    headers are extra "Name: value\r\n" lines for a GET.
+    """
+    global http_last_used, http_stale
+    for _ in range(2):
+        reused = http_session is not None
+        session = await http_open(url)
+        if session is None:
+            return None
         
-        # Get response data
-        data_resp = sendCMD_waitResp("AT+CHTTPREAD=0")
+        if method == "GET":
+            send_cmd = "AT+CHTTPSEND={},0,\"{}\"".format(session, path)
+            if headers:
+                send_cmd += "," + str_to_hexStr(headers)
+        else:
+            send_cmd = "AT+CHTTPSEND={},1,\"{}\",,\"{}\",{}".format(
+                session, path, content_type, body_hex)
         
-        sendCMD_waitResp("AT+CHTTPDISCON=0")
-        sendCMD_waitResp("AT+CHTTPDESTROY=0")
+        response = await http_exchange(session, send_cmd, read_timeout, sink)
+        if response is not None:
+            http_last_used = utime.ticks_ms()
+            return response
         
-        return data_resp
+        http_stale = True
+        if not reused:
+            break
+        print("HTTP session went stale, reconnecting")
+    return None
+
+async def http_get(url, endpoint):
+    """Make HTTP GET request"""
+    try:
+        print("Making HTTP GET request to:", url + endpoint)
+        return await http_request(url, "GET", endpoint)
     except Exception as e:
         print("HTTP GET failed:", e)
         return None
 
-def check_for_update():
-    """Check if there's a new version available"""
+async def ota_request(payload, read_timeout=3000, sink=None):
+    """POST a JSON payload to the OTA endpoint and return the raw modem response"""
+    json_payload = json.dumps(payload)
+    hex_payload = str_to_hexStr(json_payload)
+    
+    return await http_request(OTA_SERVER, "POST", "/ota", "application/json", hex_payload, read_timeout, sink)
+
+# --- CoAP session ---
+# The modem's CoAP client sends a message given as hex and reports every
+# datagram it receives as +CCOAPNMI: <id>,<len>,<hex>; the messages are
+# built and parsed here. A request carries a random token and is matched
+# to its response by it. A request that is not answered within
+# COAP_ACK_TIMEOUT is sent again with twice the timeout, up to
+# COAP_MAX_RETRANSMIT times. There is no connection to set up, so the
+# instance only names the server's address.
+
+COAP_CON, COAP_NON, COAP_ACK = 0, 1, 2
+COAP_GET, COAP_POST = 1, 2
+COAP_VALID = 0x43         # 2.03, what 304 is to HTTP
+COAP_URI_PATH = 11
+COAP_CONTENT_FORMAT = 12
+COAP_URI_QUERY = 15
+COAP_BLOCK2 = 23
+COAP_JSON = 50            # application/json content format
+
+coap_session = None       # Modem CoAP instance id
+coap_address = None       # Server address, resolved once
+coap_mid = random.getrandbits(16)
+coap_inbox = []           # Received responses not yet claimed by a request
+
+def coap_uint(n):
+    """Option value of an unsigned integer, in its shortest form"""
+    value = struct.pack(">I", n)
+    i = 0
+    while i < 4 and value[i] == 0:
+        i += 1
+    return value[i:]
+
+def coap_szx(size):
+    """Block size exponent of size (size = 16 << szx)"""
+    szx = 0
+    while (16 << szx) < size:
+        szx += 1
+    return szx
+
+def coap_option_field(n):
+    """Nibble and extension bytes of an option delta or length"""
+    if n < 13:
+        return n, b""
+    if n < 269:
+        return 13, bytes([n - 13])
+    return 14, struct.pack(">H", n - 269)
+
+def coap_encode(mtype, code, mid, token, options, payload=None):
+    """Build a message; options is a list of (number, bytes) in number order"""
+    msg = bytearray([0x40 | (mtype << 4) | len(token), code, mid >> 8, mid & 0xff])
+    msg += token
+    last = 0
+    for number, value in options:
+        delta, delta_ext = coap_option_field(number - last)
+        length, length_ext = coap_option_field(len(value))
+        msg.append((delta << 4) | length)
+        msg += delta_ext
+        msg += length_ext
+        msg += value
+        last = number
+    if payload:
+        msg.append(0xff)
+        msg += payload
+    return msg
+
+def coap_decode(data):
+    """Parse a message into (type, code, mid, token, options, payload), where
+    options maps an option number to the list of its values"""
+    tkl = data[0] & 0x0f
+    pos = 4 + tkl
+    options = {}
+    number = 0
+    payload = b""
+    while pos < len(data):
+        byte = data[pos]
+        pos += 1
+        if byte == 0xff:
+            payload = data[pos:]
+            break
+        fields = []
+        for nibble in (byte >> 4, byte & 0x0f):
+            if nibble == 13:
+                nibble = data[pos] + 13
+                pos += 1
+            elif nibble == 14:
+                nibble = (data[pos] << 8 | data[pos + 1]) + 269
+                pos += 2
+            fields.append(nibble)
+        number += fields[0]
+        options.setdefault(number, []).append(data[pos:pos + fields[1]])
+        pos += fields[1]
+    return (data[0] >> 4) & 3, data[1], data[2] << 8 | data[3], data[4:4 + tkl], options, payload
+
+def coap_status(code):
+    """HTTP status equivalent of a CoAP response code (2.03 -> 304, 4.29 -> 429)"""
+    if code == COAP_VALID:
+        return 304
+    if code >> 5 == 2:
+        return 200
+    return (code >> 5) * 100 + (code & 0x1f)
+
+def on_coap_message(line):
+    # +CCOAPNMI: <id>,<len>,<hex message>
     try:
-        print("Checking for updates...")
+        msg = coap_decode(ubinascii.unhexlify(line.split(",")[2].strip('"')))
+    except Exception as e:
+        print("Bad CoAP message:", e)
+        return
+    if msg[1]:  # Empty ACKs and resets carry nothing to wait for
+        coap_inbox.append(msg)
+        if len(coap_inbox) > 4:
+            coap_inbox.pop(0)
+
+register_urc("+CCOAPNMI", on_coap_message)
+
+async def coap_close():
+    """Delete the modem CoAP instance, if any"""
+    global coap_session
+    if coap_session is None:
+        return
+    await sendCMD_waitResp("AT+CCOAPDEL={}".format(coap_session))
+    coap_session = None
+
+async def coap_open():
+    """Make sure a CoAP instance for OTA_SERVER's host exists, returns its id"""
+    global coap_session, coap_address
+    if coap_session is not None:
+        return coap_session
+    
+    host = OTA_SERVER.split("://")[-1].split("/")[0].split(":")[0]
+    if host.replace(".", "").isdigit():
+        coap_address = host
+    elif coap_address is None:
+        # CCOAPNEW takes an address; +CDNSGIP: 1,"<host>","<address>"
+        response = await sendCMD_waitResp("AT+CDNSGIP=\"{}\"".format(host), timeout=HTTP_TIMEOUT, expect="+CDNSGIP")
+        for line in response.split("\r\n"):
+            if line.startswith("+CDNSGIP: 1,"):
+                coap_address = line.split(",")[2].strip('"')
+        if coap_address is None:
+            print("DNS lookup failed")
+            return None
+    
+    response = await sendCMD_waitResp("AT+CCOAPNEW={},{},1".format(coap_address, COAP_PORT))
+    if not is_ok(response):
+        return None
+    for line in response.split("\r\n"):
+        if line.startswith("+CCOAPNEW:"):
+            coap_session = int(line.split(":")[1])
+    return coap_session
+
+async def coap_send(session, msg):
+    return await sendCMD_waitResp("AT+CCOAPSEND={},{},{}".format(
+        session, len(msg), ubinascii.hexlify(msg).decode()))
+
+async def coap_wait(token, timeout):
+    """Wait up to timeout ms for the response carrying token"""
+    start = utime.ticks_ms()
+    while utime.ticks_diff(utime.ticks_ms(), start) < timeout:
+        if not at_lock.locked():
+            poll_urcs()
+        for msg in coap_inbox:
+            if msg[3] == token:
+                coap_inbox.remove(msg)
+                return msg
+        await asyncio.sleep_ms(5)
+    return None
+
+async def coap_exchange(code, path, payload=None, block=None, confirmable=True):
+    """Send one request and return its response message, None if unanswered.
+    
+    path may carry a query string. block is the Block2 value to ask for.
+    """
+    global coap_mid, coap_address, http_status
+    session = await coap_open()
+    if session is None:
+        return None
+    
+    path = path.split("?", 1)
+    options = [(COAP_URI_PATH, segment.encode()) for segment in path[0].split("/") if segment]
+    if payload is not None:
+        options.append((COAP_CONTENT_FORMAT, coap_uint(COAP_JSON)))
+    if len(path) > 1:
+        options += [(COAP_URI_QUERY, item.encode()) for item in path[1].split("&") if item]
+    if block is not None:
+        options.append((COAP_BLOCK2, coap_uint(block)))
+    
+    coap_mid = (coap_mid + 1) & 0xffff
+    token = struct.pack(">I", random.getrandbits(32))
+    msg = coap_encode(COAP_CON if confirmable else COAP_NON, code, coap_mid, token, options, payload)
+    
+    timeout = COAP_ACK_TIMEOUT
+    for _ in range(COAP_MAX_RETRANSMIT + 1):
+        if not is_ok(await coap_send(session, msg)):
+            break
+        response = await coap_wait(token, timeout)
+        if response is not None:
+            if response[0] == COAP_CON:
+                # A separate response has to be acknowledged
+                await coap_send(session, coap_encode(COAP_ACK, 0, response[2], b"", []))
+            http_status = coap_status(response[1])
+            return response
+        timeout *= 2
+    
+    # Start over with a fresh instance and lookup next time
+    coap_address = None
+    await coap_close()
+    return None
+
+async def coap_request(code, path, payload=None, confirmable=True):
+    """Run a request, following Block2 until the whole body arrived.
+    
+    Returns the body as text, None if the request failed.
+    """
+    body = bytearray()
+    num = 0
+    szx = coap_szx(COAP_BLOCK_SIZE)
+    while True:
+        response = await coap_exchange(code, path, payload, num << 4 | szx, confirmable)
+        if response is None:
+            return None
+        body += response[5]
+        block = response[4].get(COAP_BLOCK2)
+        if not block:
+            break
+        value = int.from_bytes(block[0], "big")
+        if not value & 8:
+            break
+        num = (value >> 4) + 1
+        szx = value & 7
+    return body.decode('utf-8')
+
+# --- Transports ---
+# Checks and downloads go through the transport named by TRANSPORT. Either
+# one returns the response text (or passes the chunk to the decoder) and
+# leaves the HTTP equivalent of the response code in http_status, so the
+# callers do not depend on how a request travelled.
+
+class HttpTransport:
+    """HTTP over the modem's TCP client, one connection for check and download"""
+    
+    async def get(self, path):
+        return await http_get(OTA_SERVER, path)
+    
+    async def post(self, payload):
+        return await ota_request(payload)
+    
+    def chunk_size(self, size):
+        return size
+    
+    async def chunk(self, decoder, plan, offset, length):
+        url = plan.get("url")
+        if url and "bin" in TRANSFER_ENCODINGS:
+            # Ranged GET of the raw artifact from /firmware
+            decoder.reset("bin")
+            return await http_request(OTA_SERVER, "GET", "{}{}d={}".format(url, "&" if "?" in url else "?", DEVICE_ID),
+                                      sink=decoder.write,
+                                      headers="Range: bytes={}-{}\r\n".format(offset, offset + length - 1))
         
-        # Create request payload
-        check_payload = {
+        # Servers without /firmware, or a modem that mangles binary bodies:
+        # the chunk comes in a download_chunk response in a text encoding
+        encoding = plan.get("encoding", "hex")
+        chunk_payload = {
             "device_id": DEVICE_ID,
             "current_version": VERSION,
-            "action": "check_update"
+            "action": "download_chunk",
+            "version": plan.get("new_version"),
+            "offset": offset,
+            "length": length,
+            "encoding": encoding,
+            "compression": plan.get("compression", "none"),
+            "format": plan.get("format", "py"),
+            "path": plan.get("path")
         }
+        if plan.get("delta_from"):
+            chunk_payload["delta_from"] = plan["delta_from"]
         
-        json_payload = json.dumps(check_payload)
-        hex_payload = str_to_hexStr(json_payload)
+        decoder.reset(encoding)
+        return await ota_request(chunk_payload, sink=decoder.write)
+    
+    async def close(self):
+        await http_close()
+
+class CoapTransport:
+    """CoAP over the modem's UDP client.
+    
+    Conditional checks are non-confirmable unless COAP_CONFIRMABLE_CHECKS,
+    everything else is confirmable. Files are fetched from
+    /f/<version>/<format>/<path> one Block2 block per chunk, as raw bytes.
+    """
+    
+    async def get(self, path):
+        return await coap_request(COAP_GET, path, confirmable=COAP_CONFIRMABLE_CHECKS)
+    
+    async def post(self, payload):
+        return await coap_request(COAP_POST, "/ota", json.dumps(payload).encode())
+    
+    def chunk_size(self, size):
+        # Chunks are blocks, so a power of two
+        size = min(size, COAP_BLOCK_SIZE, CHUNK_SIZE)
+        block = 16
+        while block * 2 <= size:
+            block *= 2
+        return block
+    
+    async def chunk(self, decoder, plan, offset, length):
+        block = plan["chunk_size"]
+        path = "/f/{}/{}/{}?d={}&c={}".format(plan.get("new_version"), plan.get("format", "py"),
+                                             plan.get("path"), DEVICE_ID, plan.get("compression", "none"))
+        if plan.get("delta_from"):
+            path += "&f=" + plan["delta_from"]
         
-        # Make request
-        sendCMD_waitResp("AT+CHTTPCREATE=\"{}\"".format(OTA_SERVER))
-        utime.sleep(1)
-        sendCMD_waitResp("AT+CHTTPCON=0")
-        utime.sleep(2)
+        decoder.reset("bin")
+        response = await coap_exchange(COAP_GET, path, block=(offset // block) << 4 | coap_szx(block))
+        if response is None:
+            return None
+        if http_status != 200:
+            return bytes(response[5]).decode('utf-8')
+        decoder.write(response[5])
+        return ""
+    
+    async def close(self):
+        await coap_close()
+
+TRANSPORTS = {"http": HttpTransport(), "coap": CoapTransport()}
+
+def transport():
+    return TRANSPORTS[TRANSPORT]
+
+def extract_json(response):
+    """Extract the JSON object embedded in a raw modem response"""
+    if not response:
+        return None
+    json_start = response.find('{')
+    json_end = response.rfind('}') + 1
+    if json_start == -1 or json_end == 0:
+        return None
+    return json.loads(response[json_start:json_end])
+
+# Seconds until the next update check as hinted by the server, None for
+# the default OTA_CHECK_INTERVAL
+next_check_hint = None
+
+def parse_record(response, kind):
+    """Value of a "<kind> <value>" conditional check record, or None"""
+    for line in response.split("\r\n"):
+        if line.startswith(kind + " "):
+            return line[2:].strip()
+    return None
+
+async def check_for_update():
+    """Check if there's a new version available.
+    
+    A conditional GET with the running version as token comes first. The
+    server answers 304 without a body when there is nothing new, which
+    also skips the CHTTPREAD, or "N <seconds>" to ask for a different
+    check interval. Only when it names a newer version ("U <version>") is
+    the full JSON check sent for the update details.
+    """
+    global next_check_hint
+    try:
+        print("Checking for updates...")
+        next_check_hint = None
         
-        post_cmd = "AT+CHTTPSEND=0,1,\"/ota\",,\"application/json\",{}".format(hex_payload)
-        sendCMD_waitResp(post_cmd)
-        utime.sleep(3)
+        response = await transport().get("/c/{}?d={}".format(VERSION, DEVICE_ID))
+        if response is not None:
+            if http_status == 304:
+                return {"update_available": False}
+            if http_status == 200:
+                hint = parse_record(response, "N")
+                if hint:
+                    next_check_hint = int(hint)
+                    return {"update_available": False}
+                print("Server offers version", parse_record(response, "U"))
         
-        # Get response
-        response = sendCMD_waitResp("AT+CHTTPREAD=0")
+        # Create request payload
+        check_payload = {
+            "device_id": DEVICE_ID,
+            "current_version": VERSION,
+            "action": "check_update",
+            "encodings": TRANSFER_ENCODINGS,
+            "compression": COMPRESSION,
+            "delta": True,
+            "formats": INSTALL_FORMATS,
+            "mpy_version": MPY_VERSION
+        }
         
-        sendCMD_waitResp("AT+CHTTPDISCON=0")
-        sendCMD_waitResp("AT+CHTTPDESTROY=0")
+        response = await transport().post(check_payload)
         
         # Parse response
         if response and "update_available" in response:
             try:
-                # Extract JSON from response
-                json_start = response.find('{')
-                json_end = response.rfind('}') + 1
-                if json_start != -1 and json_end != -1:
-                    json_str = response[json_start:json_end]
-                    update_info = json.loads(json_str)
-                    return update_info
+                update_info = extract_json(response)
+                next_check_hint = update_info.get("next_check")
+                return update_info
             except:
                 pass
         
@@ -209,106 +1036,569 @@ def check_for_update():
         print("Update check failed:", e)
         return None
 
-def download_update():
-    """Download new code from server"""
+class ChunkDecoder:
+    """Decodes a chunk body into a preallocated buffer as it arrives.
+    
+    Used as the CHTTPREAD sink, so text encodings are decoded piece by piece
+    and the encoded form of a chunk is never held in RAM as a whole.
+    """
+    
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.reset("bin")
+    
+    def reset(self, encoding):
+        self.encoding = encoding
+        self.filled = 0
+        self.carry = b""
+        self.overflow = False
+    
+    def write(self, data):
+        if self.encoding != "bin":
+            # Decode whole base64 quanta / hex pairs, carry the remainder
+            unit = 4 if self.encoding == "b64" else 2
+            data = self.carry + bytes(data)
+            usable = len(data) - len(data) % unit
+            self.carry = data[usable:]
+            if not usable:
+                return
+            if self.encoding == "b64":
+                data = ubinascii.a2b_base64(data[:usable])
+            else:
+                data = ubinascii.unhexlify(data[:usable])
+        n = len(data)
+        if self.filled + n > len(self.buf):
+            self.overflow = True
+            return
+        self.mv[self.filled:self.filled + n] = data
+        self.filled += n
+    
+    def chunk(self):
+        return self.mv[:self.filled]
+
+async def download_chunk(decoder, update_info, offset, length):
+    """Download one chunk of a release file into decoder, True if it is complete.
+    
+    A chunk held back by the server's rollout limits is requested again
+    after the wait the server asks for. That is not a failed attempt, so it
+    uses up neither a chunk retry nor an OTA failure.
+    """
+    while True:
+        response = await transport().chunk(decoder, update_info, offset, length)
+        if response is None or http_status != 429:
+            break
+        try:
+            retry_after = extract_json(response).get("retry_after", 5)
+        except:
+            retry_after = 5
+        print("Download throttled, retrying in", retry_after, "s")
+        await asyncio.sleep(retry_after)
+    
+    if response is None or http_status not in (200, 206):
+        print("Chunk request failed:", http_status)
+        return False
+    
+    return not decoder.overflow and not decoder.carry and decoder.filled == length
+
+def file_size(path):
+    """Return the size of a file on flash, 0 if it does not exist"""
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return 0
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def load_journal():
+    """Load the download progress journal, None if there is none"""
+    try:
+        with open(OTA_JOURNAL, "r") as f:
+            return json.loads(f.read())
+    except:
+        return None
+
+def save_journal(journal):
+    with open(OTA_JOURNAL, "w") as f:
+        f.write(json.dumps(journal))
+
+def clear_journal():
+    remove_file(OTA_JOURNAL)
+    remove_file(OTA_STAGING)
+
+def hash_file(h, path):
+    """Feed a file into hash object h in CHUNK_SIZE blocks"""
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+    return h
+
+def hex_digest(h):
+    return ubinascii.hexlify(h.digest()).decode()
+
+def file_sha256(path):
+    """Hash a file in CHUNK_SIZE blocks, returns the hex digest"""
+    return hex_digest(hash_file(hashlib.sha256(), path))
+
+def active_slot():
+    """Slot the boot stub starts, None before the first A/B install"""
     try:
-        print("Downloading update...")
-        led_blink_pattern("updating")
-        
-        # Request download
-        download_payload = {
-            "device_id": DEVICE_ID,
-            "action": "download_update"
-        }
-        
-        json_payload = json.dumps(download_payload)
-        hex_payload = str_to_hexStr(json_payload)
-        
-        sendCMD_waitResp("AT+CHTTPCREATE=\"{}\"".format(OTA_SERVER))
-        utime.sleep(1)
-        sendCMD_waitResp("AT+CHTTPCON=0")
-        utime.sleep(2)
+        with open(OTA_ACTIVE, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def set_active_slot(slot):
+    """Switch slots atomically: write the pointer aside, then rename it over"""
+    with open(OTA_ACTIVE + ".tmp", "w") as f:
+        f.write(slot)
+    os.rename(OTA_ACTIVE + ".tmp", OTA_ACTIVE)
+
+def other_slot(slot):
+    return OTA_SLOTS[1] if slot == OTA_SLOTS[0] else OTA_SLOTS[0]
+
+def local_path(path):
+    """Where a release file of the running image lives, None if nowhere"""
+    slot = active_slot()
+    if slot:
+        return slot + "/" + path
+    if path == "app.py":
+        return "main.py"  # Factory image, before the first A/B install
+    return None
+
+def list_files(root, prefix=""):
+    """Relative paths of all files below root"""
+    paths = []
+    for name in os.listdir(root + "/" + prefix):
+        path = prefix + name
+        if is_dir(root + "/" + path):
+            paths.extend(list_files(root, path + "/"))
+        else:
+            paths.append(path)
+    return paths
+
+def local_hashes():
+    """SHA-256 of every file of the running image, keyed by release path.
+    
+    The hashes are computed once per slot and cached in OTA_HASHES; an
+    install writes the cache for its slot from the release manifest.
+    """
+    slot = active_slot()
+    try:
+        with open(OTA_HASHES, "r") as f:
+            cache = json.loads(f.read())
+        if cache.get("slot") == slot:
+            return cache["files"]
+    except:
+        pass
+    
+    files = {}
+    if slot:
+        for path in list_files(slot):
+            files[path] = file_sha256(slot + "/" + path)
+    elif file_size("main.py"):
+        files["app.py"] = file_sha256("main.py")
+    save_hashes(slot, files)
+    return files
+
+def save_hashes(slot, files):
+    with open(OTA_HASHES, "w") as f:
+        f.write(json.dumps({"slot": slot, "files": files}))
+
+def file_plan(update_info, entry, local):
+    """Describe how to fetch one changed release file.
+    
+    The delta patch is used if it is cheaper and the local copy of the file
+    is exactly the one the server built the patch against.
+    """
+    transfer = entry["transfer"]
+    plan = {
+        "new_version": update_info.get("new_version"),
+        "path": entry["path"],
+        "format": update_info.get("format", "py"),
+        "encoding": update_info.get("encoding", "hex"),
+        "chunk_size": transport().chunk_size(update_info.get("chunk_size", CHUNK_SIZE)),
+        "wbits": update_info.get("wbits", 15),
+        "code_size": entry["size"],
+        "code_sha256": entry["sha256"],
+        "size": transfer["size"],
+        "sha256": transfer["sha256"],
+        "compression": transfer["compression"],
+        "url": transfer.get("url")
+    }
+    
+    patch = entry.get("patch")
+    if patch and patch["size"] < plan["size"]:
+        if local.get(entry["path"]) == patch["base_sha256"]:
+            print("Using", patch["size"], "byte patch for", entry["path"], "instead of", plan["size"], "bytes")
+            plan["size"] = patch["size"]
+            plan["sha256"] = patch["sha256"]
+            plan["compression"] = patch["compression"]
+            plan["delta_from"] = patch["from"]
+            plan["url"] = patch.get("url")
+        else:
+            print("Local", entry["path"], "differs from patch base, using full file")
+    return plan
+
+def resume_offset(journal, plan):
+    """Work out where an interrupted download of this file can resume"""
+    if (journal.get("path") != plan["path"] or journal.get("size") != plan["size"]
+            or journal.get("sha256") != plan["sha256"]):
+        return 0
+    # The staging file is flushed after every chunk, so its length is the
+    # last good offset even if the journal write itself was interrupted
+    on_flash = file_size(OTA_STAGING)
+    if on_flash > plan["size"]:
+        return 0
+    return on_flash
+
+async def download_file(plan, journal):
+    """Download one release file into the staging file, chunk by chunk.
+    
+    Progress is journaled on flash so that a dropped link or a reset
+    resumes from the last good offset instead of starting over. The SHA-256
+    is computed over the chunks as they arrive; on resume the bytes already
+    on flash are hashed first.
+    """
+    total_size = plan["size"]
+    sha256 = plan["sha256"]
+    chunk_size = min(plan["chunk_size"], CHUNK_SIZE)
+    
+    hasher = hashlib.sha256()
+    offset = resume_offset(journal, plan)
+    if offset:
+        print("Resuming download of", plan["path"], "at offset", offset)
+        hash_file(hasher, OTA_STAGING)
+    else:
+        remove_file(OTA_STAGING)
+    
+    journal["path"] = plan["path"]
+    journal["size"] = total_size
+    journal["sha256"] = sha256
+    journal["received"] = offset
+    save_journal(journal)
+    
+    decoder = ChunkDecoder(chunk_size)
+    with open(OTA_STAGING, "ab") as f:
+        while offset < total_size:
+            length = min(chunk_size, total_size - offset)
+            complete = False
+            for _ in range(CHUNK_RETRIES):
+                complete = await download_chunk(decoder, plan, offset, length)
+                if complete:
+                    break
+                print("Chunk at", offset, "failed, retrying")
+            
+            if not complete:
+                print("Download interrupted at offset", offset)
+                return None
+            
+            hasher.update(decoder.chunk())
+            f.write(decoder.chunk())
+            f.flush()
+            offset += length
+            journal["received"] = offset
+            save_journal(journal)
+            gc.collect()
+            print("Downloaded", offset, "/", total_size, "bytes")
+    
+    if sha256 and hex_digest(hasher) != sha256:
+        print("Checksum mismatch, discarding download")
+        remove_file(OTA_STAGING)
+        return None
+    
+    return OTA_STAGING
+
+def forget_hash(local, path):
+    """The running image's copy of path no longer matches its cached hash"""
+    local.pop(path, None)
+    remove_file(OTA_HASHES)  # Recomputed from flash on the next update
+
+async def fetch_file(update_info, entry, local, journal, dst):
+    """Download and install one changed release file, True on success.
+    
+    A patch is applied to the running image's copy of the file, trusted by
+    its cached hash. If that copy was rewritten since, the patched file
+    fails its checksum; the download is then discarded and the file
+    fetched whole.
+    """
+    path = entry["path"]
+    while True:
+        plan = file_plan(update_info, entry, local)
+        staging_file = await download_file(plan, journal)
+        if not staging_file:
+            return False
+        try:
+            install_file(staging_file, dst, plan, local_path(path))
+            return True
+        except Exception as e:
+            print("Installing", path, "failed:", e)
+        finally:
+            # Never resume into a download that has been installed or failed
+            remove_file(OTA_STAGING)
+            remove_file(OTA_PATCH)
+            journal["path"] = None
+            save_journal(journal)
         
-        post_cmd = "AT+CHTTPSEND=0,1,\"/ota\",,\"application/json\",{}".format(hex_payload)
-        sendCMD_waitResp(post_cmd)
-        utime.sleep(5)  # Longer timeout for download
+        if "delta_from" not in plan:
+            return False
+        forget_hash(local, path)
+        print("Retrying", path, "as a full download")
+
+def make_dirs(path):
+    """Create the parent directories of a file path"""
+    parts = path.split("/")[:-1]
+    for i in range(1, len(parts) + 1):
+        if not is_dir("/".join(parts[:i])):
+            os.mkdir("/".join(parts[:i]))
+
+async def download_update(update_info):
+    """Install a release into the inactive slot, returns the slot or None.
+    
+    Files whose hash matches the running image are copied on flash; only
+    the others are downloaded. The journal records which files are done,
+    so an interrupted update resumes with the file it was working on.
+    """
+    try:
+        print("Downloading update...")
+        set_led("updating")
         
-        # Get response with code
-        response = sendCMD_waitResp("AT+CHTTPREAD=0", timeout=10000)
+        version = update_info.get("new_version")
+        target = other_slot(active_slot() or FACTORY_SLOT)
+        local = local_hashes()
         
-        sendCMD_waitResp("AT+CHTTPDISCON=0")
-        sendCMD_waitResp("AT+CHTTPDESTROY=0")
+        journal = load_journal()
+        if journal and journal.get("version") == version and journal.get("slot") == target:
+            print("Resuming update to", version)
+        else:
+            journal = {"version": version, "slot": target, "done": []}
+            remove_file(OTA_STAGING)
+            clear_dir(target)
+            save_journal(journal)
         
-        if response and "new_code" in response:
-            try:
-                # Extract JSON from response
-                json_start = response.find('{')
-                json_end = response.rfind('}') + 1
-                if json_start != -1 and json_end != -1:
-                    json_str = response[json_start:json_end]
-                    update_data = json.loads(json_str)
-                    
-                    if "new_code" in update_data:
-                        # Decode the new code
-                        new_code = hexStr_to_str(update_data["new_code"])
-                        return new_code
-            except Exception as e:
-                print("Failed to parse update data:", e)
+        for entry in update_info["files"]:
+            path = entry["path"]
+            if path in journal["done"]:
+                continue
+            dst = target + "/" + path
+            make_dirs(dst)
+            
+            installed = False
+            if local.get(path) == entry["sha256"]:
+                copy_file(local_path(path), dst)
+                installed = file_sha256(dst) == entry["sha256"]
+                if installed:
+                    print("Unchanged:", path)
+                else:
+                    print("Local", path, "changed since it was hashed, downloading it")
+                    forget_hash(local, path)
+            if not installed and not await fetch_file(update_info, entry, local, journal, dst):
+                return None
+            
+            journal["done"].append(path)
+            save_journal(journal)
+            gc.collect()
         
-        return None
+        return target
     except Exception as e:
         print("Download failed:", e)
         return None
 
-def apply_update(new_code):
-    """Apply the downloaded update"""
+def copy_file(src, dst):
+    """Copy a file in CHUNK_SIZE blocks so RAM use stays bounded"""
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    with open(src, "rb") as fin:
+        with open(dst, "wb") as fout:
+            while True:
+                n = fin.readinto(buf)
+                if not n:
+                    break
+                fout.write(mv[:n])
+
+def inflate_file(src, dst, wbits):
+    """Decompress a zlib stream from src into dst one block at a time"""
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    with open(src, "rb") as fin:
+        with open(dst, "wb") as fout:
+            if deflate:
+                stream = deflate.DeflateIO(fin, deflate.ZLIB, wbits)
+            else:
+                stream = zlib.DecompIO(fin, wbits)
+            while True:
+                n = stream.readinto(buf)
+                if not n:
+                    break
+                fout.write(mv[:n])
+
+def apply_patch(base, patch_file, dst):
+    """Rebuild dst from base plus a delta patch, streaming both from flash.
+    
+    The patch is "OTD1" <new size> followed by 'C' <offset> <length> (copy
+    from base) and 'I' <length> <bytes> (insert) operations, see delta.js.
+    """
+    buf = bytearray(CHUNK_SIZE)
+    mv = memoryview(buf)
+    with open(patch_file, "rb") as patch:
+        if patch.read(4) != b"OTD1":
+            raise ValueError("not a delta patch")
+        patch.read(4)  # New size, checked against code_size afterwards
+        with open(base, "rb") as old:
+            with open(dst, "wb") as out:
+                while True:
+                    op = patch.read(1)
+                    if not op:
+                        break
+                    if op == b"C":
+                        offset, length = struct.unpack(">II", patch.read(8))
+                        old.seek(offset)
+                        src = old
+                    elif op == b"I":
+                        length = struct.unpack(">I", patch.read(4))[0]
+                        src = patch
+                    else:
+                        raise ValueError("bad patch operation")
+                    
+                    while length:
+                        n = src.readinto(mv[:min(length, CHUNK_SIZE)])
+                        if not n:
+                            raise ValueError("truncated patch")
+                        out.write(mv[:n])
+                        length -= n
+
+def install_file(staging_file, dst, update_info, base=None):
+    """Write the downloaded artifact to dst, decompressing and patching it as needed"""
+    delta = update_info.get("delta_from")
+    if update_info.get("compression") == "zlib":
+        target = OTA_PATCH if delta else dst
+        inflate_file(staging_file, target, update_info.get("wbits", 15))
+        staging_file = target
+    elif not delta:
+        copy_file(staging_file, dst)
+    
+    if delta:
+        apply_patch(base, staging_file, dst)
+        remove_file(OTA_PATCH)
+    
+    code_size = update_info.get("code_size")
+    if code_size is not None and file_size(dst) != code_size:
+        raise ValueError("installed size mismatch")
+    code_sha256 = update_info.get("code_sha256")
+    if code_sha256 and file_sha256(dst) != code_sha256:
+        raise ValueError("installed checksum mismatch")
+
+def is_dir(path):
+    try:
+        return os.stat(path)[0] & 0x4000 != 0
+    except OSError:
+        return False
+
+def clear_dir(path):
+    """Remove everything below path, creating path if it does not exist"""
+    if not is_dir(path):
+        os.mkdir(path)
+        return
+    for name in os.listdir(path):
+        child = path + "/" + name
+        if is_dir(child):
+            clear_dir(child)
+            os.rmdir(child)
+        else:
+            os.remove(child)
+
+def is_boot_stub(path="main.py"):
+    marker = BOOT_STUB.split("\n", 1)[0]
+    try:
+        with open(path, "r") as f:
+            return f.read(len(marker)) == marker
+    except OSError:
+        return False
+
+def write_boot_stub():
+    """Replace main.py with the boot stub in one rename"""
+    with open("main.tmp", "w") as f:
+        f.write(BOOT_STUB)
+    os.rename("main.tmp", "main.py")
+
+def adopt_factory_image():
+    """Move the factory main.py into FACTORY_SLOT and install the boot stub.
+    
+    The image is copied before the stub is renamed over main.py, so a power
+    cut at any point leaves a bootable main.py.
+    """
+    if is_boot_stub():
+        return
+    clear_dir(FACTORY_SLOT)
+    copy_file("main.py", FACTORY_SLOT + "/app.py")
+    write_boot_stub()
+
+def rollback_update():
+    """Switch back to the previously installed slot and restart"""
+    slot = active_slot()
+    if not slot:
+        print("Nothing to roll back to")
+        return False
+    set_active_slot(other_slot(slot))
+    machine.reset()
+
+async def apply_update(target, update_info):
+    """Switch to the slot download_update filled with the new release"""
     try:
         print("Applying update...")
-        led_blink_pattern("updating")
+        set_led("updating")
         
-        # Backup current main.py
-        try:
-            with open("main.py", "r") as f:
-                current_code = f.read()
-            with open("main_backup.py", "w") as f:
-                f.write(current_code)
-            print("Backup created")
-        except:
-            print("Backup creation failed")
+        # The running image was left alone, so it doubles as the patch base
+        # and as the rollback target
+        save_hashes(target, dict((entry["path"], entry["sha256"]) for entry in update_info["files"]))
+        clear_journal()
         
-        # Write new code
-        with open("main.py", "w") as f:
-            f.write(new_code)
+        if not active_slot():
+            adopt_factory_image()
+        set_active_slot(target)
         
-        print("Update applied successfully")
+        print("Update applied successfully to", target)
         print("Restarting in 3 seconds...")
-        utime.sleep(3)
+        await asyncio.sleep(3)
         machine.reset()
         
     except Exception as e:
         print("Update application failed:", e)
-        led_blink_pattern("error")
+        set_led("error")
         return False
 
-def perform_ota_update():
-    """Main OTA update function"""
+async def perform_ota_update():
+    """Main OTA update function, check and download run on one transport session"""
     try:
         print("=== Starting OTA Update Check ===")
         
         # Check for updates
-        update_info = check_for_update()
+        update_info = await check_for_update()
+        if update_info is None:
+            print("Update check failed")
+            return False
         
-        if update_info and update_info.get("update_available"):
+        if update_info.get("update_available"):
             print("Update available! Version:", update_info.get("new_version"))
             
-            # Download update
-            new_code = download_update()
+            # Download changed files into the inactive slot
+            target = await download_update(update_info)
             
-            if new_code:
+            if target:
                 print("Code downloaded successfully")
                 
                 # Apply update
-                apply_update(new_code)
+                await transport().close()
+                return await apply_update(target, update_info)
             else:
                 print("Failed to download update")
                 return False
@@ -318,44 +1608,89 @@ def perform_ota_update():
             
     except Exception as e:
         print("OTA update failed:", e)
-        led_blink_pattern("error")
+        set_led("error")
         return False
+    finally:
+        # Check and download share one session; release it until next time
+        await transport().close()
+        if led_pattern == "updating":
+            set_led("default")
 
-def main():
-    """Main application loop"""
-    print("=== Raspberry Pi Pico OTA System ===")
-    print("Version:", VERSION)
-    print("Device ID:", DEVICE_ID)
+def next_check_delay(failures):
+    """Seconds until the next update check.
     
-    # Initialize SIM7020E
-    if not init_sim7020():
-        print("Failed to initialize SIM7020E")
-        while True:
-            led_blink_pattern("error")
-            utime.sleep(2)
+    The server's hint (or OTA_CHECK_INTERVAL) after a success, doubling up
+    to OTA_MAX_BACKOFF with each consecutive failure. Every delay is
+    jittered so a fleet that powered up together drifts apart.
+    """
+    if failures:
+        delay = min(OTA_CHECK_INTERVAL * (1 << min(failures, 16)), OTA_MAX_BACKOFF)
+    else:
+        delay = next_check_hint or OTA_CHECK_INTERVAL
+    jitter = (random.getrandbits(16) / 32768 - 1) * OTA_JITTER
+    return max(1, delay * (1 + jitter))
+
+async def ota_task():
+    """Bring up the modem, then check for updates when next_check_delay says.
     
-    # Main loop
-    update_counter = 0
+    A download runs here in the background while app_task keeps going.
+    After MODEM_REINIT_FAILURES failed checks in a row the modem is brought
+    up again, in case it reset or lost its PDP context.
+    """
+    modem_up = False
+    reinit = False  # The modem is being brought up again after failed checks
+    failures = 0
+    while True:
+        ok = False
+        try:
+            if not modem_up:
+                modem_up = await init_sim7020()
+                if not modem_up:
+                    print("Failed to initialize SIM7020E")
+                    set_led("error")
+                ok = modem_up
+            else:
+                ok = await perform_ota_update()
+        except Exception as e:
+            print("OTA task error:", e)
+            set_led("error")
+        if ok and reinit:
+            # Up again, but the backoff goes on until a check succeeds
+            reinit = False
+        else:
+            failures = 0 if ok else failures + 1
+            if modem_up and failures and failures % MODEM_REINIT_FAILURES == 0:
+                print("Repeated failures, reinitializing the modem")
+                modem_up = False
+                reinit = True
+        delay = next_check_delay(failures)
+        print("Next update check in", int(delay), "s")
+        await asyncio.sleep(delay)
+
+async def app_task():
+    """The device's application; replace the body with the real workload"""
     while True:
         try:
             print("\n--- Main Loop ---")
-            
-            # Normal operation - blink LED
-            led_blink_pattern("default")
-            
-            # Check for OTA updates every 10 loops (adjust as needed)
-            update_counter += 1
-            if update_counter >= 10:
-                update_counter = 0
-                perform_ota_update()
-            
-            # Wait before next iteration
-            utime.sleep(5)
-            
+            gc.collect()
+            print("Free memory:", gc.mem_free())
         except Exception as e:
             print("Main loop error:", e)
-            led_blink_pattern("error")
-            utime.sleep(5)
+            set_led("error")
+        await asyncio.sleep(APP_INTERVAL)
+
+async def run():
+    asyncio.create_task(led_task())
+    asyncio.create_task(at_task())
+    asyncio.create_task(ota_task())
+    await app_task()
+
+def main():
+    """Start the application, LED, AT engine and OTA tasks"""
+    print("=== Raspberry Pi Pico OTA System ===")
+    print("Version:", VERSION)
+    print("Device ID:", DEVICE_ID)
+    asyncio.run(run())
 
 # Run main application
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+// Metrics in the Prometheus text exposition format
+//
+// Counters and histograms are updated on the request path and cost a Map
+// lookup each. Values that other modules already track (downloads in
+// flight, cache hits, devices per version) are not copied on every
+// request: a metric created with a collect function reads them when
+// /metrics is scraped.
+//
+// Samples are keyed by their label values in the order of labelNames:
+//   requests.inc({ action: 'check_update' })
+//   latency.observe({ action: 'check_update' }, 0.0042)
+
+const CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8';
+
+// Seconds, from a fast cache hit to a slow streamed response
+const DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5];
+
+function escapeLabel(value) {
+    return String(value).replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n');
+}
+
+// {a="1",b="2"} for the label names and values, '' without labels
+function formatLabels(names, values) {
+    if (!names.length) {
+        return '';
+    }
+    return '{' + names.map((name, i) => `${name}="${escapeLabel(values[i])}"`).join(',') + '}';
+}
+
+function formatValue(value) {
+    if (value === Infinity) {
+        return '+Inf';
+    }
+    if (value === -Infinity) {
+        return '-Inf';
+    }
+    return String(value);
+}
+
+class Metric {
+    constructor(type, name, help, labelNames = [], collect = null) {
+        this.type = type;
+        this.name = name;
+        this.help = help;
+        this.labelNames = labelNames;
+        this.collect = collect;  // () => value, or [[labels, value], ...] with labels
+        this.samples = new Map();  // label values joined by \0 -> { values, value }
+    }
+
+    labelValues(labels = {}) {
+        return this.labelNames.map(name => (labels[name] === undefined ? '' : labels[name]));
+    }
+
+    sample(labels) {
+        const values = this.labelValues(labels);
+        const key = values.join('\0');
+        let sample = this.samples.get(key);
+        if (!sample) {
+            sample = { values, value: 0 };
+            this.samples.set(key, sample);
+        }
+        return sample;
+    }
+
+    lines() {
+        if (this.collect) {
+            const collected = this.collect();
+            if (!Array.isArray(collected)) {
+                return [`${this.name} ${formatValue(collected)}`];
+            }
+            return collected.map(([labels, value]) =>
+                `${this.name}${formatLabels(this.labelNames, this.labelValues(labels))} ${formatValue(value)}`);
+        }
+        return Array.from(this.samples.values(), sample =>
+            `${this.name}${formatLabels(this.labelNames, sample.values)} ${formatValue(sample.value)}`);
+    }
+
+    render() {
+        return [`# HELP ${this.name} ${this.help}`, `# TYPE ${this.name} ${this.type}`]
+            .concat(this.lines()).join('\n');
+    }
+}
+
+class Counter extends Metric {
+    constructor(name, help, labelNames, collect) {
+        super('counter', name, help, labelNames, collect);
+    }
+
+    inc(labels, value = 1) {
+        this.sample(labels).value += value;
+    }
+}
+
+class Gauge extends Metric {
+    constructor(name, help, labelNames, collect) {
+        super('gauge', name, help, labelNames, collect);
+    }
+
+    set(labels, value) {
+        this.sample(labels).value = value;
+    }
+}
+
+class Histogram extends Metric {
+    constructor(name, help, labelNames, buckets = DEFAULT_BUCKETS) {
+        super('histogram', name, help, labelNames);
+        this.buckets = buckets;
+    }
+
+    observe(labels, value) {
+        const sample = this.sample(labels);
+        if (!sample.counts) {
+            sample.counts = new Array(this.buckets.length).fill(0);
+            sample.sum = 0;
+            sample.count = 0;
+        }
+        // Counts are per bucket here and made cumulative when rendered
+        const i = this.buckets.findIndex(bound => value <= bound);
+        if (i >= 0) {
+            sample.counts[i]++;
+        }
+        sample.sum += value;
+        sample.count++;
+    }
+
+    lines() {
+        const lines = [];
+        const names = this.labelNames.concat('le');
+        for (const sample of this.samples.values()) {
+            let cumulative = 0;
+            this.buckets.forEach((bound, i) => {
+                cumulative += sample.counts[i];
+                lines.push(`${this.name}_bucket${formatLabels(names, sample.values.concat(bound))} ${cumulative}`);
+            });
+            lines.push(`${this.name}_bucket${formatLabels(names, sample.values.concat('+Inf'))} ${sample.count}`);
+            const labels = formatLabels(this.labelNames, sample.values);
+            lines.push(`${this.name}_sum${labels} ${sample.sum}`);
+            lines.push(`${this.name}_count${labels} ${sample.count}`);
+        }
+        return lines;
+    }
+}
+
+class MetricsRegistry {
+    constructor() {
+        this.metrics = [];
+    }
+
+    add(metric) {
+        this.metrics.push(metric);
+        return metric;
+    }
+
+    counter(name, help, labelNames, collect) {
+        return this.add(new Counter(name, help, labelNames, collect));
+    }
+
+    gauge(name, help, labelNames, collect) {
+        return this.add(new Gauge(name, help, labelNames, collect));
+    }
+
+    histogram(name, help, labelNames, buckets) {
+        return this.add(new Histogram(name, help, labelNames, buckets));
+    }
+
+    render() {
+        return this.metrics.map(metric => metric.render()).join('\n') + '\n';
+    }
+}
+
+module.exports = { MetricsRegistry, Counter, Gauge, Histogram, CONTENT_TYPE };
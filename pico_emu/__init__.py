@@ -0,0 +1,29 @@
+"""
+Host-side stand-ins for the MicroPython modules main.py uses, with an
+emulated SIM7020E behind the UART, so the device code runs on Linux.
+
+    import pico_emu
+    modem = pico_emu.install(pico_emu.SIM7020E(pico_emu.NBIOT, apn="cmnbiot"))
+    import main
+
+install() must run before main.py is imported.
+"""
+import sys
+
+from . import deflate, machine, uasyncio, ubinascii, utime
+from .machine import DeviceReset
+from .sim7020 import LINKS, LOCAL, NBIOT, Link, SIM7020E
+
+def install(modem=None):
+    """Register the shims as machine, utime, ubinascii, uasyncio and deflate.
+    Returns the modem the emulated UART is connected to.
+    """
+    machine.modem = modem or SIM7020E()
+    sys.modules["machine"] = machine
+    sys.modules["utime"] = utime
+    sys.modules["ubinascii"] = ubinascii
+    sys.modules["uasyncio"] = uasyncio
+    sys.modules["deflate"] = deflate
+    return machine.modem
+
+__all__ = ["install", "DeviceReset", "SIM7020E", "Link", "LINKS", "NBIOT", "LOCAL"]
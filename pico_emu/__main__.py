@@ -0,0 +1,86 @@
+"""
+Run one OTA update check of main.py against a local server.
+
+    node server.js &
+    python -m pico_emu --server http://localhost:3000 --link nbiot
+    python -m pico_emu --server http://localhost:3000 --transport coap
+
+The device's flash is a directory (a fresh temporary one unless --flash is
+given). main.py is copied into it as the factory image the first time.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pico_emu
+
+def load_main(path):
+    spec = importlib.util.spec_from_file_location("main", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["main"] = module
+    spec.loader.exec_module(module)
+    return module
+
+def run(main, modem):
+    """Bring the modem up and run one update check, returns the result dict"""
+    result = {"reset": False}
+    
+    async def update():
+        result["modem_up"] = await main.init_sim7020()
+        result["bringup_timings"] = dict(main.bringup_timings)
+        if result["modem_up"]:
+            result["updated"] = await main.perform_ota_update()
+    
+    start = time.monotonic()
+    try:
+        pico_emu.uasyncio.run(update())
+    except pico_emu.DeviceReset:
+        result["reset"] = True
+    result["elapsed_s"] = round(time.monotonic() - start, 3)
+    result["modem"] = modem.stats
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Run main.py against an emulated SIM7020E")
+    parser.add_argument("--server", default="http://localhost:3000", help="OTA server URL")
+    parser.add_argument("--link", choices=sorted(pico_emu.LINKS), default="nbiot", help="network timing model")
+    parser.add_argument("--baud", type=int, default=None, help="UART baud rate (default: main.py's)")
+    parser.add_argument("--flash", help="directory used as the device's flash")
+    parser.add_argument("--main", default=os.path.join(os.path.dirname(__file__), "..", "main.py"),
+                        help="device code to run")
+    parser.add_argument("--version", help="override main.VERSION")
+    parser.add_argument("--transport", choices=("http", "coap"), help="override main.TRANSPORT")
+    parser.add_argument("--coap-port", type=int, help="override main.COAP_PORT")
+    args = parser.parse_args()
+    
+    flash = args.flash or tempfile.mkdtemp(prefix="pico-flash-")
+    os.makedirs(flash, exist_ok=True)
+    if not os.path.exists(os.path.join(flash, "main.py")):
+        shutil.copy(args.main, os.path.join(flash, "main.py"))
+    main_path = os.path.abspath(args.main)
+    os.chdir(flash)
+    
+    modem = pico_emu.install(pico_emu.SIM7020E(pico_emu.LINKS[args.link]))
+    main = load_main(main_path)
+    main.OTA_SERVER = args.server
+    if args.version:
+        main.VERSION = args.version
+    if args.transport:
+        main.TRANSPORT = args.transport
+    if args.coap_port:
+        main.COAP_PORT = args.coap_port
+    if args.baud:
+        main.uart_baute = args.baud
+    modem.apn = main.APN
+    
+    result = run(main, modem)
+    result["flash"] = flash
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+deflate stand-in for running device code on a host, on top of CPython's zlib
+"""
+import zlib
+
+RAW = 1
+ZLIB = 2
+GZIP = 3
+
+class DeflateIO:
+    """Read-only decompressing stream over another stream, like MicroPython's"""
+    
+    def __init__(self, stream, format=ZLIB, wbits=0, close=False):
+        self.stream = stream
+        wbits = wbits or 15
+        self.decomp = zlib.decompressobj({RAW: -wbits, ZLIB: wbits, GZIP: 16 + wbits}[format])
+        self.pending = b""
+    
+    def readinto(self, buf):
+        while not self.pending and not self.decomp.eof:
+            data = self.stream.read(len(buf))
+            if not data:
+                self.pending = self.decomp.flush()
+                break
+            self.pending = self.decomp.decompress(data)
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
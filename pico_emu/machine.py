@@ -0,0 +1,56 @@
+"""
+machine stand-in for running device code on a host.
+
+UART talks to the emulated modem set by install(); reset() raises
+DeviceReset so a runner can see where the device would have restarted.
+"""
+
+# Modem behind every UART, set by pico_emu.install()
+modem = None
+
+class DeviceReset(BaseException):
+    """Raised by reset(). Not an Exception, so device code cannot swallow it."""
+
+def reset():
+    raise DeviceReset()
+
+class Pin:
+    OUT = 1
+    IN = 0
+    
+    def __init__(self, pin, mode=IN):
+        self.pin = pin
+        self.mode = mode
+        self._value = 0
+    
+    def value(self, v=None):
+        if v is None:
+            return self._value
+        self._value = 1 if v else 0
+
+class UART:
+    """UART connected to the emulated modem. No irq(), so the device code polls."""
+    
+    def __init__(self, port, baudrate=115200, **kwargs):
+        if modem is None:
+            raise OSError("pico_emu.install() was not called with a modem")
+        self.port = port
+        self.modem = modem
+        self.modem.open(baudrate)
+    
+    def any(self):
+        return self.modem.pending()
+    
+    def read(self, n=None):
+        data = self.modem.read(n)
+        return data or None
+    
+    def readinto(self, buf, n=None):
+        n = len(buf) if n is None else min(n, len(buf))
+        data = self.modem.read(n)
+        buf[:len(data)] = data
+        return len(data)
+    
+    def write(self, data):
+        self.modem.write(bytes(data))
+        return len(data)
@@ -0,0 +1,368 @@
+"""
+Emulated SIM7020E NB-IoT modem.
+
+Implements the AT commands main.py uses and forwards AT+CHTTP* requests to
+a real HTTP server and AT+CCOAP* messages to a real CoAP server over UDP.
+Timing follows the device: bytes cross the UART at the configured baud
+rate, the network is registered some time after the radio is switched on,
+and every HTTP or CoAP exchange takes the link's round trip time plus its
+payload over the link's uplink/downlink rates.
+"""
+import binascii
+import http.client
+import re
+import socket
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+# Request line and headers that http.client adds to each request, counted
+# against the uplink together with the body
+HTTP_OVERHEAD = 150
+# IPv4 and UDP headers of each CoAP datagram
+UDP_OVERHEAD = 28
+# How long to wait for a CoAP server to answer before giving up on a datagram
+COAP_REPLY_TIMEOUT = 2.0
+# Largest datagram read from the CoAP server, a 1024 byte block plus headers
+COAP_MAX_DATAGRAM = 2048
+
+class Link:
+    """Network timing model. Rates are in bit/s, 0 means unlimited."""
+    
+    def __init__(self, rtt=0.0, uplink=0, downlink=0, attach=0.0):
+        self.rtt = rtt        # Seconds per request/response round trip
+        self.uplink = uplink
+        self.downlink = downlink
+        self.attach = attach  # Seconds from AT+CFUN=1 to registration
+    
+    def transfer_time(self, up_bytes, down_bytes):
+        t = self.rtt
+        if self.uplink:
+            t += up_bytes * 8 / self.uplink
+        if self.downlink:
+            t += down_bytes * 8 / self.downlink
+        return t
+
+# Typical NB-IoT (Cat-NB1) coverage: second-scale latency, tens of kbit/s
+NBIOT = Link(rtt=1.5, uplink=20000, downlink=25000, attach=5.0)
+# No network delays, only the UART
+LOCAL = Link()
+
+LINKS = {"nbiot": NBIOT, "local": LOCAL}
+
+SEND_RE = re.compile(r'(\d+),([01]),"([^"]*)"(?:,([0-9A-Fa-f]*)(?:,"([^"]*)",([0-9A-Fa-f]*))?)?$')
+
+class Session:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.conn = None
+        self.body = b""
+
+class SIM7020E:
+    """The modem side of the UART: write() takes command bytes, read() returns
+    response bytes once the emulated modem would have sent them.
+    """
+    
+    def __init__(self, link=LOCAL, boot_time=0.0, apn="", host=None):
+        self.link = link
+        self.boot_time = boot_time  # Seconds from power on until AT answers
+        self.apn = apn              # APN stored in the modem's NV memory
+        self.host = host            # "host:port" to send every request to, if set
+        self.baud = 115200
+        self.echo = True
+        self.cfun = 1
+        self.registered_at = 0.0
+        self.booted_at = 0.0
+        self.sessions = {}
+        self.coap = {}        # CoAP instance id -> connected UDP socket
+        self._line = bytearray()
+        self._out = deque()   # [start time, data, bytes read]
+        self._out_end = 0.0
+        self.stats = {
+            "commands": 0,
+            "http_requests": 0,
+            "coap_messages": 0,
+            "uart_tx_bytes": 0,
+            "uart_rx_bytes": 0,
+            "air_up_bytes": 0,
+            "air_down_bytes": 0
+        }
+    
+    # --- UART side ---
+    
+    def open(self, baud):
+        """Called when the device opens the UART; the modem powers up now"""
+        now = time.monotonic()
+        self.baud = baud
+        self.booted_at = now + self.boot_time
+        self.registered_at = self.booted_at + self.link.attach
+    
+    def _byte_time(self, n):
+        return n * 10 / self.baud  # 8N1: 10 bits per byte
+    
+    def _emit(self, data, delay=0.0):
+        """Queue response bytes to start arriving after delay seconds"""
+        start = max(time.monotonic() + delay, self._out_end)
+        self._out_end = start + self._byte_time(len(data))
+        self._out.append([start, data, 0])
+    
+    def pending(self):
+        now = time.monotonic()
+        n = 0
+        for start, data, pos in self._out:
+            if now < start:
+                break
+            ready = min(len(data), int((now - start) * self.baud / 10) + 1)
+            n += ready - pos
+            if ready < len(data):
+                break
+        return n
+    
+    def read(self, n=None):
+        now = time.monotonic()
+        out = bytearray()
+        while self._out and (n is None or len(out) < n):
+            seg = self._out[0]
+            start, data, pos = seg
+            if now < start:
+                break
+            ready = min(len(data), int((now - start) * self.baud / 10) + 1)
+            take = ready - pos if n is None else min(ready - pos, n - len(out))
+            out += data[pos:pos + take]
+            seg[2] += take
+            if seg[2] < len(data):
+                break
+            self._out.popleft()
+        self.stats["uart_rx_bytes"] += len(out)
+        return bytes(out)
+    
+    def write(self, data):
+        self.stats["uart_tx_bytes"] += len(data)
+        # The command is complete once its last byte has crossed the UART
+        delay = self._byte_time(len(data))
+        for b in data:
+            if b == 13:
+                line = bytes(self._line).decode("latin1").strip()
+                self._line = bytearray()
+                if line:
+                    self._command(line, delay)
+            elif b != 10:
+                self._line.append(b)
+    
+    # --- Command handling ---
+    
+    def _reply(self, text, delay=0.0, ok=True):
+        out = ""
+        if text:
+            out += "\r\n" + text + "\r\n"
+        out += "\r\nOK\r\n" if ok else "\r\nERROR\r\n"
+        self._emit(out.encode(), delay)
+    
+    def _command(self, line, delay):
+        now = time.monotonic()
+        if now + delay < self.booted_at:
+            return  # Still booting, commands are lost
+        self.stats["commands"] += 1
+        if self.echo:
+            self._emit((line + "\r\n").encode(), delay)
+        
+        cmd, _, arg = line.partition("=")
+        if cmd.endswith("?"):
+            cmd, arg = cmd[:-1], "?"
+        upper = cmd.upper()
+        handler = getattr(self, "_at_" + re.sub(r"[^A-Z0-9]", "_", upper[2:]), None)
+        if not upper.startswith("AT"):
+            self._reply("", delay, ok=False)
+        elif upper == "AT":
+            self._reply("", delay)
+        elif upper in ("ATE0", "ATE1"):
+            self.echo = upper == "ATE1"
+            self._reply("", delay)
+        elif handler is None:
+            self._reply("", delay, ok=False)
+        else:
+            handler(arg, delay)
+    
+    def _attached(self):
+        return self.cfun == 1 and time.monotonic() >= self.registered_at
+    
+    def _at__CFUN(self, arg, delay):
+        if arg == "?":
+            self._reply("+CFUN: {}".format(self.cfun), delay)
+            return
+        cfun = int(arg)
+        if cfun == 1 and self.cfun != 1:
+            self.registered_at = time.monotonic() + self.link.attach
+        self.cfun = cfun
+        self._reply("", delay)
+    
+    def _at__MCGDEFCONT(self, arg, delay):
+        if arg == "?":
+            self._reply('*MCGDEFCONT: "IP","{}"'.format(self.apn), delay)
+            return
+        if self.cfun != 0:
+            self._reply("", delay, ok=False)  # Only accepted with the radio off
+            return
+        self.apn = arg.split(",")[1].strip('"')
+        self._reply("", delay)
+    
+    def _at__CEREG(self, arg, delay):
+        self._reply("+CEREG: 0,{}".format(1 if self._attached() else 2), delay)
+    
+    def _at__CGATT(self, arg, delay):
+        self._reply("+CGATT: {}".format(1 if self._attached() else 0), delay)
+    
+    def _at__CGACT(self, arg, delay):
+        self._reply("+CGACT: 1,{}".format(1 if self._attached() else 0), delay)
+    
+    def _at__CHTTPCREATE(self, arg, delay):
+        sid = 0
+        while sid in self.sessions:
+            sid += 1
+        self.sessions[sid] = Session(arg.split(",")[0].strip('"'))
+        self._reply("+CHTTPCREATE: {}".format(sid), delay)
+    
+    def _session(self, arg):
+        return self.sessions.get(int(arg.split(",")[0]))
+    
+    def _at__CHTTPCON(self, arg, delay):
+        session = self._session(arg)
+        if session is None or not self._attached():
+            self._reply("", delay, ok=False)
+            return
+        host, port = session.host, session.port
+        if self.host:
+            host, _, port = self.host.partition(":")
+            port = int(port or 80)
+        try:
+            session.conn = http.client.HTTPConnection(host, port, timeout=30)
+            session.conn.connect()
+        except OSError:
+            session.conn = None
+            self._reply("", delay + self.link.rtt, ok=False)
+            return
+        # TCP handshake is one round trip
+        self._reply("", delay + self.link.rtt)
+    
+    def _at__CHTTPSEND(self, arg, delay):
+        match = SEND_RE.match(arg)
+        session = match and self.sessions.get(int(match.group(1)))
+        if session is None or session.conn is None:
+            self._reply("", delay, ok=False)
+            return
+        sid, method, path, header_hex, ctype, body_hex = match.groups()
+        headers = {}
+        if header_hex:
+            for header in binascii.unhexlify(header_hex).decode().split("\r\n"):
+                name, _, value = header.partition(":")
+                if name:
+                    headers[name.strip()] = value.strip()
+        body = None
+        if method == "1":
+            headers["Content-Type"] = ctype
+            body = binascii.unhexlify(body_hex or "")
+        
+        try:
+            session.conn.request("POST" if body is not None else "GET", path, body, headers)
+            response = session.conn.getresponse()
+            session.body = response.read()
+        except (OSError, http.client.HTTPException):
+            # Connection closed by the server or failed
+            session.conn.close()
+            session.conn = None
+            self._emit("\r\n+CHTTPERR: {},-2\r\n".format(sid).encode(), delay)
+            self._reply("", delay, ok=False)
+            return
+        
+        up = len(body or b"") + HTTP_OVERHEAD
+        down = len(session.body) + HTTP_OVERHEAD
+        self.stats["http_requests"] += 1
+        self.stats["air_up_bytes"] += up
+        self.stats["air_down_bytes"] += down
+        self._reply("", delay)
+        self._emit("\r\n+CHTTPNMIC: {},{},{}\r\n".format(sid, response.status, len(session.body)).encode(),
+                   delay + self.link.transfer_time(up, down))
+    
+    def _at__CHTTPREAD(self, arg, delay):
+        session = self._session(arg)
+        if session is None:
+            self._reply("", delay, ok=False)
+            return
+        body, session.body = session.body, b""
+        sid = arg.split(",")[0]
+        self._emit("\r\n+CHTTPREAD: {},{}\r\n".format(sid, len(body)).encode() + body + b"\r\nOK\r\n", delay)
+    
+    def _at__CHTTPDISCON(self, arg, delay):
+        session = self._session(arg)
+        if session and session.conn:
+            session.conn.close()
+            session.conn = None
+        self._reply("", delay, ok=session is not None)
+    
+    def _at__CHTTPDESTROY(self, arg, delay):
+        session = self._session(arg)
+        if session is None:
+            self._reply("", delay, ok=False)
+            return
+        if session.conn:
+            session.conn.close()
+        del self.sessions[int(arg.split(",")[0])]
+        self._reply("", delay)
+    
+    def _at__CDNSGIP(self, arg, delay):
+        host = arg.strip('"')
+        try:
+            address = socket.gethostbyname(host)
+        except OSError:
+            self._reply("", delay)
+            self._emit('\r\n+CDNSGIP: 0,8\r\n'.encode(), delay + self.link.rtt)
+            return
+        self._reply("", delay)
+        self._emit('\r\n+CDNSGIP: 1,"{}","{}"\r\n'.format(host, address).encode(), delay + self.link.rtt)
+    
+    def _at__CCOAPNEW(self, arg, delay):
+        address, port = arg.split(",")[:2]
+        if not self._attached():
+            self._reply("", delay, ok=False)
+            return
+        cid = 0
+        while cid in self.coap:
+            cid += 1
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(COAP_REPLY_TIMEOUT)
+        sock.connect((address.strip('"'), int(port)))
+        self.coap[cid] = sock
+        # UDP, nothing goes over the air yet
+        self._reply("+CCOAPNEW: {}".format(cid), delay)
+    
+    def _at__CCOAPSEND(self, arg, delay):
+        cid, length, data = arg.split(",")[:3]
+        sock = self.coap.get(int(cid))
+        message = binascii.unhexlify(data.strip('"'))
+        if sock is None or len(message) != int(length):
+            self._reply("", delay, ok=False)
+            return
+        self._reply("", delay)
+        
+        sock.send(message)
+        self.stats["coap_messages"] += 1
+        up = len(message) + UDP_OVERHEAD
+        self.stats["air_up_bytes"] += up
+        if (message[0] >> 4) & 3 >= 2:
+            return  # ACK or reset, no answer follows
+        try:
+            reply = sock.recv(COAP_MAX_DATAGRAM)
+        except OSError:
+            return  # Lost, the device retransmits
+        down = len(reply) + UDP_OVERHEAD
+        self.stats["air_down_bytes"] += down
+        self._emit("\r\n+CCOAPNMI: {},{},{}\r\n".format(cid, len(reply), reply.hex().upper()).encode(),
+                   delay + self.link.transfer_time(up, down))
+    
+    def _at__CCOAPDEL(self, arg, delay):
+        sock = self.coap.pop(int(arg.split(",")[0]), None)
+        if sock:
+            sock.close()
+        self._reply("", delay, ok=sock is not None)
@@ -0,0 +1,9 @@
+"""
+uasyncio stand-in for running device code on a host: CPython's asyncio plus
+the MicroPython-only sleep_ms
+"""
+from asyncio import *  # noqa: F401,F403
+import asyncio as _asyncio
+
+async def sleep_ms(ms):
+    await _asyncio.sleep(ms / 1000)
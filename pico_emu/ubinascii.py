@@ -0,0 +1,4 @@
+"""
+ubinascii stand-in for running device code on a host
+"""
+from binascii import a2b_base64, b2a_base64, hexlify, unhexlify
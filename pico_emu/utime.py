@@ -0,0 +1,28 @@
+"""
+utime stand-in for running device code on a host
+"""
+import time as _time
+
+def sleep(seconds):
+    _time.sleep(seconds)
+
+def sleep_ms(ms):
+    _time.sleep(ms / 1000)
+
+def sleep_us(us):
+    _time.sleep(us / 1000000)
+
+def ticks_ms():
+    return int(_time.monotonic() * 1000)
+
+def ticks_us():
+    return int(_time.monotonic() * 1000000)
+
+def ticks_add(ticks, delta):
+    return ticks + delta
+
+def ticks_diff(end, start):
+    return end - start
+
+def time():
+    return int(_time.time())
@@ -0,0 +1,107 @@
+// Rollout control for update downloads
+//
+// Three limits decide whether a device may download a release now:
+//   - cohorts: a release rolled out to P percent reaches the devices whose
+//     id hashes into the first P of 100 buckets, so raising P only adds
+//     devices and a device never flips in and out of a rollout
+//   - in-flight downloads: each admitted device holds a lease that every
+//     chunk renews; it is released when the device reports the new
+//     version or after leaseTimeout ms without a chunk
+//   - egress: a token bucket of bytesPerSecond, refilled continuously and
+//     allowed to run into debt by one chunk so any chunk size gets through
+//
+// A device that is over a limit is told how many seconds to wait.
+
+const crypto = require('crypto');
+
+// Cohort bucket (0-99) of a device, stable across restarts
+function cohortOf(deviceId) {
+    return crypto.createHash('md5').update(String(deviceId)).digest().readUInt32BE(0) % 100;
+}
+
+class RolloutController {
+    constructor({ maxInFlight = 0, bytesPerSecond = 0, leaseTimeout = 120000, retryAfter = 60 } = {}) {
+        this.maxInFlight = maxInFlight;        // 0 = unlimited
+        this.bytesPerSecond = bytesPerSecond;  // 0 = unlimited
+        this.leaseTimeout = leaseTimeout;
+        this.retryAfter = retryAfter;          // Seconds to wait for a download slot
+        this.leases = new Map();               // device id -> { version, lastActive }
+        this.tokens = bytesPerSecond;
+        this.lastRefill = Date.now();
+        this.deferred = 0;
+        this.throttled = 0;
+    }
+
+    inCohort(deviceId, percent) {
+        return percent >= 100 || cohortOf(deviceId) < percent;
+    }
+
+    expireLeases(now) {
+        for (const [deviceId, lease] of this.leases) {
+            if (now - lease.lastActive > this.leaseTimeout) {
+                this.leases.delete(deviceId);
+            }
+        }
+    }
+
+    // Admit a device to download version, returns 0 or seconds to wait
+    admit(deviceId, version) {
+        const now = Date.now();
+        const lease = this.leases.get(deviceId);
+        if (lease) {
+            lease.version = version;
+            lease.lastActive = now;
+            return 0;
+        }
+        if (this.maxInFlight) {
+            if (this.leases.size >= this.maxInFlight) {
+                this.expireLeases(now);
+            }
+            if (this.leases.size >= this.maxInFlight) {
+                this.deferred++;
+                return this.retryAfter;
+            }
+        }
+        this.leases.set(deviceId, { version, lastActive: now });
+        return 0;
+    }
+
+    // The device runs currentVersion; drop its lease once it has installed
+    // what it was admitted for
+    reportVersion(deviceId, currentVersion) {
+        const lease = this.leases.get(deviceId);
+        if (lease && lease.version === currentVersion) {
+            this.leases.delete(deviceId);
+        }
+    }
+
+    // Account for bytes about to be sent, returns 0 or seconds to wait
+    takeEgress(bytes) {
+        if (!this.bytesPerSecond) {
+            return 0;
+        }
+        const now = Date.now();
+        this.tokens = Math.min(this.bytesPerSecond,
+            this.tokens + (now - this.lastRefill) * this.bytesPerSecond / 1000);
+        this.lastRefill = now;
+        if (this.tokens <= 0) {
+            this.throttled++;
+            return Math.max(1, Math.ceil((bytes - this.tokens) / this.bytesPerSecond));
+        }
+        this.tokens -= bytes;
+        return 0;
+    }
+
+    stats() {
+        this.expireLeases(Date.now());
+        return {
+            in_flight: this.leases.size,
+            max_in_flight: this.maxInFlight,
+            bytes_per_second: this.bytesPerSecond,
+            deferred: this.deferred,
+            throttled: this.throttled
+        };
+    }
+}
+
+module.exports = { RolloutController, cohortOf };
@@ -1,124 +1,890 @@
 const express = require('express');
 const fs = require('fs');
 const path = require('path');
+const os = require('os');
+const { spawnSync } = require('child_process');
+const zlib = require('zlib');
+const { createDelta, applyDelta } = require('./delta');
+const { RolloutController } = require('./rollout');
+const { CoapProxy } = require('./coap');
+const { ArtifactStore, writeAtomic } = require('./store');
+const { DeviceRegistry } = require('./devices');
+const { MetricsRegistry, CONTENT_TYPE: METRICS_CONTENT_TYPE } = require('./metrics');
 const app = express();
 const PORT = process.env.PORT || 3000;
+const KEEP_ALIVE_TIMEOUT = 60000;
+const MPY_CROSS = process.env.MPY_CROSS || 'mpy-cross';
+// UDP port of the CoAP endpoint (see coap.js), 0 to turn it off
+const COAP_PORT = Number(process.env.COAP_PORT || 5683);
+// A line per device request is only logged at LOG_LEVEL=debug, and then
+// only for a LOG_SAMPLE share (0-1) of the requests
+const LOG_REQUESTS = process.env.LOG_LEVEL === 'debug';
+const LOG_SAMPLE = process.env.LOG_SAMPLE !== undefined ? Number(process.env.LOG_SAMPLE) : 1;
 
 // Middleware
 app.use(express.json());
+
+// Conditional update check: GET /c/<current version>?d=<device id>. The
+// version is the device's token. An up-to-date device gets 304 with no
+// body, or "N <seconds>\n" when it should wait longer than its default
+// before checking again. Otherwise the reply is "U <new version>\n" and
+// the device follows up with a full check_update. That request counts
+// towards the check rate, so a "U" reply does not. Registered ahead of the
+// static files so this path never touches the file system.
+app.get('/c/:version', (req, res) => {
+    timeRequest(res, 'check_conditional');
+    const currentVersion = req.params.version;
+    const deviceId = req.query.d;
+    registry.seen(deviceId, { current_version: currentVersion, ip: req.ip });
+    
+    rollout.reportVersion(deviceId, currentVersion);
+    const nextVersion = getNextVersion(currentVersion, deviceId);
+    if (!nextVersion) {
+        recordCheck();
+        const nextCheck = nextCheckHint(false);
+        if (nextCheck === CHECK_INTERVAL) {
+            return res.status(304).end();
+        }
+        return res.type('text/plain').send(`N ${nextCheck}\n`);
+    }
+    
+    // No download slot free: come back later
+    const retryAfter = rollout.admit(deviceId, nextVersion);
+    if (retryAfter) {
+        recordCheck();
+        return res.type('text/plain').send(`N ${retryAfter}\n`);
+    }
+    res.type('text/plain').send(`U ${nextVersion}\n`);
+});
+
+// Binary download of one release artifact:
+//   GET /firmware/<version>?format=<py|mpy>&path=<file>&compression=<none|zlib>[&from=<version>][&d=<device id>]
+// The check_update reply carries these URLs. The body is the raw artifact
+// streamed from the store with its SHA-256 in Digest and ETag. A single
+// "Range: bytes=<first>-<last>" gets 206 with just those bytes, which is
+// how devices fetch it chunk by chunk. Downloads by a device (d=...) go
+// through rollout admission, and every response counts against egress.
+app.get('/firmware/:version', (req, res) => {
+    timeRequest(res, 'firmware');
+    const version = req.params.version;
+    const { format, path: filePath, compression, from, d: deviceId } = req.query;
+    const artifact = findArtifact(version, format, filePath, from, compression);
+    if (!artifact) {
+        return res.status(404).json({
+            success: false,
+            error: 'Update not found'
+        });
+    }
+    
+    const range = parseRange(req.headers.range, artifact.size);
+    if (range === null) {
+        return res.status(416).set('Content-Range', `bytes */${artifact.size}`).json({
+            success: false,
+            error: 'Invalid range'
+        });
+    }
+    const { start, end } = range || { start: 0, end: artifact.size };
+    registry.touch(deviceId);
+    
+    const retryAfter = (deviceId && rollout.admit(deviceId, version)) || rollout.takeEgress(end - start);
+    if (retryAfter) {
+        return res.set('Retry-After', String(retryAfter)).status(429).json({
+            success: false,
+            error: 'Rollout limit reached',
+            retry_after: retryAfter
+        });
+    }
+    
+    res.set({
+        'Content-Type': 'application/octet-stream',
+        'Accept-Ranges': 'bytes',
+        'ETag': `"${artifact.sha256}"`,
+        'Digest': 'sha-256=' + Buffer.from(artifact.sha256, 'hex').toString('base64')
+    });
+    if (range) {
+        res.status(206).set('Content-Range', `bytes ${start}-${end - 1}/${artifact.size}`);
+    }
+    bytesServed.inc({ artifact: from ? 'delta' : format || 'py', compression: artifact.compression, encoding: 'bin' },
+        end - start);
+    if (end - start <= MAX_CHUNK_SIZE) {
+        // Chunks come from the store's cache
+        return res.end(store.read(artifact.sha256, start, end));
+    }
+    sendObject(res, artifact.sha256, start, end);
+});
+
 app.use(express.static('public'));
 
-// Store device information and available updates
-const devices = new Map();
+// Store available updates
 const availableUpdates = new Map();
 
-// Initialize with test updates
-function initializeUpdates() {
-    // Load test blink codes
-    const testCode1 = fs.readFileSync(path.join(__dirname, 'test_blink_1.py'), 'utf8');
-    const testCode2 = fs.readFileSync(path.join(__dirname, 'test_blink_2.py'), 'utf8');
-    
-    availableUpdates.set('2.0.0', {
-        version: '2.0.0',
-        description: 'Fast blink pattern test',
-        code: testCode1,
-        hex_code: Buffer.from(testCode1).toString('hex')
+// Release versions in ascending semver order, kept in step with availableUpdates
+const releaseIndex = [];
+
+// "latest" sends a device straight to the newest release, "next" walks
+// through every release in between
+const UPDATE_POLICY = process.env.UPDATE_POLICY === 'next' ? 'next' : 'latest';
+
+// Download admission: at most MAX_CONCURRENT_DOWNLOADS devices download at
+// a time and chunks leave at no more than EGRESS_BYTES_PER_SEC (0 = no
+// limit). New releases reach ROLLOUT_PERCENT of devices unless POST /updates
+// or PUT /updates/:version/rollout says otherwise.
+const rollout = new RolloutController({
+    maxInFlight: Number(process.env.MAX_CONCURRENT_DOWNLOADS) || 0,
+    bytesPerSecond: Number(process.env.EGRESS_BYTES_PER_SEC) || 0
+});
+const DEFAULT_ROLLOUT = process.env.ROLLOUT_PERCENT !== undefined ? Number(process.env.ROLLOUT_PERCENT) : 100;
+
+// Poll scheduling: devices check every CHECK_INTERVAL seconds (matching
+// OTA_CHECK_INTERVAL in main.py) until update checks arrive faster than
+// TARGET_CHECK_RATE per second. Then the next_check hint stretches the
+// interval in proportion, up to MAX_CHECK_INTERVAL.
+const CHECK_INTERVAL = Number(process.env.CHECK_INTERVAL) || 60;
+const MAX_CHECK_INTERVAL = 3600;
+const TARGET_CHECK_RATE = Number(process.env.TARGET_CHECK_RATE) || 50;
+const CHECK_RATE_WINDOW = 10000;
+let checkWindowStart = Date.now();
+let checksInWindow = 0;
+let checkRate = 0;  // Checks per second over the last complete window
+
+// Release files and everything derived from them are kept on disk in a
+// content-addressed store under DATA_DIR, with an LRU cache of up to
+// ARTIFACT_CACHE_BYTES in front. Release records only hold digests and
+// are saved in DATA_DIR/releases, so releases survive a restart.
+const DATA_DIR = process.env.DATA_DIR || path.join(__dirname, 'data');
+const RELEASES_DIR = path.join(DATA_DIR, 'releases');
+const store = new ArtifactStore({
+    dir: DATA_DIR,
+    cacheBytes: Number(process.env.ARTIFACT_CACHE_BYTES) || 64 * 1024 * 1024
+});
+fs.mkdirSync(RELEASES_DIR, { recursive: true });
+
+// Devices are kept in DATA_DIR/devices.log. Check-ins are batched and
+// written every DEVICE_FLUSH_INTERVAL ms, and whatever is pending is
+// written on shutdown.
+const registry = new DeviceRegistry({
+    file: path.join(DATA_DIR, 'devices.log'),
+    flushInterval: Number(process.env.DEVICE_FLUSH_INTERVAL) || 1000
+});
+registry.start();
+for (const signal of ['SIGINT', 'SIGTERM']) {
+    process.once(signal, () => {
+        registry.flushSync();
+        process.exit(0);
+    });
+}
+
+// Served at GET /metrics. Request-path metrics are updated as requests
+// complete; the rest are read from their modules at scrape time.
+const metrics = new MetricsRegistry();
+const OTA_ACTIONS = ['check_update', 'download_update', 'download_chunk'];
+const otaDuration = metrics.histogram('ota_request_duration_seconds',
+    'Time to answer device requests: POST /ota by action, GET /c as check_conditional, GET /firmware as firmware',
+    ['action']);
+const bytesServed = metrics.counter('ota_artifact_bytes_served_total',
+    'Artifact bytes sent to devices', ['artifact', 'compression', 'encoding']);
+metrics.gauge('ota_downloads_in_flight', 'Devices holding a download lease',
+    [], () => rollout.stats().in_flight);
+metrics.counter('ota_downloads_deferred_total', 'Downloads refused for lack of a download slot',
+    [], () => rollout.deferred);
+metrics.counter('ota_egress_throttled_total', 'Downloads refused by the egress limit',
+    [], () => rollout.throttled);
+metrics.counter('ota_store_cache_hits_total', 'Artifact reads served from the cache',
+    [], () => store.hits);
+metrics.counter('ota_store_cache_misses_total', 'Artifact reads that went to disk',
+    [], () => store.misses);
+metrics.gauge('ota_store_cache_bytes', 'Bytes held in the artifact cache',
+    [], () => store.cachedBytes);
+metrics.gauge('ota_devices', 'Known devices by current version',
+    ['version'], () => registry.versionCounts().map(([version, count]) => [{ version }, count]));
+metrics.gauge('ota_releases', 'Available releases', [], () => availableUpdates.size);
+
+// Observe the time until the response to a device request has been sent
+function timeRequest(res, action) {
+    const started = process.hrtime.bigint();
+    res.on('finish', () => {
+        otaDuration.observe({ action }, Number(process.hrtime.bigint() - started) / 1e9);
     });
+}
+
+// Log a per-request line, see LOG_LEVEL
+function logRequest(...args) {
+    if (LOG_REQUESTS && Math.random() < LOG_SAMPLE) {
+        console.log(...args);
+    }
+}
+
+// Page size of GET /devices, and the most one page may hold
+const DEVICE_PAGE_SIZE = 100;
+const MAX_DEVICE_PAGE_SIZE = 1000;
+
+// Delta patch artifacts keyed by "from>to:format:path", built on first request
+const deltaCache = new Map();
+
+// Largest chunk a device may request in one download_chunk call
+const MAX_CHUNK_SIZE = 4096;
+const DEFAULT_CHUNK_SIZE = 1024;
+
+// Chunk transfer encodings in order of preference: raw bytes, base64, hex
+const TRANSFER_ENCODINGS = ['bin', 'b64', 'hex'];
+
+// Pick the cheapest encoding the device advertised, hex for old devices
+function pickEncoding(accepted) {
+    if (!Array.isArray(accepted)) {
+        return 'hex';
+    }
+    return TRANSFER_ENCODINGS.find(encoding => accepted.includes(encoding)) || 'hex';
+}
+
+// Send a chunk in the requested encoding. Without an encoding the chunk is
+// wrapped in JSON as hex, which is what devices predating encodings expect.
+function sendChunk(res, version, artifact, start, chunk, encoding) {
+    if (encoding === 'bin') {
+        res.type('application/octet-stream').send(chunk);
+    } else if (encoding === 'b64') {
+        res.type('text/plain').send(chunk.toString('base64'));
+    } else if (encoding === 'hex') {
+        res.type('text/plain').send(chunk.toString('hex'));
+    } else {
+        res.json({
+            success: true,
+            version: version,
+            offset: start,
+            length: chunk.length,
+            total_size: artifact.size,
+            sha256: artifact.sha256,
+            data: chunk.toString('hex')
+        });
+    }
+}
+
+// Artifacts are compressed with a small deflate window so the device only
+// needs a 1 KB history buffer to inflate them
+const COMPRESSION_WBITS = 10;
+
+// Store bytes to be transferred, returns their size and digest
+function makeArtifact(data, compression) {
+    const { sha256, size } = store.put(data);
+    return { compression, size, sha256 };
+}
+
+// Plain and, when it pays off, zlib-compressed artifacts for some bytes.
+// The compressed copy is built once per content.
+function buildArtifacts(data) {
+    const artifacts = { none: makeArtifact(data, 'none') };
+    
+    const compressed = store.derive(`zlib:${COMPRESSION_WBITS}:${artifacts.none.sha256}`,
+        () => zlib.deflateSync(data, { level: 9, windowBits: COMPRESSION_WBITS }));
+    const size = store.size(compressed);
+    if (size < data.length) {
+        artifacts.zlib = { compression: 'zlib', size, sha256: compressed };
+    }
+    return artifacts;
+}
+
+// Cross-compile source to .mpy bytecode, null if mpy-cross is unavailable
+// or the source does not compile
+function compileMpy(version, filePath, code) {
+    const dir = fs.mkdtempSync(path.join(os.tmpdir(), 'ota-mpy-'));
+    try {
+        const source = path.join(dir, path.basename(filePath));
+        const output = path.join(dir, 'out.mpy');
+        fs.writeFileSync(source, code);
+        
+        const result = spawnSync(MPY_CROSS, ['-o', output, source], { encoding: 'utf8' });
+        if (result.error || result.status !== 0) {
+            console.log(`No .mpy build of ${filePath} for ${version}:`,
+                result.error ? result.error.message : result.stderr.trim());
+            return null;
+        }
+        return fs.readFileSync(output);
+    } finally {
+        fs.rmSync(dir, { recursive: true, force: true });
+    }
+}
+
+// Every release has this file; the device's boot stub imports it
+const ENTRY_FILE = 'app.py';
+
+// Release file paths are relative to the device's slot directory
+function isValidFilePath(filePath) {
+    return typeof filePath === 'string' && filePath.length > 0 && !filePath.startsWith('/') &&
+        filePath.split('/').every(part => part && part !== '.' && part !== '..');
+}
+
+// Build a release record from its files ({ path: contents }). Each install
+// format (source or precompiled bytecode) lists the release's files with
+// their own transfer artifacts. The bytecode format is only offered when
+// every .py file compiles.
+function createRelease(version, description, files) {
+    const formats = { py: [], mpy: [] };
+    let mpyVersion = null;
+    
+    for (const [filePath, content] of Object.entries(files)) {
+        const artifacts = buildArtifacts(Buffer.from(content, 'utf8'));
+        formats.py.push({ path: filePath, artifacts });
+        
+        if (!formats.mpy) {
+            continue;
+        }
+        if (!filePath.endsWith('.py')) {
+            formats.mpy.push({ path: filePath, artifacts });
+            continue;
+        }
+        // The file name is compiled into the bytecode, so it is part of the key
+        const compiled = store.derive(`mpy:${artifacts.none.sha256}:${path.basename(filePath)}`,
+            () => compileMpy(version, filePath, content));
+        if (compiled) {
+            const mpy = store.get(compiled);
+            formats.mpy.push({ path: filePath.slice(0, -3) + '.mpy', artifacts: buildArtifacts(mpy) });
+            mpyVersion = mpy[1];  // .mpy header: 'M', bytecode version, ...
+        } else {
+            delete formats.mpy;
+        }
+    }
+    
+    const entry = findFile(formats.py, ENTRY_FILE).artifacts.none;
+    return {
+        version,
+        description,
+        size: entry.size,
+        sha256: entry.sha256,
+        formats,
+        mpy_version: formats.mpy ? mpyVersion : null,
+        rollout: DEFAULT_ROLLOUT
+    };
+}
+
+// Build a single-file release from source code
+function createUpdate(version, description, code) {
+    return createRelease(version, description, { [ENTRY_FILE]: code });
+}
+
+// Look up a file of one install format by its path
+function findFile(files, filePath) {
+    return files && files.find(file => file.path === filePath);
+}
+
+// Path of the entry file in an install format
+function entryPath(format) {
+    return format === 'mpy' ? 'app.mpy' : ENTRY_FILE;
+}
+
+// Precompiled bytecode when the device can load our mpy-cross output, else source
+function pickFormat(updateInfo, formats, mpyVersion) {
+    if (Array.isArray(formats) && formats.includes('mpy') && updateInfo.formats.mpy &&
+        updateInfo.mpy_version === mpyVersion) {
+        return 'mpy';
+    }
+    return 'py';
+}
+
+// Pick the smallest artifact the device can decompress
+function selectArtifact(artifacts, compression) {
+    if (Array.isArray(compression) && compression.includes('zlib') && artifacts.zlib) {
+        return artifacts.zlib;
+    }
+    return artifacts.none;
+}
+
+// Get (building and caching on first use) the patch artifacts of one file
+// between two versions
+function getDelta(fromVersion, toVersion, format, filePath) {
+    const key = `${fromVersion}>${toVersion}:${format}:${filePath}`;
+    if (deltaCache.has(key)) {
+        return deltaCache.get(key);
+    }
+    
+    const fromUpdate = availableUpdates.get(fromVersion);
+    const toUpdate = availableUpdates.get(toVersion);
+    const fromFile = fromUpdate && findFile(fromUpdate.formats[format], filePath);
+    const toFile = toUpdate && findFile(toUpdate.formats[format], filePath);
+    if (!fromFile || !toFile) {
+        return null;
+    }
+    const from = fromFile.artifacts.none;
+    const to = toFile.artifacts.none;
     
-    availableUpdates.set('3.0.0', {
-        version: '3.0.0',
-        description: 'Slow pulse pattern test',
-        code: testCode2,
-        hex_code: Buffer.from(testCode2).toString('hex')
+    // Patches depend only on the two contents, so one is built per pair
+    // and reused by every release pair that shares them
+    const patch = store.derive(`delta:${from.sha256}:${to.sha256}`, () => {
+        const source = store.get(from.sha256);
+        const target = store.get(to.sha256);
+        const data = createDelta(source, target);
+        if (!applyDelta(source, data).equals(target)) {
+            throw new Error(`Delta ${key} does not reproduce the target`);
+        }
+        return data;
     });
+    const delta = buildArtifacts(store.get(patch));
+    delta.base_sha256 = from.sha256;
+    deltaCache.set(key, delta);
+    return delta;
+}
+
+// Artifact of one release file in a format and compression, or of its
+// patch from deltaFrom; null if there is none
+function findArtifact(version, format, filePath, deltaFrom, compression) {
+    const updateInfo = availableUpdates.get(version);
+    const installFormat = format || 'py';
+    const target = filePath || entryPath(installFormat);
+    const file = updateInfo && findFile(updateInfo.formats[installFormat], target);
+    const artifacts = deltaFrom ? getDelta(deltaFrom, version, installFormat, target)
+        : file && file.artifacts;
+    return (artifacts && artifacts[compression || 'none']) || null;
+}
+
+// Where GET /firmware serves an artifact
+function firmwareUrl(version, format, filePath, compression, deltaFrom) {
+    let url = `/firmware/${encodeURIComponent(version)}?format=${format}` +
+        `&path=${encodeURIComponent(filePath)}&compression=${compression}`;
+    if (deltaFrom) {
+        url += `&from=${encodeURIComponent(deltaFrom)}`;
+    }
+    return url;
+}
+
+// Describe one release file for a device: its installed size and digest,
+// the artifact to transfer and, if smaller, a patch against the same file
+// in the device's current version
+function describeFile(file, currentVersion, newVersion, format, compression, delta) {
+    const artifact = selectArtifact(file.artifacts, compression);
+    const entry = {
+        path: file.path,
+        size: file.artifacts.none.size,
+        sha256: file.artifacts.none.sha256,
+        transfer: {
+            size: artifact.size,
+            sha256: artifact.sha256,
+            compression: artifact.compression,
+            url: firmwareUrl(newVersion, format, file.path, artifact.compression)
+        }
+    };
     
-    console.log('Initialized with', availableUpdates.size, 'available updates');
+    const patches = delta ? getDelta(currentVersion, newVersion, format, file.path) : null;
+    if (patches) {
+        const patch = selectArtifact(patches, compression);
+        if (patch.size < artifact.size) {
+            entry.patch = {
+                from: currentVersion,
+                size: patch.size,
+                sha256: patch.sha256,
+                compression: patch.compression,
+                base_sha256: patches.base_sha256,
+                url: firmwareUrl(newVersion, format, file.path, patch.compression, currentVersion)
+            };
+        }
+    }
+    return entry;
+}
+
+// Drop cached patches that start or end at a version
+function invalidateDeltas(version) {
+    for (const key of deltaCache.keys()) {
+        const [fromVersion, toVersion] = key.split(':')[0].split('>');
+        if (fromVersion === version || toVersion === version) {
+            deltaCache.delete(key);
+        }
+    }
 }
 
-// Helper function to get next version
-function getNextVersion(currentVersion) {
-    const versions = Array.from(availableUpdates.keys()).sort();
-    const currentIndex = versions.indexOf(currentVersion);
+// Load the saved releases, or the test updates when there are none yet
+function initializeUpdates() {
+    loadReleases();
     
-    if (currentIndex === -1) {
-        // Current version not found, return first available
-        return versions[0];
+    if (availableUpdates.size === 0) {
+        // Load test blink codes
+        const testCode1 = fs.readFileSync(path.join(__dirname, 'test_blink_1.py'), 'utf8');
+        const testCode2 = fs.readFileSync(path.join(__dirname, 'test_blink_2.py'), 'utf8');
+        
+        addRelease(createUpdate('2.0.0', 'Fast blink pattern test', testCode1));
+        addRelease(createUpdate('3.0.0', 'Slow pulse pattern test', testCode2));
     }
+    collectGarbage();
     
-    if (currentIndex < versions.length - 1) {
-        // Return next version
-        return versions[currentIndex + 1];
+    console.log('Initialized with', availableUpdates.size, 'available updates');
+}
+
+function releaseFile(version) {
+    return path.join(RELEASES_DIR, `${version}.json`);
+}
+
+function saveRelease(release) {
+    writeAtomic(releaseFile(release.version), JSON.stringify(release));
+}
+
+// Index the release records saved in RELEASES_DIR. Records whose artifacts
+// are missing from the store are skipped.
+function loadReleases() {
+    for (const name of fs.readdirSync(RELEASES_DIR)) {
+        if (!name.endsWith('.json')) {
+            continue;
+        }
+        try {
+            const release = JSON.parse(fs.readFileSync(path.join(RELEASES_DIR, name), 'utf8'));
+            const digests = Object.values(release.formats).flat()
+                .flatMap(file => Object.values(file.artifacts).map(artifact => artifact.sha256));
+            if (!digests.every(digest => store.has(digest))) {
+                console.log(`Skipping release ${release.version}: artifacts missing`);
+                continue;
+            }
+            addRelease(release, false);
+        } catch (error) {
+            console.error(`Cannot load release ${name}:`, error.message);
+        }
+    }
+}
+
+// Parse "MAJOR.MINOR.PATCH[-PRERELEASE][+BUILD]", null if it is not semver
+function parseVersion(version) {
+    const match = /^v?(\d+)\.(\d+)\.(\d+)(?:-([0-9A-Za-z.-]+))?(?:\+[0-9A-Za-z.-]+)?$/.exec(version || '');
+    if (!match) {
+        return null;
+    }
+    return {
+        core: [Number(match[1]), Number(match[2]), Number(match[3])],
+        pre: match[4] ? match[4].split('.') : []
+    };
+}
+
+// Semver precedence; versions that do not parse sort before all others
+function compareVersions(a, b) {
+    const va = parseVersion(a);
+    const vb = parseVersion(b);
+    if (!va || !vb) {
+        return (va ? 1 : 0) - (vb ? 1 : 0);
+    }
+    for (let i = 0; i < 3; i++) {
+        if (va.core[i] !== vb.core[i]) {
+            return va.core[i] - vb.core[i];
+        }
+    }
+    // A pre-release sorts before its release
+    if (!va.pre.length || !vb.pre.length) {
+        return vb.pre.length - va.pre.length;
+    }
+    for (let i = 0; i < Math.min(va.pre.length, vb.pre.length); i++) {
+        const x = va.pre[i];
+        const y = vb.pre[i];
+        if (x === y) {
+            continue;
+        }
+        const xNum = /^\d+$/.test(x);
+        const yNum = /^\d+$/.test(y);
+        if (xNum && yNum) {
+            return Number(x) - Number(y);
+        }
+        if (xNum !== yNum) {
+            return xNum ? -1 : 1;
+        }
+        return x < y ? -1 : 1;
+    }
+    return va.pre.length - vb.pre.length;
+}
+
+// Index of the first release in releaseIndex newer than version
+function firstNewerRelease(version) {
+    let lo = 0;
+    let hi = releaseIndex.length;
+    while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (compareVersions(releaseIndex[mid], version) <= 0) {
+            lo = mid + 1;
+        } else {
+            hi = mid;
+        }
+    }
+    return lo;
+}
+
+// Store a release and index it, replacing any release with the same version
+function addRelease(release, persist = true) {
+    if (!availableUpdates.has(release.version)) {
+        releaseIndex.splice(firstNewerRelease(release.version), 0, release.version);
+    }
+    availableUpdates.set(release.version, release);
+    invalidateDeltas(release.version);
+    if (persist) {
+        saveRelease(release);
+    }
+}
+
+function removeRelease(version) {
+    if (!availableUpdates.delete(version)) {
+        return false;
     }
+    releaseIndex.splice(releaseIndex.indexOf(version), 1);
+    invalidateDeltas(version);
+    fs.rmSync(releaseFile(version), { force: true });
+    collectGarbage();
+    return true;
+}
+
+// Delete what no release needs any more from the store: the files of
+// removed releases and everything derived from them. Live are the
+// releases' artifacts, their zlib and .mpy builds, and the patches from
+// each release to every newer one with their zlib copies.
+function collectGarbage() {
+    const keys = [];
+    const digests = [];
+    releaseIndex.forEach((version, i) => {
+        const release = availableUpdates.get(version);
+        for (const [format, files] of Object.entries(release.formats)) {
+            for (const file of files) {
+                const source = file.artifacts.none.sha256;
+                digests.push(...Object.values(file.artifacts).map(artifact => artifact.sha256));
+                keys.push(`zlib:${COMPRESSION_WBITS}:${source}`);
+                if (format === 'py' && file.path.endsWith('.py')) {
+                    keys.push(`mpy:${source}:${path.basename(file.path)}`);
+                }
+                for (const fromVersion of releaseIndex.slice(0, i)) {
+                    const from = findFile(availableUpdates.get(fromVersion).formats[format], file.path);
+                    if (!from) {
+                        continue;
+                    }
+                    const key = `delta:${from.artifacts.none.sha256}:${source}`;
+                    const patch = store.lookup(key);
+                    keys.push(key);
+                    if (patch) {
+                        keys.push(`zlib:${COMPRESSION_WBITS}:${patch}`);
+                    }
+                }
+            }
+        }
+    });
     
-    // Already at latest version
+    const removed = store.sweep(keys, digests);
+    if (removed.objects || removed.refs) {
+        console.log(`Removed ${removed.objects} unused objects (${removed.bytes} bytes) and ${removed.refs} refs`);
+    }
+}
+
+// True if the release's rollout percentage covers the device's cohort
+function inRollout(version, deviceId) {
+    return rollout.inCohort(deviceId, availableUpdates.get(version).rollout);
+}
+
+// Release a device on currentVersion should install, null if it is up to
+// date or outside the rollout of the release it would get. Under the
+// "latest" policy this is the newest release the device's cohort is in,
+// found by walking down from the top of the index.
+function getNextVersion(currentVersion, deviceId) {
+    const index = firstNewerRelease(currentVersion);
+    if (index >= releaseIndex.length) {
+        return null;
+    }
+    if (UPDATE_POLICY === 'next') {
+        return inRollout(releaseIndex[index], deviceId) ? releaseIndex[index] : null;
+    }
+    for (let i = releaseIndex.length - 1; i >= index; i--) {
+        if (inRollout(releaseIndex[i], deviceId)) {
+            return releaseIndex[i];
+        }
+    }
     return null;
 }
 
-// Helper function to convert string to hex
-function stringToHex(str) {
-    return Buffer.from(str, 'utf8').toString('hex');
+// Count an update check towards the current check rate
+function recordCheck() {
+    const now = Date.now();
+    if (now - checkWindowStart >= CHECK_RATE_WINDOW) {
+        checkRate = checksInWindow * 1000 / (now - checkWindowStart);
+        checkWindowStart = now;
+        checksInWindow = 0;
+    }
+    checksInWindow++;
+}
+
+// Seconds a device should wait before its next check. A device with an
+// update to fetch keeps the default; everyone else is spread out while
+// the server sees more checks than it wants.
+function nextCheckHint(updateAvailable) {
+    if (updateAvailable) {
+        return CHECK_INTERVAL;
+    }
+    const elapsed = Math.max(Date.now() - checkWindowStart, 1000);
+    const rate = Math.max(checkRate, checksInWindow * 1000 / elapsed);
+    if (rate <= TARGET_CHECK_RATE) {
+        return CHECK_INTERVAL;
+    }
+    return Math.min(MAX_CHECK_INTERVAL, Math.ceil(CHECK_INTERVAL * rate / TARGET_CHECK_RATE));
+}
+
+// Stream bytes [start, end) of a stored object, all of it by default, as
+// the response body
+function sendObject(res, digest, start = 0, end = store.size(digest)) {
+    res.set('Content-Length', String(end - start));
+    if (end <= start) {
+        return res.end();
+    }
+    store.createReadStream(digest, { start, end: end - 1 })
+        .on('error', error => {
+            console.error('Object read failed:', error.message);
+            res.destroy(error);
+        })
+        .pipe(res);
 }
 
-// Helper function to convert hex to string
-function hexToString(hex) {
-    return Buffer.from(hex, 'hex').toString('utf8');
+// Byte range of a "Range: bytes=..." header as { start, end } with end
+// exclusive; undefined without a header (or one we do not support, which
+// gets the whole body), null if the range is unsatisfiable
+function parseRange(header, size) {
+    const match = /^bytes=(\d*)-(\d*)$/.exec(header || '');
+    if (!match || (!match[1] && !match[2])) {
+        return undefined;
+    }
+    let start;
+    let end;
+    if (!match[1]) {
+        // Suffix range: the last N bytes
+        start = Math.max(size - Number(match[2]), 0);
+        end = size;
+    } else {
+        start = Number(match[1]);
+        end = match[2] ? Math.min(Number(match[2]) + 1, size) : size;
+    }
+    if (start >= size || end <= start) {
+        return null;
+    }
+    return { start, end };
 }
 
 // Main OTA endpoint
 app.post('/ota', (req, res) => {
     try {
-        const { device_id, current_version, action } = req.body;
+        const {
+            device_id, current_version, action,
+            version, offset, length, encoding, encodings, compression,
+            delta, delta_from, formats, mpy_version, format, path: filePath
+        } = req.body;
         
-        console.log(`OTA request from ${device_id}: ${action} (current: ${current_version})`);
+        logRequest(`OTA request from ${device_id}: ${action} (current: ${current_version})`);
+        timeRequest(res, OTA_ACTIONS.includes(action) ? action : 'invalid');
         
         // Update device info
-        devices.set(device_id, {
-            device_id,
-            current_version,
-            last_seen: new Date(),
-            ip: req.ip
-        });
+        registry.seen(device_id, { current_version, ip: req.ip });
         
         if (action === 'check_update') {
             // Check if update is available
-            const nextVersion = getNextVersion(current_version);
+            recordCheck();
+            rollout.reportVersion(device_id, current_version);
+            const nextVersion = getNextVersion(current_version, device_id);
+            const retryAfter = nextVersion ? rollout.admit(device_id, nextVersion) : 0;
             
-            if (nextVersion) {
-                const updateInfo = availableUpdates.get(nextVersion);
+            if (retryAfter) {
                 res.json({
+                    update_available: false,
+                    deferred: true,
+                    message: 'Rollout limit reached, retry later',
+                    current_version: current_version,
+                    retry_after: retryAfter,
+                    next_check: retryAfter
+                });
+                logRequest(`Update for ${device_id} deferred by ${retryAfter}s`);
+            } else if (nextVersion) {
+                const updateInfo = availableUpdates.get(nextVersion);
+                const installFormat = pickFormat(updateInfo, formats, mpy_version);
+                const files = updateInfo.formats[installFormat].map(file =>
+                    describeFile(file, current_version, nextVersion, installFormat, compression, delta));
+                
+                // The top-level size/sha256/patch fields describe the entry
+                // file for firmware that predates multi-file releases
+                const entry = files.find(file => file.path === entryPath(installFormat));
+                const reply = {
                     update_available: true,
                     new_version: nextVersion,
                     description: updateInfo.description,
-                    current_version: current_version
-                });
-                console.log(`Update available for ${device_id}: ${current_version} -> ${nextVersion}`);
+                    current_version: current_version,
+                    size: entry.transfer.size,
+                    sha256: entry.transfer.sha256,
+                    compression: entry.transfer.compression,
+                    url: entry.transfer.url,
+                    wbits: COMPRESSION_WBITS,
+                    format: installFormat,
+                    code_size: entry.size,
+                    code_sha256: entry.sha256,
+                    chunk_size: DEFAULT_CHUNK_SIZE,
+                    encoding: pickEncoding(encodings),
+                    files,
+                    next_check: nextCheckHint(true)
+                };
+                if (entry.patch) {
+                    reply.patch = entry.patch;
+                }
+                res.json(reply);
+                logRequest(`Update available for ${device_id}: ${current_version} -> ${nextVersion}`);
             } else {
                 res.json({
                     update_available: false,
                     message: 'Device is up to date',
-                    current_version: current_version
+                    current_version: current_version,
+                    next_check: nextCheckHint(false)
                 });
-                console.log(`No update available for ${device_id}`);
+                logRequest(`No update available for ${device_id}`);
             }
         } else if (action === 'download_update') {
             // Provide the update code
-            const nextVersion = getNextVersion(current_version);
+            const nextVersion = getNextVersion(current_version, device_id);
+            const retryAfter = nextVersion ? rollout.admit(device_id, nextVersion) : 0;
             
-            if (nextVersion) {
+            if (retryAfter) {
+                res.set('Retry-After', String(retryAfter)).status(429).json({
+                    success: false,
+                    error: 'Rollout limit reached',
+                    retry_after: retryAfter
+                });
+            } else if (nextVersion) {
+                // Metadata only; the code itself comes from GET /firmware
                 const updateInfo = availableUpdates.get(nextVersion);
                 res.json({
                     success: true,
                     version: nextVersion,
                     description: updateInfo.description,
-                    new_code: updateInfo.hex_code
+                    size: updateInfo.size,
+                    sha256: updateInfo.sha256,
+                    url: firmwareUrl(nextVersion, 'py', ENTRY_FILE, 'none')
                 });
-                console.log(`Sent update ${nextVersion} to ${device_id}`);
+                logRequest(`Sent update ${nextVersion} to ${device_id}`);
             } else {
                 res.json({
                     success: false,
                     error: 'No update available'
                 });
             }
+        } else if (action === 'download_chunk') {
+            // Provide one byte range of a specific version. Chunks are addressed
+            // by version rather than "next version" so an interrupted download
+            // can resume at any offset even if newer releases appear meanwhile.
+            const artifact = findArtifact(version, format, filePath, delta_from, compression);
+            
+            if (!artifact) {
+                return res.status(404).json({
+                    success: false,
+                    error: 'Update not found'
+                });
+            }
+            
+            const start = Number(offset);
+            const count = Math.min(Number(length) || DEFAULT_CHUNK_SIZE, MAX_CHUNK_SIZE);
+            if (!Number.isInteger(start) || start < 0 || start > artifact.size || count <= 0) {
+                return res.status(416).json({
+                    success: false,
+                    error: 'Invalid chunk range'
+                });
+            }
+            
+            const chunk = store.read(artifact.sha256, start, start + count);
+            const retryAfter = rollout.admit(device_id, version) || rollout.takeEgress(chunk.length);
+            if (retryAfter) {
+                return res.set('Retry-After', String(retryAfter)).status(429).json({
+                    success: false,
+                    error: 'Rollout limit reached',
+                    retry_after: retryAfter
+                });
+            }
+            bytesServed.inc({ artifact: delta_from ? 'delta' : format || 'py', compression: artifact.compression,
+                encoding: TRANSFER_ENCODINGS.includes(encoding) ? encoding : 'json' }, chunk.length);
+            sendChunk(res, version, artifact, start, chunk, encoding);
         } else {
             res.status(400).json({
                 success: false,
@@ -134,21 +900,44 @@ app.post('/ota', (req, res) => {
     }
 });
 
-// Get device status
+// Get device status, one page at a time in device id order. Query:
+// limit, cursor (next_cursor of the previous page), version (current
+// version), q (device id prefix) and active_within (seconds since the
+// device was last seen).
 app.get('/devices', (req, res) => {
-    const deviceList = Array.from(devices.values());
+    const { cursor, version, q } = req.query;
+    const limit = req.query.limit !== undefined ? parseInt(req.query.limit, 10) : DEVICE_PAGE_SIZE;
+    const activeWithin = req.query.active_within !== undefined ? Number(req.query.active_within) : undefined;
+    if (!(limit > 0) || (activeWithin !== undefined && !(activeWithin >= 0))) {
+        return res.status(400).json({
+            success: false,
+            error: 'Invalid limit or active_within'
+        });
+    }
+    
+    const page = registry.list({
+        cursor,
+        limit: Math.min(limit, MAX_DEVICE_PAGE_SIZE),
+        version,
+        prefix: q,
+        seenSince: activeWithin !== undefined ? new Date(Date.now() - activeWithin * 1000) : undefined
+    });
     res.json({
-        devices: deviceList,
-        total_devices: deviceList.length
+        devices: page.devices,
+        total_devices: registry.size,
+        next_cursor: page.next_cursor
     });
 });
 
 // Get available updates
 app.get('/updates', (req, res) => {
-    const updateList = Array.from(availableUpdates.values()).map(update => ({
+    const updateList = releaseIndex.map(version => availableUpdates.get(version)).map(update => ({
         version: update.version,
         description: update.description,
-        code_size: update.code.length
+        code_size: update.size,
+        files: update.formats.py.map(file => file.path),
+        formats: Object.keys(update.formats),
+        rollout: update.rollout
     }));
     res.json({
         updates: updateList,
@@ -159,21 +948,44 @@ app.get('/updates', (req, res) => {
 // Add new update (for testing)
 app.post('/updates', (req, res) => {
     try {
-        const { version, description, code } = req.body;
+        const { version, description, code, files, rollout: percent } = req.body;
         
-        if (!version || !description || !code) {
+        if (!version || !description || !(code || files)) {
             return res.status(400).json({
                 success: false,
-                error: 'Missing required fields: version, description, code'
+                error: 'Missing required fields: version, description, code or files'
             });
         }
         
-        availableUpdates.set(version, {
-            version,
-            description,
-            code,
-            hex_code: stringToHex(code)
-        });
+        const releaseFiles = files || { [ENTRY_FILE]: code };
+        const paths = Object.keys(releaseFiles);
+        if (!paths.includes(ENTRY_FILE) || !paths.every(isValidFilePath) ||
+            !Object.values(releaseFiles).every(content => typeof content === 'string')) {
+            return res.status(400).json({
+                success: false,
+                error: `files must map relative paths to text and include ${ENTRY_FILE}`
+            });
+        }
+        
+        if (!parseVersion(version)) {
+            return res.status(400).json({
+                success: false,
+                error: 'version must be a semantic version such as 1.2.3'
+            });
+        }
+        
+        if (percent !== undefined && !isValidRollout(percent)) {
+            return res.status(400).json({
+                success: false,
+                error: 'rollout must be a percentage from 0 to 100'
+            });
+        }
+        
+        const release = createRelease(version, description, releaseFiles);
+        if (percent !== undefined) {
+            release.rollout = percent;
+        }
+        addRelease(release);
         
         res.json({
             success: true,
@@ -190,12 +1002,42 @@ app.post('/updates', (req, res) => {
     }
 });
 
+function isValidRollout(percent) {
+    return typeof percent === 'number' && percent >= 0 && percent <= 100;
+}
+
+// Change the share of devices a release is offered to
+app.put('/updates/:version/rollout', (req, res) => {
+    const release = availableUpdates.get(req.params.version);
+    const { percent } = req.body;
+    
+    if (!release) {
+        return res.status(404).json({
+            success: false,
+            error: 'Update not found'
+        });
+    }
+    if (!isValidRollout(percent)) {
+        return res.status(400).json({
+            success: false,
+            error: 'percent must be a number from 0 to 100'
+        });
+    }
+    
+    release.rollout = percent;
+    saveRelease(release);
+    res.json({
+        success: true,
+        message: `Update ${release.version} rolled out to ${percent}% of devices`
+    });
+    console.log(`Rollout of ${release.version} set to ${percent}%`);
+});
+
 // Delete update
 app.delete('/updates/:version', (req, res) => {
     const version = req.params.version;
     
-    if (availableUpdates.has(version)) {
-        availableUpdates.delete(version);
+    if (removeRelease(version)) {
         res.json({
             success: true,
             message: `Update ${version} deleted successfully`
@@ -216,7 +1058,7 @@ app.get('/updates/:version/code', (req, res) => {
     
     if (update) {
         res.type('text/plain');
-        res.send(update.code);
+        sendObject(res, update.sha256);
     } else {
         res.status(404).json({
             success: false,
@@ -225,13 +1067,39 @@ app.get('/updates/:version/code', (req, res) => {
     }
 });
 
+// Get the precompiled bytecode of an update (for installing by hand or benchmarking)
+app.get('/updates/:version/mpy', (req, res) => {
+    const update = availableUpdates.get(req.params.version);
+    
+    if (update && update.formats.mpy) {
+        res.type('application/octet-stream');
+        sendObject(res, findFile(update.formats.mpy, entryPath('mpy')).artifacts.none.sha256);
+    } else {
+        res.status(404).json({
+            success: false,
+            error: 'No bytecode build for this update'
+        });
+    }
+});
+
+// Prometheus scrape endpoint
+app.get('/metrics', (req, res) => {
+    res.set('Content-Type', METRICS_CONTENT_TYPE).send(metrics.render());
+});
+
 // Health check endpoint
 app.get('/health', (req, res) => {
     res.json({
         status: 'OK',
         timestamp: new Date().toISOString(),
-        devices_connected: devices.size,
-        updates_available: availableUpdates.size
+        devices_connected: registry.size,
+        updates_available: availableUpdates.size,
+        update_policy: UPDATE_POLICY,
+        memory: process.memoryUsage(),
+        rollout: rollout.stats(),
+        store: store.stats(),
+        registry: registry.stats(),
+        coap: coap ? coap.stats() : null
     });
 });
 
@@ -277,6 +1145,7 @@ app.get('/', (req, res) => {
         <div class="section">
             <h2>Connected Devices</h2>
             <div id="devices-table"></div>
+            <button class="button" id="more-devices" onclick="loadDevices(nextCursor)" style="display: none">Load More</button>
         </div>
         
         <div class="section">
@@ -286,13 +1155,26 @@ app.get('/', (req, res) => {
     </div>
 
     <script>
-        function refreshData() {
-            fetch('/devices')
+        // Devices are fetched a page at a time; Load More appends the next page
+        let shownDevices = [];
+        let nextCursor = null;
+        
+        function loadDevices(cursor) {
+            fetch('/devices?limit=${DEVICE_PAGE_SIZE}' + (cursor ? '&cursor=' + encodeURIComponent(cursor) : ''))
                 .then(response => response.json())
                 .then(data => {
                     document.getElementById('device-count').textContent = data.total_devices;
-                    displayDevices(data.devices);
+                    shownDevices = cursor ? shownDevices.concat(data.devices) : data.devices;
+                    nextCursor = data.next_cursor;
+                    document.getElementById('more-devices').style.display = nextCursor ? '' : 'none';
+                    displayDevices(shownDevices);
                 });
+        }
+        
+        // Re-reads only the first page of devices, so a refresh costs the
+        // same however large the fleet is
+        function refreshData() {
+            loadDevices(null);
             
             fetch('/updates')
                 .then(response => response.json())
@@ -353,7 +1235,7 @@ app.get('/', (req, res) => {
 });
 
 // Start server
-app.listen(PORT, () => {
+const server = app.listen(PORT, () => {
     console.log(`OTA Server running on port ${PORT}`);
     console.log(`Web interface: http://localhost:${PORT}`);
     console.log(`Health check: http://localhost:${PORT}/health`);
@@ -361,3 +1243,14 @@ app.listen(PORT, () => {
     // Initialize with test updates
     initializeUpdates();
 });
+
+// CoAP devices reach /ota and /c through the stand-in endpoint
+const coap = COAP_PORT ? new CoapProxy({ port: COAP_PORT, httpPort: PORT }) : null;
+if (coap) {
+    coap.start();
+}
+
+// Devices keep one HTTP connection open across a check and the download
+// that follows it; keep idle connections around longer than Node's 5 s default
+server.keepAliveTimeout = KEEP_ALIVE_TIMEOUT;
+server.headersTimeout = KEEP_ALIVE_TIMEOUT + 1000;
@@ -0,0 +1,202 @@
+// Content-addressed artifact store
+//
+// Every artifact (release file, compressed copy, delta patch, .mpy build)
+// is a file under <dir>/objects named by the SHA-256 of its bytes, so
+// identical content is stored once however many releases share it.
+// Derived artifacts are memoized under <dir>/refs: the ref of a key such
+// as "zlib:10:<source sha>" holds the digest of the object built for it,
+// so each one is built once and survives restarts.
+//
+// Objects are read lazily. An LRU cache of at most cacheBytes keeps the
+// recently used ones in memory; objects larger than the cache are read
+// range by range from disk.
+//
+// Nothing is deleted as it goes; sweep() removes whatever the caller no
+// longer references.
+
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+
+function sha256(data) {
+    return crypto.createHash('sha256').update(data).digest('hex');
+}
+
+// Write a file under a temporary name and rename it into place, so readers
+// never see a partial file
+function writeAtomic(file, data) {
+    const tmp = `${file}.${process.pid}.tmp`;
+    fs.writeFileSync(tmp, data);
+    fs.renameSync(tmp, file);
+}
+
+class ArtifactStore {
+    constructor({ dir, cacheBytes = 64 * 1024 * 1024 }) {
+        this.objectsDir = path.join(dir, 'objects');
+        this.refsDir = path.join(dir, 'refs');
+        fs.mkdirSync(this.objectsDir, { recursive: true });
+        fs.mkdirSync(this.refsDir, { recursive: true });
+        this.cacheBytes = cacheBytes;
+        this.cache = new Map();  // digest -> Buffer, least recently used first
+        this.cachedBytes = 0;
+        this.hits = 0;
+        this.misses = 0;
+    }
+
+    objectPath(digest) {
+        if (!/^[0-9a-f]{64}$/.test(digest)) {
+            throw new Error(`Invalid object digest ${digest}`);
+        }
+        return path.join(this.objectsDir, digest);
+    }
+
+    has(digest) {
+        return fs.existsSync(this.objectPath(digest));
+    }
+
+    // Store bytes, returns { sha256, size }
+    put(data) {
+        const digest = sha256(data);
+        const file = this.objectPath(digest);
+        if (!fs.existsSync(file)) {
+            writeAtomic(file, data);
+        }
+        return { sha256: digest, size: data.length };
+    }
+
+    size(digest) {
+        return fs.statSync(this.objectPath(digest)).size;
+    }
+
+    remember(digest, data) {
+        if (data.length > this.cacheBytes) {
+            return;
+        }
+        this.cache.set(digest, data);
+        this.cachedBytes += data.length;
+        for (const [oldest, buf] of this.cache) {
+            if (this.cachedBytes <= this.cacheBytes) {
+                break;
+            }
+            this.cache.delete(oldest);
+            this.cachedBytes -= buf.length;
+        }
+    }
+
+    // Whole object, through the cache
+    get(digest) {
+        const cached = this.cache.get(digest);
+        if (cached) {
+            // Move to the most recently used end
+            this.cache.delete(digest);
+            this.cache.set(digest, cached);
+            this.hits++;
+            return cached;
+        }
+        this.misses++;
+        const data = fs.readFileSync(this.objectPath(digest));
+        this.remember(digest, data);
+        return data;
+    }
+
+    // Bytes [start, end) of an object
+    read(digest, start, end) {
+        const size = this.size(digest);
+        if (size <= this.cacheBytes) {
+            return this.get(digest).subarray(start, end);
+        }
+        end = Math.min(end, size);
+        const buf = Buffer.alloc(Math.max(end - start, 0));
+        const fd = fs.openSync(this.objectPath(digest), 'r');
+        try {
+            fs.readSync(fd, buf, 0, buf.length, start);
+        } finally {
+            fs.closeSync(fd);
+        }
+        return buf;
+    }
+
+    // options as for fs.createReadStream, e.g. { start, end } (inclusive)
+    createReadStream(digest, options) {
+        return fs.createReadStream(this.objectPath(digest), options);
+    }
+
+    refPath(key) {
+        return path.join(this.refsDir, sha256(key));
+    }
+
+    // Digest of the object derived under key, null if it has not been built
+    lookup(key) {
+        const ref = this.refPath(key);
+        if (fs.existsSync(ref)) {
+            const digest = fs.readFileSync(ref, 'utf8');
+            if (this.has(digest)) {
+                return digest;
+            }
+        }
+        return null;
+    }
+
+    // Digest of the object derived under key, building it with build() the
+    // first time. build may return null when there is nothing to store,
+    // which is not remembered.
+    derive(key, build) {
+        const ref = this.refPath(key);
+        const existing = this.lookup(key);
+        if (existing) {
+            return existing;
+        }
+        const data = build();
+        if (!data) {
+            return null;
+        }
+        const { sha256: digest } = this.put(data);
+        writeAtomic(ref, digest);
+        return digest;
+    }
+
+    // Delete every ref whose key is not in keys, and every object that is
+    // neither in digests nor pointed at by a remaining ref. Returns the
+    // number of objects and refs removed and the bytes freed.
+    sweep(keys, digests) {
+        const liveRefs = new Set(Array.from(keys, key => sha256(key)));
+        const liveObjects = new Set(digests);
+        const removed = { objects: 0, refs: 0, bytes: 0 };
+        for (const name of fs.readdirSync(this.refsDir)) {
+            const ref = path.join(this.refsDir, name);
+            if (liveRefs.has(name)) {
+                liveObjects.add(fs.readFileSync(ref, 'utf8'));
+            } else {
+                fs.rmSync(ref, { force: true });
+                removed.refs++;
+            }
+        }
+        for (const name of fs.readdirSync(this.objectsDir)) {
+            if (liveObjects.has(name)) {
+                continue;
+            }
+            const file = path.join(this.objectsDir, name);
+            removed.bytes += fs.statSync(file).size;
+            fs.rmSync(file, { force: true });
+            removed.objects++;
+            const cached = this.cache.get(name);
+            if (cached) {
+                this.cache.delete(name);
+                this.cachedBytes -= cached.length;
+            }
+        }
+        return removed;
+    }
+
+    stats() {
+        return {
+            cached_objects: this.cache.size,
+            cached_bytes: this.cachedBytes,
+            cache_limit_bytes: this.cacheBytes,
+            hits: this.hits,
+            misses: this.misses
+        };
+    }
+}
+
+module.exports = { ArtifactStore, writeAtomic };
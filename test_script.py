@@ -4,6 +4,9 @@ Test Script for OTA System
 Run this on your computer to test the server functionality
 """
 
+import base64
+import hashlib
+import re
 import requests
 import json
 import time
@@ -12,6 +15,21 @@ import time
 SERVER_URL = "http://localhost:3000"
 DEVICE_ID = "test_device_001"
 
+# Benchmark configuration: every image size is run with every encoding
+BENCH_SIZES = [1024, 10240, 51200, 204800]
+BENCH_ENCODINGS = ["bin", "b64", "hex"]
+BENCH_TRANSPORTS = ["http"]    # main.TRANSPORT values to compare, "coap" needs the CoAP endpoint
+BENCH_COAP_PORT = 5683
+BENCH_BASE_VERSION = "9.0.0"  # Version the emulated device runs
+BENCH_VERSION = "9.0.1"       # Version it updates to
+
+# Load test configuration
+LOAD_DEVICES = 100
+LOAD_DURATION = 60   # Seconds of load
+LOAD_INTERVAL = 60   # Seconds between a device's update checks, OTA_CHECK_INTERVAL in main.py
+LOAD_WORKERS = 32    # Concurrent HTTP connections
+LOAD_SCRAPE_INTERVAL = 5  # Seconds between /metrics scrapes with --scrape
+
 def test_health_check():
     """Test server health"""
     print("Testing server health...")
@@ -57,6 +75,104 @@ def test_check_update(current_version="1.0.0"):
         print(f"❌ Update check error: {e}")
         return None
 
+def version_key(version):
+    """Sort key that orders versions as semver, so 10.0.0 comes after 2.0.0
+    and 1.2.3-beta.1 before 1.2.3"""
+    core, _, pre = version.partition("-")
+    return tuple(int(part) for part in core.split(".")), not pre, pre
+
+def offered_version(current_version, device_id=DEVICE_ID):
+    """Version check_update offers a device on current_version, None if up to date"""
+    response = requests.post(f"{SERVER_URL}/ota", json={
+        "device_id": device_id,
+        "current_version": current_version,
+        "action": "check_update"
+    })
+    response.raise_for_status()
+    data = response.json()
+    return data["new_version"] if data.get("update_available") else None
+
+def expected_version(current_version, versions, policy):
+    """Version the update policy should pick from versions for current_version"""
+    newer = sorted((v for v in versions if version_key(v) > version_key(current_version)), key=version_key)
+    if not newer:
+        return None
+    return newer[-1] if policy == "latest" else newer[0]
+
+def check_offers(current_versions, versions, policy):
+    """Compare the offers for each current version with the policy, True if all match"""
+    ok = True
+    for current_version in current_versions:
+        expected = expected_version(current_version, versions, policy)
+        offered = offered_version(current_version)
+        if offered == expected:
+            print(f"✅ {current_version} -> {offered or 'up to date'}")
+        else:
+            print(f"❌ {current_version} -> {offered or 'up to date'}, expected {expected or 'up to date'}")
+            ok = False
+    return ok
+
+def test_update_policy():
+    """Test that check_update picks the release the server's update policy asks for"""
+    print("\nTesting update policy...")
+    try:
+        policy = requests.get(f"{SERVER_URL}/health").json()["update_policy"]
+        versions = [update["version"] for update in requests.get(f"{SERVER_URL}/updates").json()["updates"]]
+        print(f"   Policy: {policy}")
+        return check_offers(["1.0.0"] + versions, versions, policy)
+    except Exception as e:
+        print(f"❌ Update policy error: {e}")
+        return False
+
+def test_semver_ordering():
+    """Test that 10.0.0 counts as newer than 2.0.0, which a string comparison gets wrong"""
+    print("\nTesting semver ordering...")
+    try:
+        response = requests.post(f"{SERVER_URL}/updates", json={
+            "version": "10.0.0",
+            "description": "Semver ordering test",
+            "code": 'VERSION = "10.0.0"\n'
+        })
+        if response.status_code != 200:
+            print(f"❌ Adding 10.0.0 failed: {response.status_code}")
+            return False
+        try:
+            policy = requests.get(f"{SERVER_URL}/health").json()["update_policy"]
+            versions = [update["version"] for update in requests.get(f"{SERVER_URL}/updates").json()["updates"]]
+            return check_offers(["2.0.0", "10.0.0"], versions, policy)
+        finally:
+            requests.delete(f"{SERVER_URL}/updates/10.0.0")
+    except Exception as e:
+        print(f"❌ Semver ordering error: {e}")
+        return False
+
+def test_conditional_check():
+    """Test GET /c: 304 or "N <seconds>" when up to date, "U <version>" otherwise"""
+    print("\nTesting conditional update check...")
+    try:
+        policy = requests.get(f"{SERVER_URL}/health").json()["update_policy"]
+        versions = [update["version"] for update in requests.get(f"{SERVER_URL}/updates").json()["updates"]]
+        newest = max(versions, key=version_key)
+        
+        response = requests.get(f"{SERVER_URL}/c/{newest}", params={"d": DEVICE_ID})
+        up_to_date = response.status_code == 304 or (
+            response.status_code == 200 and re.fullmatch(r"N \d+\n", response.text))
+        if not up_to_date:
+            print(f"❌ /c/{newest}: {response.status_code} {response.text!r}, expected 304 or N")
+            return False
+        print(f"✅ /c/{newest}: {response.status_code} {response.text.strip() or '(no body)'}")
+        
+        expected = expected_version("1.0.0", versions, policy)
+        response = requests.get(f"{SERVER_URL}/c/1.0.0", params={"d": DEVICE_ID})
+        if response.status_code != 200 or response.text != f"U {expected}\n":
+            print(f"❌ /c/1.0.0: {response.status_code} {response.text!r}, expected U {expected}")
+            return False
+        print(f"✅ /c/1.0.0: {response.text.strip()}")
+        return True
+    except Exception as e:
+        print(f"❌ Conditional check error: {e}")
+        return False
+
 def test_download_update():
     """Test update download"""
     print("\nTesting update download...")
@@ -70,9 +186,15 @@ def test_download_update():
         if response.status_code == 200:
             data = response.json()
             if data.get("success"):
+                # The reply only describes the update; the code is at its URL
+                code = requests.get(SERVER_URL + data["url"])
+                digest = hashlib.sha256(code.content).hexdigest()
+                if code.status_code != 200 or digest != data["sha256"]:
+                    print(f"❌ Firmware download failed: {code.status_code}")
+                    return None
                 print(f"✅ Update downloaded: {data['version']}")
                 print(f"   Description: {data['description']}")
-                print(f"   Code size: {len(data['new_code']) // 2} bytes")
+                print(f"   Code size: {len(code.content)} bytes, sha256 {digest[:12]}")
                 return data
             else:
                 print(f"❌ Download failed: {data.get('error')}")
@@ -84,6 +206,125 @@ def test_download_update():
         print(f"❌ Download error: {e}")
         return None
 
+def test_firmware_download():
+    """Test GET /firmware: digest headers, byte ranges and unsatisfiable ranges"""
+    print("\nTesting firmware download...")
+    try:
+        response = requests.post(f"{SERVER_URL}/ota", json={
+            "device_id": DEVICE_ID,
+            "current_version": "1.0.0",
+            "action": "check_update"
+        })
+        data = response.json()
+        if not data.get("update_available"):
+            print("❌ No update to download from 1.0.0")
+            return False
+        url = SERVER_URL + data["url"]
+        
+        full = requests.get(url)
+        digest = hashlib.sha256(full.content)
+        if (full.status_code != 200 or digest.hexdigest() != data["sha256"]
+                or full.headers.get("ETag") != f'"{digest.hexdigest()}"'
+                or full.headers.get("Digest") != "sha-256=" + base64.b64encode(digest.digest()).decode()):
+            print(f"❌ Full download: {full.status_code}, ETag {full.headers.get('ETag')}, "
+                  f"Digest {full.headers.get('Digest')}")
+            return False
+        print(f"✅ Full download: {len(full.content)} bytes, Digest and ETag match")
+        
+        size = len(full.content)
+        first, last = size // 4, size // 2
+        part = requests.get(url, headers={"Range": f"bytes={first}-{last}"})
+        if (part.status_code != 206 or part.content != full.content[first:last + 1]
+                or part.headers.get("Content-Range") != f"bytes {first}-{last}/{size}"):
+            print(f"❌ Range download: {part.status_code}, Content-Range {part.headers.get('Content-Range')}")
+            return False
+        print(f"✅ Range download: {part.headers['Content-Range']}")
+        
+        beyond = requests.get(url, headers={"Range": f"bytes={size}-{size + 100}"})
+        if beyond.status_code != 416 or beyond.headers.get("Content-Range") != f"bytes */{size}":
+            print(f"❌ Unsatisfiable range: {beyond.status_code}, expected 416")
+            return False
+        print(f"✅ Unsatisfiable range: 416, Content-Range {beyond.headers['Content-Range']}")
+        return True
+    except Exception as e:
+        print(f"❌ Firmware download error: {e}")
+        return False
+
+def test_metrics():
+    """Test that /metrics exposes the OTA metrics and counts a check_update"""
+    print("\nTesting metrics...")
+    try:
+        checks = ("ota_request_duration_seconds_count", (("action", "check_update"),))
+        before = parse_metrics(requests.get(f"{SERVER_URL}/metrics").text)
+        offered_version("1.0.0")
+        response = requests.get(f"{SERVER_URL}/metrics")
+        after = parse_metrics(response.text)
+        
+        if not response.headers.get("Content-Type", "").startswith("text/plain"):
+            print(f"❌ Content-Type {response.headers.get('Content-Type')}")
+            return False
+        names = {name for name, _ in after}
+        missing = [name for name in ("ota_request_duration_seconds_bucket", "ota_artifact_bytes_served_total",
+                                     "ota_downloads_in_flight", "ota_store_cache_hits_total",
+                                     "ota_devices", "ota_releases") if name not in names]
+        if missing:
+            print(f"❌ Missing metrics: {', '.join(missing)}")
+            return False
+        if after[checks] != before.get(checks, 0) + 1:
+            print(f"❌ check_update count went from {before.get(checks, 0):g} to {after[checks]:g}")
+            return False
+        releases = requests.get(f"{SERVER_URL}/updates").json()["total_updates"]
+        if after[("ota_releases", ())] != releases:
+            print(f"❌ ota_releases is {after[('ota_releases', ())]:g}, server has {releases}")
+            return False
+        print(f"✅ {len(after)} samples, check_update counted")
+        return True
+    except Exception as e:
+        print(f"❌ Metrics error: {e}")
+        return False
+
+def cohort_of(device_id):
+    """Rollout cohort (0-99) of a device, as cohortOf() in rollout.js"""
+    return int.from_bytes(hashlib.md5(device_id.encode()).digest()[:4], "big") % 100
+
+def test_rollout(devices=20):
+    """Test that the rollout percentage decides which devices are offered a release"""
+    print("\nTesting rollout percentage...")
+    try:
+        versions = [update["version"] for update in requests.get(f"{SERVER_URL}/updates").json()["updates"]]
+        current_version = max(versions, key=version_key)
+        response = requests.post(f"{SERVER_URL}/updates", json={
+            "version": "11.0.0",
+            "description": "Rollout test",
+            "code": 'VERSION = "11.0.0"\n'
+        })
+        if response.status_code != 200:
+            print(f"❌ Adding 11.0.0 failed: {response.status_code}")
+            return False
+        try:
+            response = requests.put(f"{SERVER_URL}/updates/11.0.0/rollout", json={"percent": 150})
+            if response.status_code != 400:
+                print(f"❌ Rollout of 150% accepted: {response.status_code}")
+                return False
+            for percent in (0, 50, 100):
+                requests.put(f"{SERVER_URL}/updates/11.0.0/rollout", json={"percent": percent}).raise_for_status()
+                offered = 0
+                for i in range(devices):
+                    device_id = f"rollout_test_{i:03d}"
+                    expected = "11.0.0" if cohort_of(device_id) < percent else None
+                    version = offered_version(current_version, device_id)
+                    if version != expected:
+                        print(f"❌ {percent}%: {device_id} (cohort {cohort_of(device_id)}) offered {version}")
+                        return False
+                    offered += version is not None
+                print(f"✅ {percent}%: {offered}/{devices} devices offered 11.0.0")
+            return True
+        finally:
+            requests.delete(f"{SERVER_URL}/updates/11.0.0")
+    except Exception as e:
+        print(f"❌ Rollout error: {e}")
+        return False
+
 def test_get_devices():
     """Test getting device list"""
     print("\nTesting device list...")
@@ -102,6 +343,37 @@ def test_get_devices():
         print(f"❌ Device list error: {e}")
         return None
 
+def test_device_pages(devices=25, limit=7):
+    """Test walking /devices page by page with the cursor"""
+    print("\nTesting device pagination...")
+    try:
+        for i in range(devices):
+            requests.get(f"{SERVER_URL}/c/1.0.0", params={"d": f"page_test_{i:03d}"})
+        
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": limit}
+            if cursor:
+                params["cursor"] = cursor
+            data = requests.get(f"{SERVER_URL}/devices", params=params).json()
+            if len(data["devices"]) > limit:
+                print(f"❌ Page of {len(data['devices'])} devices, limit {limit}")
+                return False
+            seen.extend(device["device_id"] for device in data["devices"])
+            cursor = data["next_cursor"]
+            if not cursor:
+                break
+        
+        if len(set(seen)) != len(seen) or len(seen) != data["total_devices"]:
+            print(f"❌ Walked {len(seen)} devices ({len(set(seen))} distinct) of {data['total_devices']}")
+            return False
+        print(f"✅ Walked {len(seen)} devices in pages of {limit}, no duplicates or gaps")
+        return True
+    except Exception as e:
+        print(f"❌ Device pagination error: {e}")
+        return False
+
 def test_get_updates():
     """Test getting update list"""
     print("\nTesting update list...")
@@ -154,9 +426,10 @@ if __name__ == "__main__":
     main()
 '''
     
+    version = "4.0.0"
     try:
         payload = {
-            "version": "4.0.0",
+            "version": version,
             "description": "Custom LED sequence test",
             "code": custom_code
         }
@@ -165,13 +438,16 @@ if __name__ == "__main__":
         if response.status_code == 200:
             data = response.json()
             print(f"✅ Custom update added: {data['message']}")
-            return True
+            return test_get_updates() is not None
         else:
             print(f"❌ Custom update failed: {response.status_code}")
             return False
     except Exception as e:
         print(f"❌ Custom update error: {e}")
         return False
+    finally:
+        # Leave the server as it was, so 3.0.0 is still up to date on the next run
+        requests.delete(f"{SERVER_URL}/updates/{version}")
 
 def simulate_device_lifecycle():
     """Simulate a complete device update lifecycle"""
@@ -220,27 +496,579 @@ def run_all_tests():
     # Test endpoints
     test_get_updates()
     test_get_devices()
+    test_device_pages()
     
     # Test OTA flow
     test_check_update("1.0.0")
     test_check_update("2.0.0")
     test_check_update("3.0.0")  # Should be up to date
     
+    test_update_policy()
+    test_semver_ordering()
+    test_conditional_check()
+    
     # Test download
     test_download_update()
+    test_firmware_download()
+    test_metrics()
+    test_rollout()
     
-    # Add custom update
+    # Add custom update, listed and then deleted again
     test_add_custom_update()
     
-    # Test updated list
-    test_get_updates()
-    
     # Full lifecycle simulation
     simulate_device_lifecycle()
     
     print("\n✅ All tests completed!")
     return True
 
+def make_image(size, seed=0):
+    """Python source of exactly size bytes, about as compressible as real code"""
+    import random
+    rng = random.Random(seed)
+    words = ["value", "sensor", "read", "led", "state", "count", "buffer", "timeout",
+             "modem", "retry", "offset", "length", "config", "update", "status"]
+    lines = [f'"""Benchmark image, {size} bytes"""\nVERSION = "{BENCH_VERSION}"\n']
+    total = len(lines[0])
+    while total < size:
+        name = "_".join(rng.choice(words) for _ in range(2))
+        line = f"{name}_{rng.randrange(10000)} = {rng.randrange(1 << 20)}  # {rng.choice(words)} {rng.choice(words)}\n"
+        lines.append(line)
+        total += len(line)
+    image = "".join(lines)[:size - 1]
+    return image[:image.rfind("\n") + 1].ljust(size - 1, "#") + "\n"
+
+class Phase:
+    """Measures one phase of the device code: wall time, AT round trips,
+    bytes over the UART and the air, and peak Python heap (tracemalloc)
+    """
+    
+    def __init__(self, results, name, modem):
+        self.results = results
+        self.name = name
+        self.modem = modem
+    
+    def __enter__(self):
+        import tracemalloc
+        self.stats = dict(self.modem.stats)
+        self.heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.start = time.monotonic()
+        return self
+    
+    def __exit__(self, *exc):
+        import tracemalloc
+        elapsed = time.monotonic() - self.start
+        stats = self.modem.stats
+        self.results[self.name] = {
+            "wall_s": round(elapsed, 3),
+            "at_commands": stats["commands"] - self.stats["commands"],
+            "http_requests": stats["http_requests"] - self.stats["http_requests"],
+            "coap_messages": stats["coap_messages"] - self.stats["coap_messages"],
+            "uart_tx_bytes": stats["uart_tx_bytes"] - self.stats["uart_tx_bytes"],
+            "uart_rx_bytes": stats["uart_rx_bytes"] - self.stats["uart_rx_bytes"],
+            "air_up_bytes": stats["air_up_bytes"] - self.stats["air_up_bytes"],
+            "air_down_bytes": stats["air_down_bytes"] - self.stats["air_down_bytes"],
+            "peak_heap_bytes": tracemalloc.get_traced_memory()[1] - self.heap
+        }
+        return False
+
+def publish_benchmark_release(image):
+    """Replace the benchmark releases on the server with a fresh pair"""
+    cleanup_benchmark_releases()
+    for version, code in ((BENCH_BASE_VERSION, f'VERSION = "{BENCH_BASE_VERSION}"\n'),
+                          (BENCH_VERSION, image)):
+        response = requests.post(f"{SERVER_URL}/updates", json={
+            "version": version,
+            "description": "OTA benchmark",
+            "code": code
+        })
+        response.raise_for_status()
+
+def cleanup_benchmark_releases():
+    for version in (BENCH_BASE_VERSION, BENCH_VERSION):
+        requests.delete(f"{SERVER_URL}/updates/{version}")
+
+def benchmark_case(size, encoding, link, transport="http", coap_port=BENCH_COAP_PORT):
+    """Run check -> download -> apply of one image on an emulated device"""
+    import contextlib
+    import io
+    import os
+    import tempfile
+    import pico_emu
+    from pico_emu.__main__ import load_main
+    
+    image = make_image(size)
+    publish_benchmark_release(image)
+    
+    main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    flash = tempfile.mkdtemp(prefix="pico-bench-")
+    cwd = os.getcwd()
+    os.chdir(flash)
+    with open(main_path) as src, open("main.py", "w") as dst:
+        dst.write(src.read())
+    
+    modem = pico_emu.install(pico_emu.SIM7020E(pico_emu.LINKS[link]))
+    phases = {}
+    case = {"size": size, "transport": transport, "encoding": encoding, "phases": phases, "ok": False}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            main = load_main(main_path)
+            main.OTA_SERVER = SERVER_URL
+            main.VERSION = BENCH_BASE_VERSION
+            main.TRANSFER_ENCODINGS = [encoding]
+            main.TRANSPORT = transport
+            main.COAP_PORT = coap_port
+            modem.apn = main.APN
+            
+            async def lifecycle():
+                with Phase(phases, "bringup", modem):
+                    if not await main.init_sim7020():
+                        return None
+                with Phase(phases, "check", modem):
+                    info = await main.check_for_update()
+                if not info or not info.get("update_available"):
+                    return None
+                case["compression"] = info.get("compression", "none")
+                case["transfer_size"] = info.get("size")
+                with Phase(phases, "download", modem):
+                    target = await main.download_update(info)
+                    await main.transport().close()
+                if not target:
+                    return None
+                with Phase(phases, "apply", modem):
+                    try:
+                        await main.apply_update(target, info)
+                    except pico_emu.DeviceReset:
+                        return target
+                return None
+            
+            target = pico_emu.uasyncio.run(lifecycle())
+        if target:
+            with open(os.path.join(target, "app.py")) as f:
+                case["ok"] = f.read() == image
+    except Exception as e:
+        case["error"] = str(e)
+    finally:
+        os.chdir(cwd)
+        cleanup_benchmark_releases()
+    if not case["ok"]:
+        case["log_tail"] = log.getvalue()[-2000:]
+    return case
+
+def run_benchmark(sizes=BENCH_SIZES, encodings=BENCH_ENCODINGS, link="local", output=None,
+                  transports=BENCH_TRANSPORTS, coap_port=BENCH_COAP_PORT):
+    """Benchmark the OTA lifecycle of main.py on pico_emu against the server.
+    
+    Each phase reports wall time, AT commands, network round trips (HTTP
+    requests or CoAP messages), bytes over the UART and the air, and peak
+    heap. The apply phase includes main.py's 3 s delay before it resets.
+    CoAP always carries raw bytes, so it runs once per size rather than
+    once per encoding.
+    """
+    import hashlib
+    import os
+    import platform
+    import tracemalloc
+    
+    print("🚀 OTA Benchmark")
+    print("="*50)
+    if not test_health_check():
+        print("❌ Server not accessible, stopping benchmark")
+        return None
+    
+    root = os.path.dirname(os.path.abspath(__file__))
+    def file_hash(name):
+        with open(os.path.join(root, name), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:12]
+    
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "server": SERVER_URL,
+        "link": link,
+        "transports": transports,
+        "python": platform.python_version(),
+        "main_py_sha256": file_hash("main.py"),
+        "server_js_sha256": file_hash("server.js"),
+        "cases": []
+    }
+    
+    tracemalloc.start()
+    try:
+        for size in sizes:
+            for transport in transports:
+                for encoding in (encodings if transport == "http" else ["bin"]):
+                    case = benchmark_case(size, encoding, link, transport, coap_port)
+                    results["cases"].append(case)
+                    phases = case["phases"]
+                    download = phases.get("download", {})
+                    round_trips = download.get("http_requests", 0) + download.get("coap_messages", 0)
+                    print(f"{'✅' if case['ok'] else '❌'} {size:>7} B {transport:>4} {encoding:>3}: "
+                          f"download {download.get('wall_s', '-')} s, "
+                          f"{download.get('at_commands', '-')} AT cmds, "
+                          f"{round_trips} round trips, "
+                          f"{download.get('air_up_bytes', '-')} B up, "
+                          f"{download.get('air_down_bytes', '-')} B down, "
+                          f"peak heap {download.get('peak_heap_bytes', '-')} B")
+    finally:
+        tracemalloc.stop()
+    
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {output}")
+    else:
+        print(json.dumps(results, indent=2))
+    return results
+
+class LoadStats:
+    """Latencies, errors and throttled requests per request kind, shared by
+    the load test workers"""
+    
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.throttled = {}
+    
+    def record(self, kind, latency, ok, throttled=False):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(latency)
+            if throttled:
+                self.throttled[kind] = self.throttled.get(kind, 0) + 1
+            elif not ok:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+    
+    def report(self, elapsed):
+        report = {}
+        for kind, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            def percentile(q):
+                return round(latencies[int(round(q * (len(latencies) - 1)))] * 1000, 1)
+            report[kind] = {
+                "requests": len(latencies),
+                "throughput_rps": round(len(latencies) / elapsed, 1),
+                "p50_ms": percentile(0.50),
+                "p95_ms": percentile(0.95),
+                "p99_ms": percentile(0.99),
+                "max_ms": round(latencies[-1] * 1000, 1),
+                "error_rate": round(self.errors.get(kind, 0) / len(latencies), 4),
+                "throttled": self.throttled.get(kind, 0)
+            }
+        return report
+
+class FleetDevice:
+    """One simulated device following main.py's cadence: check for an update
+    every interval (or as hinted by the server, jittered, backing off after
+    failures) and, if there is one, download it chunk by chunk
+    """
+    
+    def __init__(self, device_id, version, interval, rng):
+        self.device_id = device_id
+        self.version = version
+        self.interval = interval
+        self.rng = rng
+        self.hint = None
+        self.failures = 0
+        self.download = None  # {"info", "file", "offset"} of a download in progress
+    
+    def next_due(self, ok):
+        """Same schedule as next_check_delay() in main.py"""
+        self.failures = 0 if ok else self.failures + 1
+        if self.failures:
+            delay = min(self.interval * 2 ** min(self.failures, 16), 3600)
+        else:
+            delay = self.hint or self.interval
+        return time.monotonic() + delay * (1 + self.rng.uniform(-0.2, 0.2))
+    
+    def post(self, session, stats, kind, payload):
+        start = time.monotonic()
+        try:
+            response = session.post(f"{SERVER_URL}/ota", json=payload, timeout=30)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            response = None
+            ok = False
+        stats.record(kind, time.monotonic() - start, ok)
+        return response if ok else None
+    
+    def fetch(self, session, stats, kind, url, headers):
+        """GET from the server, returns the response (also a 429 throttle) or None on failure"""
+        start = time.monotonic()
+        try:
+            response = session.get(SERVER_URL + url, params={"d": self.device_id}, headers=headers, timeout=30)
+            throttled = response.status_code == 429
+            ok = throttled or response.status_code in (200, 206)
+        except requests.RequestException:
+            response = None
+            throttled = ok = False
+        stats.record(kind, time.monotonic() - start, ok, throttled)
+        return response if ok else None
+    
+    def conditional_check(self, session, stats):
+        """GET /c/<version> like main.py, returns the response or None on failure"""
+        start = time.monotonic()
+        try:
+            response = session.get(f"{SERVER_URL}/c/{self.version}", params={"d": self.device_id}, timeout=30)
+            ok = response.status_code in (200, 304)
+        except requests.RequestException:
+            response = None
+            ok = False
+        stats.record("check_conditional", time.monotonic() - start, ok)
+        return response if ok else None
+    
+    def step(self, session, stats):
+        """One update check (and download), returns when the next one is due"""
+        if self.download:
+            return self.resume_download(session, stats)
+        self.hint = None
+        response = self.conditional_check(session, stats)
+        if response is None:
+            return self.next_due(False)
+        if response.status_code == 304:
+            return self.next_due(True)
+        if response.text.startswith("N "):
+            self.hint = int(response.text[2:])
+            return self.next_due(True)
+        
+        response = self.post(session, stats, "check_update", {
+            "device_id": self.device_id,
+            "current_version": self.version,
+            "action": "check_update",
+            "encodings": ["bin"],
+            "compression": ["zlib"],
+            "formats": ["py"]
+        })
+        if response is None:
+            return self.next_due(False)
+        info = response.json()
+        self.hint = info.get("next_check")
+        if not info.get("update_available"):
+            return self.next_due(True)
+        self.download = {"info": info, "file": 0, "offset": 0}
+        return self.resume_download(session, stats)
+    
+    def resume_download(self, session, stats):
+        """Fetch the chunks of the download in progress. A throttled chunk is
+        requested again after the server's Retry-After, as download_chunk()
+        in main.py does. That is no failure, so it does not add to the backoff.
+        """
+        info = self.download["info"]
+        chunk_size = info.get("chunk_size", 1024)
+        files = info.get("files", [])
+        while self.download["file"] < len(files):
+            transfer = files[self.download["file"]]["transfer"]
+            while self.download["offset"] < transfer["size"]:
+                offset = self.download["offset"]
+                last = min(offset + chunk_size, transfer["size"]) - 1
+                chunk = self.fetch(session, stats, "download_chunk", transfer["url"],
+                                   {"Range": f"bytes={offset}-{last}"})
+                if chunk is None:
+                    self.download = None
+                    return self.next_due(False)
+                if chunk.status_code == 429:
+                    # Come back for the same chunk without holding a worker
+                    return time.monotonic() + int(chunk.headers.get("Retry-After", 5))
+                self.download["offset"] = last + 1
+            self.download["file"] += 1
+            self.download["offset"] = 0
+        self.version = info["new_version"]
+        self.download = None
+        return self.next_due(True)
+
+def server_memory():
+    """Resident set size of the server process in bytes, None if unknown"""
+    try:
+        return requests.get(f"{SERVER_URL}/health", timeout=10).json()["memory"]["rss"]
+    except (requests.RequestException, KeyError, ValueError):
+        return None
+
+def parse_metrics(text):
+    """Prometheus text exposition as {(name, ((label, value), ...)): value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, labels = series.partition("{")
+        samples[(name, tuple(re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels)))] = float(value)
+    return samples
+
+class MetricsScraper:
+    """Scrapes the server's /metrics every interval seconds in the background"""
+    
+    def __init__(self, interval):
+        import threading
+        self.interval = interval
+        self.scrapes = []
+        self.failures = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def scrape(self):
+        try:
+            response = requests.get(f"{SERVER_URL}/metrics", timeout=10)
+            response.raise_for_status()
+            self.scrapes.append(parse_metrics(response.text))
+        except requests.RequestException:
+            self.failures += 1
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.scrape()
+    
+    def start(self):
+        self.scrape()
+        self.thread.start()
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.scrape()
+    
+    def report(self):
+        """What the server saw between the first and the last scrape"""
+        if len(self.scrapes) < 2:
+            return None
+        first, last = self.scrapes[0], self.scrapes[-1]
+        
+        def delta(key):
+            return last.get(key, 0) - first.get(key, 0)
+        
+        def series(samples, name):
+            return {labels: value for (metric, labels), value in samples.items() if metric == name}
+        
+        latency = {}
+        for labels in series(last, "ota_request_duration_seconds_count"):
+            count = delta(("ota_request_duration_seconds_count", labels))
+            if not count:
+                continue
+            buckets = sorted(
+                (float(dict(bucket)["le"]), delta(("ota_request_duration_seconds_bucket", bucket)))
+                for bucket in series(last, "ota_request_duration_seconds_bucket")
+                if bucket[:-1] == labels)
+            def bound(q):
+                # Upper bound of the bucket holding the q quantile
+                le = next(le for le, cumulative in buckets if cumulative >= q * count)
+                return round(le * 1000, 1) if le != float("inf") else None
+            latency[dict(labels)["action"]] = {
+                "requests": int(count),
+                "mean_ms": round(delta(("ota_request_duration_seconds_sum", labels)) / count * 1000, 2),
+                "p50_ms_le": bound(0.50),
+                "p95_ms_le": bound(0.95)
+            }
+        
+        hits = delta(("ota_store_cache_hits_total", ()))
+        misses = delta(("ota_store_cache_misses_total", ()))
+        return {
+            "scrapes": len(self.scrapes),
+            "scrape_failures": self.failures,
+            "ota_latency": latency,
+            "bytes_served": {"/".join(value for _, value in labels): int(delta(("ota_artifact_bytes_served_total", labels)))
+                             for labels in series(last, "ota_artifact_bytes_served_total")},
+            "max_downloads_in_flight": int(max(scrape.get(("ota_downloads_in_flight", ()), 0)
+                                               for scrape in self.scrapes)),
+            "cache_hit_rate": round(hits / (hits + misses), 4) if hits + misses else None,
+            "devices_by_version": {dict(labels)["version"]: int(value)
+                                   for labels, value in series(last, "ota_devices").items()}
+        }
+
+def run_load_test(devices=LOAD_DEVICES, duration=LOAD_DURATION, interval=LOAD_INTERVAL,
+                  workers=LOAD_WORKERS, ramp=0, output=None, scrape=None):
+    """Simulate a fleet of devices checking in concurrently.
+    
+    All devices start within ramp seconds (0 = all at once, as after a
+    power outage). Each worker thread keeps its own pooled connection.
+    With scrape set, the server's /metrics is scraped every scrape seconds
+    and the server-side view is reported alongside the client's.
+    """
+    import heapq
+    import random
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    
+    print(f"🚀 Load test: {devices} devices, {duration} s, check every {interval} s")
+    print("="*50)
+    if not test_health_check():
+        print("❌ Server not accessible, stopping load test")
+        return None
+    
+    versions = ["1.0.0"] + [update["version"] for update in requests.get(f"{SERVER_URL}/updates").json()["updates"]]
+    rng = random.Random(0)
+    local = threading.local()
+    stats = LoadStats()
+    
+    def step(device):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return device.step(local.session, stats)
+    
+    memory_before = server_memory()
+    scraper = MetricsScraper(scrape) if scrape else None
+    if scraper:
+        scraper.start()
+    start = time.monotonic()
+    end = start + duration
+    queue = [(start + ramp * i / devices, i, FleetDevice(f"load_{i:05d}", rng.choice(versions), interval, rng))
+             for i in range(devices)]
+    heapq.heapify(queue)
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while running or (queue and queue[0][0] < end):
+            now = time.monotonic()
+            while queue and queue[0][0] <= now and now < end:
+                _, i, device = heapq.heappop(queue)
+                running[pool.submit(step, device)] = (i, device)
+            for future in [future for future in running if future.done()]:
+                i, device = running.pop(future)
+                due = future.result()
+                if due < end:
+                    heapq.heappush(queue, (due, i, device))
+            time.sleep(0.01)
+    
+    elapsed = time.monotonic() - start
+    if scraper:
+        scraper.stop()
+    memory_after = server_memory()
+    results = {
+        "devices": devices,
+        "duration_s": round(elapsed, 1),
+        "interval_s": interval,
+        "workers": workers,
+        "requests": stats.report(elapsed),
+        "server_rss_before": memory_before,
+        "server_rss_after": memory_after,
+        "server_rss_growth": memory_after - memory_before if memory_before and memory_after else None
+    }
+    if scraper:
+        results["server_metrics"] = scraper.report()
+    
+    for kind, report in results["requests"].items():
+        print(f"{kind:>15}: {report['requests']} requests, {report['throughput_rps']} req/s, "
+              f"p50 {report['p50_ms']} ms, p95 {report['p95_ms']} ms, p99 {report['p99_ms']} ms, "
+              f"errors {report['error_rate'] * 100:.2f}%, throttled {report['throttled']}")
+    print(f"Server memory growth: {results['server_rss_growth']} bytes")
+    metrics = results.get("server_metrics")
+    if metrics:
+        print(f"Server metrics ({metrics['scrapes']} scrapes):")
+        for action, report in metrics["ota_latency"].items():
+            print(f"{action:>15}: {report['requests']} requests, mean {report['mean_ms']} ms, "
+                  f"p50 <= {report['p50_ms_le']} ms, p95 <= {report['p95_ms_le']} ms")
+        for artifact, served in metrics["bytes_served"].items():
+            print(f"{artifact:>15}: {served} bytes served")
+        print(f"Max downloads in flight: {metrics['max_downloads_in_flight']}, "
+              f"cache hit rate: {metrics['cache_hit_rate']}")
+        print(f"Devices by version: {metrics['devices_by_version']}")
+    
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {output}")
+    return results
+
 def interactive_test():
     """Interactive test mode"""
     while True:
@@ -285,12 +1113,44 @@ def interactive_test():
             print("Invalid option, please try again")
 
 if __name__ == "__main__":
-    import sys
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="OTA System Test Script")
+    parser.add_argument("--interactive", action="store_true", help="interactive test menu")
+    parser.add_argument("--benchmark", action="store_true", help="benchmark the device OTA lifecycle on pico_emu")
+    parser.add_argument("--load", action="store_true", help="simulate a fleet of devices checking in concurrently")
+    parser.add_argument("--devices", type=int, default=LOAD_DEVICES, help="load test: number of devices")
+    parser.add_argument("--duration", type=float, default=LOAD_DURATION, help="load test: seconds of load")
+    parser.add_argument("--interval", type=float, default=LOAD_INTERVAL, help="load test: seconds between checks")
+    parser.add_argument("--workers", type=int, default=LOAD_WORKERS, help="load test: concurrent connections")
+    parser.add_argument("--ramp", type=float, default=0, help="load test: seconds over which devices start")
+    parser.add_argument("--scrape", type=float, nargs="?", const=LOAD_SCRAPE_INTERVAL,
+                        help="load test: scrape /metrics every SCRAPE seconds and report the server's view")
+    parser.add_argument("--link", default="local", help="benchmark network model: local or nbiot")
+    parser.add_argument("--sizes", help="comma separated image sizes in bytes")
+    parser.add_argument("--encodings", help="comma separated transfer encodings")
+    parser.add_argument("--transports", help="benchmark: comma separated transports, http and/or coap")
+    parser.add_argument("--coap-port", type=int, default=BENCH_COAP_PORT, help="benchmark: server's CoAP port")
+    parser.add_argument("--output", help="write benchmark or load test results to this JSON file")
+    parser.add_argument("--server", default=SERVER_URL, help="server URL")
+    args = parser.parse_args()
+    SERVER_URL = args.server
     
     print("OTA System Test Script")
     print("Make sure your server is running on", SERVER_URL)
     
-    if len(sys.argv) > 1 and sys.argv[1] == "--interactive":
+    if args.interactive:
         interactive_test()
+    elif args.benchmark:
+        run_benchmark(
+            [int(size) for size in args.sizes.split(",")] if args.sizes else BENCH_SIZES,
+            args.encodings.split(",") if args.encodings else BENCH_ENCODINGS,
+            args.link,
+            args.output,
+            args.transports.split(",") if args.transports else BENCH_TRANSPORTS,
+            args.coap_port)
+    elif args.load:
+        run_load_test(args.devices, args.duration, args.interval, args.workers, args.ramp, args.output,
+                      args.scrape)
     else:
         run_all_tests()